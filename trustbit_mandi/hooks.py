@@ -86,7 +86,7 @@ app_include_css = "/assets/trustbit_mandi/css/trustbit_mandi.css"
 # ------------
 
 # before_install = "trustbit_mandi.install.before_install"
-# after_install = "trustbit_mandi.install.after_install"
+after_install = "trustbit_mandi.install.after_install"
 
 # Uninstallation
 # ------------
@@ -148,6 +148,12 @@ app_include_css = "/assets/trustbit_mandi/css/trustbit_mandi.css"
 # 	}
 # }
 
+doc_events = {
+	"Sales Invoice": {
+		"on_cancel": "trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.consolidated_invoicing.release_consolidated_invoice",
+	},
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -169,6 +175,16 @@ app_include_css = "/assets/trustbit_mandi/css/trustbit_mandi.css"
 # 	],
 # }
 
+scheduler_events = {
+	"all": [
+		"trustbit_mandi.trustbit_mandi.doctype.mandi_erp_outbox.mandi_erp_outbox.schedule_erp_outbox",
+	],
+	"daily": [
+		"trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.consolidated_invoicing.create_consolidated_invoices",
+		"trustbit_mandi.trustbit_mandi.doctype.mandi_stock_closing.mandi_stock_closing.create_stock_closings",
+	],
+}
+
 # Testing
 # -------
 
@@ -0,0 +1,32 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+
+def after_install():
+	create_route_custom_fields()
+
+
+def create_route_custom_fields():
+	"""Map coordinates on Customer, used to order Vehicle Dispatch stops."""
+	create_custom_fields(
+		{
+			"Customer": [
+				{
+					"fieldname": "mandi_latitude",
+					"fieldtype": "Float",
+					"label": "Latitude",
+					"precision": "6",
+					"insert_after": "customer_group",
+					"description": "Delivery location, used to order Vehicle Dispatch stops",
+				},
+				{
+					"fieldname": "mandi_longitude",
+					"fieldtype": "Float",
+					"label": "Longitude",
+					"precision": "6",
+					"insert_after": "mandi_latitude",
+				},
+			]
+		},
+		update=True,
+	)
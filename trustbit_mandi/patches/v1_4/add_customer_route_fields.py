@@ -0,0 +1,5 @@
+from trustbit_mandi.install import create_route_custom_fields
+
+
+def execute():
+	create_route_custom_fields()
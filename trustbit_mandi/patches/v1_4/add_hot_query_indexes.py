@@ -0,0 +1,24 @@
+"""Create the composite indexes behind the app's hot queries on existing sites.
+
+They are declared in each doctype's on_doctype_update(), which only runs
+when that doctype is synced. Single-column indexes are search_index fields
+and are picked up by the regular doctype sync during migrate.
+"""
+import frappe
+
+
+def execute():
+	from trustbit_mandi.trustbit_mandi.doctype.deal.deal import on_doctype_update as deal
+	from trustbit_mandi.trustbit_mandi.doctype.deal_delivery_item.deal_delivery_item import (
+		on_doctype_update as deal_delivery_item,
+	)
+	from trustbit_mandi.trustbit_mandi.doctype.deal_price_list.deal_price_list import (
+		on_doctype_update as deal_price_list,
+	)
+	from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_entry_item.mandi_stock_entry_item import (
+		on_doctype_update as mandi_stock_entry_item,
+	)
+
+	for create_indexes in (deal, deal_delivery_item, deal_price_list, mandi_stock_entry_item):
+		create_indexes()
+
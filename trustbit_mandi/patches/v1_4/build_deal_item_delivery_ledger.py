@@ -0,0 +1,31 @@
+import frappe
+
+
+def execute():
+	"""Populate Deal Item Delivery Ledger from existing submitted deliveries.
+
+	Earlier patches that refresh Deal statuses read the ledger, which is
+	empty until now on sites running them in the same migrate, so the
+	statuses of delivered Deals are refreshed once more from the new ledger.
+	"""
+	from trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.deal_item_delivery_ledger import (
+		rebuild_ledger,
+	)
+
+	rebuild_ledger()
+	frappe.db.commit()
+
+	deals = frappe.db.sql("""
+		SELECT DISTINCT dl.deal
+		FROM `tabDeal Item Delivery Ledger` dl
+		INNER JOIN `tabDeal` d ON d.name = dl.deal
+		WHERE d.status != 'Cancelled'
+	""", pluck=True)
+
+	for deal_name in deals:
+		try:
+			frappe.get_doc("Deal", deal_name).update_delivery_status()
+		except Exception:
+			frappe.log_error(title="Deal status refresh failed for {0}".format(deal_name))
+
+	frappe.db.commit()
@@ -0,0 +1,11 @@
+import frappe
+
+
+def execute():
+	"""Populate Mandi Stock Bin from existing submitted stock entries."""
+	from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_bin.mandi_stock_bin import (
+		rebuild_stock_bins,
+	)
+
+	rebuild_stock_bins()
+	frappe.db.commit()
@@ -0,0 +1,119 @@
+"""Step timing for the dispatch, delivery and stock pipelines.
+
+Wrap a stage in trace_step() to record its wall time and the number of SQL
+queries it ran as a Mandi Step Timing row. Tracing is off unless the site
+config has `mandi_step_timing` set:
+
+	bench --site <site> set-config mandi_step_timing 1
+
+Spans are buffered until the outermost span of the request ends and then
+handed to a background job in one batch, so nested stages (a Deal Delivery
+submitted inside a Vehicle Dispatch) cost a single write. The job is queued
+straight away rather than after commit, so the timings of a step that fails
+and rolls back are kept too.
+"""
+
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import now_datetime
+
+
+def is_tracing_enabled():
+	return bool(frappe.conf.get("mandi_step_timing"))
+
+
+@contextmanager
+def count_sql():
+	"""Count the queries run on this connection inside the block.
+
+	frappe.db.sql is wrapped only for the duration of the block and put back
+	afterwards; yields a one-item list holding the running count.
+	"""
+	db = frappe.local.db
+	patched = "sql" in vars(db)
+	original_sql = db.sql
+	counter = [0]
+
+	def sql(*args, **kwargs):
+		counter[0] += 1
+		return original_sql(*args, **kwargs)
+
+	db.sql = sql
+	try:
+		yield counter
+	finally:
+		if patched:
+			db.sql = original_sql
+		else:
+			del db.sql
+
+
+@contextmanager
+def trace_step(reference_doctype, reference_name, stage):
+	"""Time `stage` of a document's pipeline; a no-op unless tracing is enabled."""
+	if not is_tracing_enabled():
+		yield
+		return
+
+	if getattr(frappe.local, "mandi_step_depth", 0):
+		with record_span(reference_doctype, reference_name, stage):
+			yield
+		return
+
+	# Outermost span: count queries while it runs, then hand every span on
+	frappe.local.mandi_step_spans = []
+	try:
+		with count_sql() as counter:
+			frappe.local.mandi_sql_counter = counter
+			with record_span(reference_doctype, reference_name, stage):
+				yield
+	finally:
+		spans = frappe.local.mandi_step_spans
+		frappe.local.mandi_step_spans = []
+		frappe.local.mandi_sql_counter = None
+		save_spans_in_background(spans)
+
+
+@contextmanager
+def record_span(reference_doctype, reference_name, stage):
+	counter = frappe.local.mandi_sql_counter
+	depth = frappe.local.mandi_step_depth = getattr(frappe.local, "mandi_step_depth", 0) + 1
+	started_at = now_datetime()
+	sql_start = counter[0]
+	clock_start = time.perf_counter()
+	try:
+		yield
+	finally:
+		frappe.local.mandi_step_spans.append((
+			frappe.generate_hash(length=10), stage, reference_doctype, reference_name, started_at,
+			round((time.perf_counter() - clock_start) * 1000, 3), counter[0] - sql_start,
+		))
+		frappe.local.mandi_step_depth = depth - 1
+
+
+def save_spans_in_background(spans):
+	if not spans:
+		return
+	try:
+		frappe.enqueue(
+			"trustbit_mandi.tracing.save_spans",
+			queue="short",
+			spans=spans,
+			user=frappe.session.user,
+		)
+	except Exception:
+		# Timing must never break the operation being timed
+		frappe.log_error(title="Mandi step timing could not be saved")
+
+
+def save_spans(spans, user):
+	"""Background job: write one batch of spans as Mandi Step Timing rows."""
+	timestamp = now_datetime()
+	frappe.db.bulk_insert(
+		"Mandi Step Timing",
+		["name", "stage", "reference_doctype", "reference_name", "started_at",
+		 "duration_ms", "sql_count", "creation", "modified", "owner", "modified_by"],
+		[(*span, timestamp, timestamp, user, user) for span in spans],
+	)
@@ -5,6 +5,10 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import flt
 
+# Columns written by the delivery-driven partial update in update_delivery_status
+ITEM_DELIVERY_FIELDS = ("delivered_qty", "delivered_kg", "pending_qty", "pending_kg", "item_status")
+DEAL_DELIVERY_FIELDS = ("total_delivered_kg", "total_pending_kg", "status")
+
 
 class Deal(Document):
 	def before_save(self):
@@ -16,6 +20,23 @@ class Deal(Document):
 		if not self.items:
 			frappe.throw("At least one item is required in the Deal.")
 
+	def on_update(self):
+		self.clear_pending_items_cache()
+
+	def on_trash(self):
+		self.clear_pending_items_cache()
+
+	def clear_pending_items_cache(self):
+		from trustbit_mandi.trustbit_mandi.doctype.deal_delivery.deal_delivery import (
+			clear_pending_items_cache,
+		)
+
+		customers = {self.customer}
+		previous = self.get_doc_before_save()
+		if previous:
+			customers.add(previous.customer)
+		clear_pending_items_cache(customers)
+
 	def calculate_items(self):
 		"""Calculate amount, pending_qty, KG and item_status for each item row."""
 		for row in self.items:
@@ -69,26 +90,55 @@ class Deal(Document):
 			if self.status not in ("Open", "Confirmed"):
 				self.status = "Open"
 
-	def update_delivery_status(self):
-		"""Called by Deal Delivery to recalculate delivered qty/KG for ALL item rows."""
-		for row in self.items:
-			result = frappe.db.sql("""
-				SELECT
-					COALESCE(SUM(sdi.deliver_qty), 0),
-					COALESCE(SUM(sdi.deliver_qty * sdi.pack_weight_kg), 0)
-				FROM `tabDeal Delivery Item` sdi
-				INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
-				WHERE sdi.soda = %s AND sdi.deal_item = %s
-				  AND sd.docstatus = 1
-			""", (self.name, row.name))[0]
-
-			row.delivered_qty = flt(result[0])
-			row.delivered_kg = flt(result[1])
+	def update_delivery_status(self, deal_items=None):
+		"""Called by Deal Delivery to refresh delivered qty/KG from the Deal Item
+		Delivery Ledger.
+
+		With `deal_items`, only those rows are recomputed and only the columns
+		that actually changed (on the rows and on the Deal) are written back
+		directly — no full save, hooks or Version. Without it, every row is
+		refreshed and the Deal is saved.
+		"""
+		from trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.deal_item_delivery_ledger import (
+			get_delivered_totals,
+		)
+
+		if deal_items is None:
+			rows = self.items
+		else:
+			deal_items = set(deal_items)
+			rows = [row for row in self.items if row.name in deal_items]
+
+		delivered = get_delivered_totals([row.name for row in rows])
+		for row in rows:
+			before = {f: row.get(f) for f in ITEM_DELIVERY_FIELDS}
+
+			totals = delivered[row.name]
+			row.delivered_qty = flt(totals.delivered_qty)
+			row.delivered_kg = flt(totals.delivered_kg)
 			row.pending_qty = flt(row.qty) - flt(row.delivered_qty)
 			booked_kg = flt(row.qty) * flt(row.pack_weight_kg)
 			row.pending_kg = booked_kg - flt(row.delivered_kg)
 			self._update_item_status(row)
 
+			if deal_items is not None:
+				changed = {f: row.get(f) for f in ITEM_DELIVERY_FIELDS if row.get(f) != before[f]}
+				if changed:
+					row.db_set(changed, update_modified=False)
+
+		if deal_items is None:
+			self.calculate_totals()
+			self.auto_update_status()
+			self.save(ignore_permissions=True)
+			return
+
+		before = {f: self.get(f) for f in DEAL_DELIVERY_FIELDS}
 		self.calculate_totals()
 		self.auto_update_status()
-		self.save(ignore_permissions=True)
+		changed = {f: self.get(f) for f in DEAL_DELIVERY_FIELDS if self.get(f) != before[f]}
+		if changed:
+			self.db_set(changed, notify=True)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Deal", ["customer", "status", "soda_date"])
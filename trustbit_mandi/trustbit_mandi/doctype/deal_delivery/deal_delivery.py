@@ -3,7 +3,15 @@
 
 import frappe
 from frappe.model.document import Document
-from frappe.utils import flt
+from frappe.utils import cint, flt
+
+from trustbit_mandi.tracing import trace_step
+from trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.deal_item_delivery_ledger import (
+	apply_delivery,
+	get_delivered_totals,
+	get_delivery_totals,
+	lock_deal_items,
+)
 
 
 class DealDelivery(Document):
@@ -28,6 +36,13 @@ class DealDelivery(Document):
 			row.is_extra = 1 if not row.soda else 0
 
 	def validate_items(self):
+		"""Validate rows against their Deals in a constant number of queries:
+		all referenced Deals and Deal Items are loaded together, and delivered
+		totals for every referenced deal item come from one ledger read."""
+		deal_rows = [row for row in self.items if row.soda]
+		deals = get_deals_for_delivery([row.soda for row in deal_rows])
+		delivered = get_delivered_totals([row.deal_item for row in deal_rows], self.name)
+
 		for row in self.items:
 			if not row.deliver_qty or flt(row.deliver_qty) <= 0:
 				frappe.throw("Row {0}: Deliver Qty must be greater than 0.".format(row.idx))
@@ -40,26 +55,21 @@ class DealDelivery(Document):
 					frappe.throw("Row {0}: Pack Size is required.".format(row.idx))
 				continue
 
-			deal = frappe.get_doc("Deal", row.soda)
+			deal = deals.get(row.soda)
+			if not deal:
+				frappe.throw("Deal {0} not found.".format(row.soda), frappe.DoesNotExistError)
 
 			if deal.status == "Cancelled":
 				frappe.throw("Deal {0} is cancelled. Cannot deliver against it.".format(row.soda))
 
-			# Find the specific Deal Item row
-			deal_item_row = None
-			for di in deal.items:
-				if di.name == row.deal_item:
-					deal_item_row = di
-					break
-
+			deal_item_row = deal.items.get(row.deal_item)
 			if not deal_item_row:
 				frappe.throw("Deal Item {0} not found in Deal {1}.".format(
 					row.deal_item, row.soda))
 
 			# Validate in KG (allows different pack sizes)
 			booked_kg = flt(deal_item_row.qty) * flt(deal_item_row.pack_weight_kg)
-			other_delivered_kg = get_other_delivered_kg_for_item(
-				row.soda, row.deal_item, self.name)
+			other_delivered_kg = delivered[row.deal_item].delivered_kg
 			available_kg = booked_kg - flt(other_delivered_kg)
 			delivering_kg = flt(row.deliver_qty) * flt(row.pack_weight_kg)
 
@@ -84,21 +94,73 @@ class DealDelivery(Document):
 		self.total_delivery_kg = total_kg
 		self.total_amount = total_amount
 
+	def before_submit(self):
+		with trace_step(self.doctype, self.name, "Validate Available KG"):
+			self.validate_available_kg()
+
+	def validate_available_kg(self):
+		"""Re-check available KG under row locks before the delivery counts.
+
+		validate_items runs at save time with plain reads, so two deliveries
+		against the same Deal Item could both pass it and then both submit.
+		Here the ledger rows are locked (see lock_deal_items) and the check is
+		repeated against the latest committed totals, summed per deal item.
+		"""
+		totals = get_delivery_totals(self)
+		if not totals:
+			return
+
+		locked = lock_deal_items({d: entry.deal for d, entry in totals.items()})
+		deals = get_deals_for_delivery({entry.deal for entry in totals.values()})
+
+		for deal_item, entry in sorted(totals.items()):
+			deal_item_row = deals.get(entry.deal, frappe._dict(items={}))["items"].get(deal_item)
+			if not deal_item_row:
+				frappe.throw("Deal Item {0} not found in Deal {1}.".format(deal_item, entry.deal))
+
+			booked_kg = flt(deal_item_row.qty) * flt(deal_item_row.pack_weight_kg)
+			ledger = locked.get(deal_item)
+			available_kg = booked_kg - flt(ledger.delivered_kg if ledger else 0)
+
+			if entry.delivered_kg > available_kg + 1:
+				frappe.throw(
+					"Delivering {0:.2f} KG for Deal {1} Item {2} exceeds available {3:.2f} KG".format(
+						entry.delivered_kg, entry.deal, deal_item_row.item, available_kg
+					)
+				)
+
 	def on_submit(self):
 		"""Update Deal statuses only when delivery is submitted."""
 		self.db_set("status", "Loaded & Submitted")
-		self.update_deal_statuses()
-		self.create_stock_entry()
+		with trace_step(self.doctype, self.name, "Delivery Ledger"):
+			apply_delivery(self, 1)
+		with trace_step(self.doctype, self.name, "Deal Status"):
+			self.update_deal_statuses()
+		self.clear_pending_items_cache()
+		with trace_step(self.doctype, self.name, "Stock Entry"):
+			self.create_stock_entry()
 
 	def on_cancel(self):
 		"""Recalculate Deal statuses when delivery is cancelled."""
 		self.db_set("status", "Cancelled")
+		apply_delivery(self, -1)
 		self.update_deal_statuses()
+		self.clear_pending_items_cache()
 		self.cancel_stock_entry()
 
+	def clear_pending_items_cache(self):
+		"""Drop cached pending lists of this customer and of every Deal's customer."""
+		customers = {self.customer}
+		deals = {row.soda for row in self.items if row.soda}
+		if deals:
+			customers.update(frappe.get_all(
+				"Deal", filters={"name": ["in", list(deals)]}, pluck="customer"))
+		clear_pending_items_cache(customers)
+
 	def create_stock_entry(self):
 		"""Auto-create a Mandi Stock Entry (Issue) for this delivery."""
 		from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_entry.mandi_stock_entry import (
+			NegativeStockError,
 			create_stock_entry_from_delivery,
 		)
 
@@ -111,6 +173,9 @@ class DealDelivery(Document):
 				indicator="green",
 				alert=True,
 			)
+		except NegativeStockError:
+			# Blocked in Mandi Settings: the delivery must not go out without its stock
+			raise
 		except Exception as e:
 			frappe.log_error(
 				title="Stock Entry Creation Failed for {0}".format(self.name),
@@ -153,82 +218,131 @@ class DealDelivery(Document):
 				pass
 
 	def update_deal_statuses(self):
-		affected_deals = set()
+		"""Refresh only the Deal Item rows this delivery touched."""
+		affected_deals = {}
 		for row in self.items:
-			if row.soda:
-				affected_deals.add(row.soda)
-
-		for deal_name in affected_deals:
+			if row.soda and row.deal_item:
+				affected_deals.setdefault(row.soda, set()).add(row.deal_item)
+
+		bulk = frappe.flags.deal_delivery_bulk
+		for deal_name, deal_items in affected_deals.items():
+			if bulk:
+				# submit_deliveries recomputes each Deal once at the end
+				bulk.deferred_deal_items.setdefault(deal_name, set()).update(deal_items)
+				continue
 			deal = frappe.get_doc("Deal", deal_name)
-			deal.update_delivery_status()
+			deal.update_delivery_status(deal_items)
 
 
-def get_other_delivered_qty_for_item(deal_name, deal_item_name, exclude_delivery=None):
-	"""Get total delivered qty (packs) for a specific Deal Item row.
-	Only counts submitted deliveries (docstatus=1)."""
-	conditions = ["sdi.soda = %s", "sdi.deal_item = %s", "sd.docstatus = 1"]
-	values = [deal_name, deal_item_name]
+def get_deals_for_delivery(deal_names):
+	"""Load status and item rows of several Deals in one query.
 
-	if exclude_delivery:
-		conditions.append("sd.name != %s")
-		values.append(exclude_delivery)
+	Returns {deal_name: _dict(status, items={deal_item_name: row})}; Deals
+	that do not exist are absent. During submit_deliveries, Deals already
+	loaded for an earlier delivery of the batch are reused.
+	"""
+	deal_names = {d for d in deal_names if d}
+	bulk = frappe.flags.deal_delivery_bulk
+	cached = bulk.deals if bulk else {}
+
+	deals = {d: cached[d] for d in deal_names if d in cached}
+	deal_names -= set(deals)
+	if not deal_names:
+		return deals
 
-	result = frappe.db.sql("""
-		SELECT COALESCE(SUM(sdi.deliver_qty), 0)
-		FROM `tabDeal Delivery Item` sdi
-		INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
-		WHERE {conditions}
-	""".format(conditions=" AND ".join(conditions)), values)
+	rows = frappe.db.sql("""
+		SELECT
+			d.name as deal_name,
+			d.status,
+			di.name as deal_item_name,
+			di.item,
+			di.pack_size,
+			di.pack_weight_kg,
+			di.qty
+		FROM `tabDeal` d
+		LEFT JOIN `tabDeal Item` di
+			ON di.parent = d.name AND di.parenttype = 'Deal'
+		WHERE d.name IN %(deals)s
+	""", {"deals": tuple(deal_names)}, as_dict=True)
 
-	return flt(result[0][0]) if result else 0
+	for row in rows:
+		deal = deals.setdefault(row.deal_name, frappe._dict(status=row.status, items={}))
+		if row.deal_item_name:
+			deal["items"][row.deal_item_name] = row
+		if bulk:
+			cached[row.deal_name] = deal
+	return deals
+
+
+def get_other_delivered_qty_for_item(deal_name, deal_item_name, exclude_delivery=None):
+	"""Get total delivered qty (packs) for a specific Deal Item row.
+	Only counts submitted deliveries (docstatus=1)."""
+	return get_delivered_totals([deal_item_name], exclude_delivery)[deal_item_name].delivered_qty
 
 
 def get_other_delivered_kg_for_item(deal_name, deal_item_name, exclude_delivery=None):
 	"""Get total delivered KG for a specific Deal Item row.
 	Only counts submitted deliveries (docstatus=1)."""
-	conditions = ["sdi.soda = %s", "sdi.deal_item = %s", "sd.docstatus = 1"]
-	values = [deal_name, deal_item_name]
-
+	return get_delivered_totals([deal_item_name], exclude_delivery)[deal_item_name].delivered_kg
+
+
+def get_pending_deal_item_rows(fields, deal_conditions, item_conditions, values,
+		exclude_delivery=None, order_by="d.soda_date ASC, d.creation ASC, di.idx ASC", limit=None):
+	"""Deal Item rows with their submitted delivered totals, in a single query.
+
+	Delivered packs/KG come from the Deal Item Delivery Ledger, joined in as
+	`dlv_qty` / `dlv_kg`. When `exclude_delivery` is set, that delivery's own
+	submitted rows are aggregated and subtracted in the same query.
+	`deal_conditions` reference the Deal (`d`), `item_conditions` the Deal Item
+	(`di`); `values` is a dict of named parameters shared by both.
+	"""
+	values = dict(values)
+	limit_clause = "LIMIT {0}".format(int(limit)) if limit else ""
+	exclude_join = ""
+	exclude_qty = exclude_kg = ""
 	if exclude_delivery:
-		conditions.append("sd.name != %s")
-		values.append(exclude_delivery)
-
-	result = frappe.db.sql("""
-		SELECT COALESCE(SUM(sdi.deliver_qty * sdi.pack_weight_kg), 0)
-		FROM `tabDeal Delivery Item` sdi
-		INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
-		WHERE {conditions}
-	""".format(conditions=" AND ".join(conditions)), values)
-
-	return flt(result[0][0]) if result else 0
-
-
-@frappe.whitelist()
-def get_pending_deal_items(customer, item=None, pack_size=None, exclude_delivery=None):
-	"""FIFO: Get all pending Deal Item rows for a customer, oldest deal first."""
-	item_conditions = ""
-	values = [customer]
+		exclude_join = """
+		LEFT JOIN (
+			SELECT
+				sdi.deal_item,
+				SUM(sdi.deliver_qty) as delivered_qty,
+				SUM(sdi.deliver_qty * sdi.pack_weight_kg) as delivered_kg
+			FROM `tabDeal Delivery Item` sdi
+			INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
+			WHERE sd.name = %(exclude_delivery)s AND sd.docstatus = 1
+			GROUP BY sdi.deal_item
+		) ex ON ex.deal_item = di.name"""
+		exclude_qty = " - COALESCE(ex.delivered_qty, 0)"
+		exclude_kg = " - COALESCE(ex.delivered_kg, 0)"
+		values["exclude_delivery"] = exclude_delivery
+
+	where = " AND ".join(list(deal_conditions) + list(item_conditions))
 
-	if item:
-		item_conditions += " AND di.item = %s"
-		values.append(item)
+	return frappe.db.sql("""
+		SELECT
+			{fields},
+			COALESCE(dl.delivered_qty, 0){exclude_qty} as dlv_qty,
+			COALESCE(dl.delivered_kg, 0){exclude_kg} as dlv_kg
+		FROM `tabDeal Item` di
+		INNER JOIN `tabDeal` d ON d.name = di.parent
+		LEFT JOIN `tabDeal Item Delivery Ledger` dl
+			ON dl.name = di.name AND dl.deal = d.name
+		{exclude_join}
+		WHERE {where}
+		ORDER BY {order_by}
+		{limit_clause}
+	""".format(
+		fields=fields,
+		exclude_qty=exclude_qty,
+		exclude_kg=exclude_kg,
+		exclude_join=exclude_join,
+		where=where,
+		order_by=order_by,
+		limit_clause=limit_clause,
+	), values, as_dict=True)
 
-	if pack_size:
-		item_conditions += " AND di.pack_size = %s"
-		values.append(pack_size)
 
-	# When editing an existing delivery (exclude_delivery set), include
-	# "Delivered" deals/items too — excluding the current delivery may
-	# make them pending again.
-	if exclude_delivery:
-		deal_statuses = "('Open', 'Confirmed', 'Partially Delivered', 'Delivered')"
-		item_statuses = "('Open', 'Partially Delivered', 'Delivered')"
-	else:
-		deal_statuses = "('Open', 'Confirmed', 'Partially Delivered')"
-		item_statuses = "('Open', 'Partially Delivered')"
-
-	rows = frappe.db.sql("""
-		SELECT
+PENDING_DEAL_ITEM_FIELDS = """
 			d.name as deal_name,
 			d.soda_date,
 			d.customer,
@@ -245,53 +359,179 @@ def get_pending_deal_items(customer, item=None, pack_size=None, exclude_delivery
 			di.rate,
 			di.price_per_kg,
 			di.base_price_50kg,
-			di.item_status
-		FROM `tabDeal Item` di
-		INNER JOIN `tabDeal` d ON d.name = di.parent
-		WHERE d.customer = %s
-		  AND d.status IN {deal_statuses}
-		  AND di.item_status IN {item_statuses}
-		  {item_conditions}
-		ORDER BY d.soda_date ASC, d.creation ASC, di.idx ASC
-	""".format(
-		deal_statuses=deal_statuses,
-		item_statuses=item_statuses,
-		item_conditions=item_conditions
-	), values, as_dict=True)
+			di.item_status"""
+
+# FIFO order; d.name breaks ties between deals created in the same instant so
+# the order is total and can be paged with a keyset.
+PENDING_DEAL_ITEM_ORDER = "d.soda_date ASC, d.creation ASC, d.name ASC, di.idx ASC"
 
-	result = []
-	for row in rows:
-		booked_kg = flt(row.qty) * flt(row.pack_weight_kg)
-		other_delivered_kg = get_other_delivered_kg_for_item(
-			row.deal_name, row.deal_item_name, exclude_delivery)
-		pending_kg = booked_kg - flt(other_delivered_kg)
-
-		other_delivered_packs = get_other_delivered_qty_for_item(
-			row.deal_name, row.deal_item_name, exclude_delivery)
-		actual_pending_packs = flt(row.qty) - flt(other_delivered_packs)
-
-		if pending_kg > 0.1:
-			row['already_delivered'] = flt(other_delivered_packs)
-			row['pending_qty'] = actual_pending_packs
-			row['booked_kg'] = booked_kg
-			row['delivered_kg'] = flt(other_delivered_kg)
-			row['pending_kg'] = pending_kg
-			result.append(row)
 
+def get_pending_filters(customer, item=None, pack_size=None, exclude_delivery=None):
+	"""Deal / Deal Item conditions and values for a customer's pending lines."""
+	values = {"customer": customer}
+	item_conditions = []
+
+	if item:
+		item_conditions.append("di.item = %(item)s")
+		values["item"] = item
+
+	if pack_size:
+		item_conditions.append("di.pack_size = %(pack_size)s")
+		values["pack_size"] = pack_size
+
+	# When editing an existing delivery (exclude_delivery set), include
+	# "Delivered" deals/items too — excluding the current delivery may
+	# make them pending again.
+	if exclude_delivery:
+		deal_statuses = "('Open', 'Confirmed', 'Partially Delivered', 'Delivered')"
+		item_statuses = "('Open', 'Partially Delivered', 'Delivered')"
+	else:
+		deal_statuses = "('Open', 'Confirmed', 'Partially Delivered')"
+		item_statuses = "('Open', 'Partially Delivered')"
+
+	deal_conditions = [
+		"d.customer = %(customer)s",
+		"d.status IN {0}".format(deal_statuses),
+	]
+	item_conditions.insert(0, "di.item_status IN {0}".format(item_statuses))
+	return deal_conditions, item_conditions, values
+
+
+def set_pending_totals(row):
+	"""Replace the joined delivered totals on `row` with the pending figures.
+	Returns False when the line has nothing left to deliver."""
+	booked_kg = flt(row.qty) * flt(row.pack_weight_kg)
+	other_delivered_kg = flt(row.pop("dlv_kg"))
+	pending_kg = booked_kg - other_delivered_kg
+
+	other_delivered_packs = flt(row.pop("dlv_qty"))
+	actual_pending_packs = flt(row.qty) - other_delivered_packs
+
+	if pending_kg <= 0.1:
+		return False
+
+	row['already_delivered'] = other_delivered_packs
+	row['pending_qty'] = actual_pending_packs
+	row['booked_kg'] = booked_kg
+	row['delivered_kg'] = other_delivered_kg
+	row['pending_kg'] = pending_kg
+	return True
+
+
+PENDING_CACHE_KEY = "trustbit_mandi:pending_deal_items:{0}"
+PENDING_CACHE_STATS_KEY = "trustbit_mandi:pending_deal_items_stats:{0}"
+
+
+def clear_pending_items_cache(customers=None):
+	"""Invalidate cached pending lists for `customers` (all customers if None).
+
+	Cleared immediately, so the rest of this request reads fresh data, and
+	again after commit, so a concurrent request cannot re-cache the
+	pre-commit state in between.
+	"""
+	def clear():
+		if customers is None:
+			frappe.cache.delete_keys(PENDING_CACHE_KEY.format(""))
+		else:
+			frappe.cache.delete_value([PENDING_CACHE_KEY.format(c) for c in customers if c])
+
+	clear()
+	frappe.db.after_commit.add(clear)
+
+
+def _count_pending_cache(outcome):
+	frappe.cache.incrby(frappe.cache.make_key(PENDING_CACHE_STATS_KEY.format(outcome)), 1)
+
+
+@frappe.whitelist()
+def get_pending_items_cache_stats():
+	"""Hit/miss counters of the pending deal items cache since the last reset."""
+	stats = {}
+	for outcome in ("hits", "misses"):
+		stats[outcome] = cint(frappe.cache.get(frappe.cache.make_key(PENDING_CACHE_STATS_KEY.format(outcome))))
+	lookups = stats["hits"] + stats["misses"]
+	stats["hit_rate"] = flt(stats["hits"] * 100 / lookups, 2) if lookups else 0
+	return stats
+
+
+@frappe.whitelist()
+def get_pending_deal_items(customer, item=None, pack_size=None, exclude_delivery=None):
+	"""FIFO: Get all pending Deal Item rows for a customer, oldest deal first.
+
+	Results are cached per customer in Redis (one hash per customer, one field
+	per filter combination) until a Deal or Deal Delivery of that customer
+	changes; see clear_pending_items_cache.
+	"""
+	cache_key = PENDING_CACHE_KEY.format(customer)
+	cache_field = "{0}|{1}|{2}".format(item or "", pack_size or "", exclude_delivery or "")
+	cached = frappe.cache.hget(cache_key, cache_field)
+	if cached is not None:
+		_count_pending_cache("hits")
+		return cached
+
+	_count_pending_cache("misses")
+	result = _get_pending_deal_items(customer, item, pack_size, exclude_delivery)
+	frappe.cache.hset(cache_key, cache_field, result)
 	return result
 
 
+def _get_pending_deal_items(customer, item=None, pack_size=None, exclude_delivery=None):
+	deal_conditions, item_conditions, values = get_pending_filters(
+		customer, item, pack_size, exclude_delivery)
+
+	rows = get_pending_deal_item_rows(
+		PENDING_DEAL_ITEM_FIELDS, deal_conditions, item_conditions, values, exclude_delivery,
+		order_by=PENDING_DEAL_ITEM_ORDER)
+
+	return [row for row in rows if set_pending_totals(row)]
+
+
+def iter_pending_deal_items(customer, item=None, pack_size=None, exclude_delivery=None, page_size=20):
+	"""FIFO: Yield the same rows as get_pending_deal_items, oldest deal first,
+	fetching them in keyset-paged chunks only as the caller asks for more."""
+	deal_conditions, item_conditions, values = get_pending_filters(
+		customer, item, pack_size, exclude_delivery)
+	fields = PENDING_DEAL_ITEM_FIELDS + ", d.creation as deal_creation, di.idx as deal_item_idx"
+
+	keyset = None
+	while True:
+		page_conditions = list(item_conditions)
+		page_values = dict(values)
+		if keyset:
+			page_conditions.append(
+				"(d.soda_date, d.creation, d.name, di.idx)"
+				" > (%(after_soda_date)s, %(after_creation)s, %(after_deal)s, %(after_idx)s)")
+			page_values.update(keyset)
+
+		rows = get_pending_deal_item_rows(
+			fields, deal_conditions, page_conditions, page_values, exclude_delivery,
+			order_by=PENDING_DEAL_ITEM_ORDER, limit=page_size)
+
+		for row in rows:
+			keyset = {
+				"after_soda_date": row.soda_date,
+				"after_creation": row.pop("deal_creation"),
+				"after_deal": row.deal_name,
+				"after_idx": row.pop("deal_item_idx"),
+			}
+			if set_pending_totals(row):
+				yield row
+
+		if len(rows) < page_size:
+			return
+
+
 @frappe.whitelist()
 def allocate_fifo(customer, total_qty, item=None, pack_size=None, exclude_delivery=None):
-	"""FIFO: Allocate delivery qty across pending Deal Items, oldest deal first."""
-	pending = get_pending_deal_items(customer, item, pack_size, exclude_delivery)
+	"""FIFO: Allocate delivery qty across pending Deal Items, oldest deal first.
+
+	Pending lines are pulled lazily, so only the oldest few deals are read
+	when they already cover `total_qty`."""
 	remaining = flt(total_qty)
 	allocations = []
 
+	pending = iter_pending_deal_items(customer, item, pack_size, exclude_delivery) if remaining > 0 else []
 	for row in pending:
-		if remaining <= 0:
-			break
-
 		allocate_qty = min(remaining, flt(row['pending_qty']))
 		allocations.append({
 			'soda': row['deal_name'],
@@ -307,6 +547,9 @@ def allocate_fifo(customer, total_qty, item=None, pack_size=None, exclude_delive
 			'amount': allocate_qty * flt(row['rate'])
 		})
 		remaining -= allocate_qty
+		if remaining <= 0:
+			# Stop before the generator reads another row (or page)
+			break
 
 	if remaining > 0:
 		frappe.msgprint(
@@ -317,6 +560,166 @@ def allocate_fifo(customer, total_qty, item=None, pack_size=None, exclude_delive
 	return allocations
 
 
+@frappe.whitelist()
+def allocate_fifo_kg(customer, item, pack_size, total_qty, exclude_delivery=None):
+	"""FIFO in KG: allocate `total_qty` packs of `pack_size` across every pending
+	Deal Item of `item`, whatever pack size each deal was booked in.
+
+	The delivery is converted to KG and walked oldest deal first; each line
+	takes as many whole delivering packs as its pending KG holds (with the same
+	1 KG tolerance validate_items allows). Pending lines come from a single
+	query. Returns the allocations plus what could not be placed.
+
+	API only: the Deal Delivery form's Get Items dialog does not call it.
+	"""
+	weight_kg = flt(frappe.db.get_value("Deal Pack Size", pack_size, "weight_kg"))
+	if weight_kg <= 0:
+		frappe.throw("Pack Size {0} has no weight.".format(pack_size))
+
+	bag_cost = flt(frappe.db.get_value(
+		"Package Bag Master", {"item": item, "pack_size": pack_size, "is_active": 1}, "bag_cost"))
+
+	deal_conditions, item_conditions, values = get_pending_filters(
+		customer, item, None, exclude_delivery)
+	rows = get_pending_deal_item_rows(
+		PENDING_DEAL_ITEM_FIELDS + ", di.bag_cost", deal_conditions, item_conditions, values, exclude_delivery,
+		order_by=PENDING_DEAL_ITEM_ORDER)
+
+	remaining_packs = int(flt(total_qty))
+	allocations = []
+
+	for row in rows:
+		if remaining_packs <= 0:
+			break
+		if not set_pending_totals(row):
+			continue
+
+		packs = min(remaining_packs, int((flt(row.pending_kg) + 1) / weight_kg + 1e-9))
+		if packs <= 0:
+			continue
+
+		allocated_kg = packs * weight_kg
+		# Same pricing as the Get Items dialog: the booked rate less its bag cost
+		# gives the price per KG, and the delivering pack's bag cost is added back
+		if flt(row.price_per_kg):
+			price_per_kg = flt(row.price_per_kg)
+		elif flt(row.pack_weight_kg):
+			price_per_kg = (flt(row.rate) - flt(row.bag_cost)) / flt(row.pack_weight_kg)
+		else:
+			price_per_kg = 0
+		rate = price_per_kg * weight_kg + bag_cost
+
+		allocations.append({
+			'soda': row.deal_name,
+			'deal_item': row.deal_item_name,
+			'customer': row.customer_name,
+			'item': row.item,
+			'pack_size': pack_size,
+			'pack_weight_kg': weight_kg,
+			'booked_pack_size': row.pack_size,
+			'pending_kg': row.pending_kg,
+			'deliver_qty': packs,
+			'deliver_kg': allocated_kg,
+			'leftover_kg': max(flt(row.pending_kg) - allocated_kg, 0),
+			'bag_cost': bag_cost,
+			'rate': rate,
+			'amount': packs * rate,
+		})
+		remaining_packs -= packs
+
+	if remaining_packs > 0:
+		frappe.msgprint(
+			"Warning: {0} packs ({1:.2f} KG) could not be allocated. Insufficient pending Deal quantity.".format(
+				remaining_packs, remaining_packs * weight_kg),
+			indicator='orange'
+		)
+
+	return {
+		"allocations": allocations,
+		"allocated_kg": sum(a['deliver_kg'] for a in allocations),
+		"unallocated_qty": remaining_packs,
+		"unallocated_kg": remaining_packs * weight_kg,
+	}
+
+
+@frappe.whitelist()
+def bulk_submit_deliveries(names):
+	"""Queue submission of several draft Deal Deliveries as one background job.
+
+	Per-document results are pushed to the caller through the
+	`deal_delivery_bulk_submit` realtime event when the job finishes.
+	"""
+	names = frappe.parse_json(names) if isinstance(names, str) else names
+	if not names:
+		frappe.throw("Select at least one Deal Delivery.")
+	frappe.has_permission("Deal Delivery", "submit", throw=True)
+
+	frappe.enqueue(
+		"trustbit_mandi.trustbit_mandi.doctype.deal_delivery.deal_delivery.submit_deliveries",
+		queue="long",
+		timeout=3600,
+		names=list(names),
+		user=frappe.session.user,
+	)
+	frappe.msgprint(
+		"{0} Deal Deliveries queued for submission.".format(len(names)),
+		indicator="blue", alert=True)
+
+
+def submit_deliveries(names, user=None):
+	"""Submit draft Deal Deliveries together; returns one result per name.
+
+	Drafts are submitted oldest first (delivery_date, creation) so earlier
+	deliveries draw on deal quantity first, as they would have one by one.
+	All their deal items are locked up front in one ordered pass, Deals are
+	loaded once for the whole batch, and each affected Deal is recomputed once
+	at the end instead of once per delivery. A failing delivery is rolled back
+	to its own savepoint and the rest continue.
+	"""
+	drafts = frappe.get_all(
+		"Deal Delivery",
+		filters={"name": ["in", list(names)], "docstatus": 0},
+		order_by="delivery_date asc, creation asc",
+		pluck="name",
+	)
+	results = [
+		{"name": name, "status": "Skipped", "error": "Not a draft Deal Delivery"}
+		for name in names if name not in drafts
+	]
+
+	if drafts:
+		lock_deal_items(dict(frappe.db.sql("""
+			SELECT DISTINCT deal_item, soda
+			FROM `tabDeal Delivery Item`
+			WHERE parent IN %(drafts)s AND parenttype = 'Deal Delivery'
+			  AND soda IS NOT NULL AND soda != ''
+			  AND deal_item IS NOT NULL AND deal_item != ''
+		""", {"drafts": tuple(drafts)})))
+
+	frappe.flags.deal_delivery_bulk = frappe._dict(deals={}, deferred_deal_items={})
+	try:
+		for name in drafts:
+			frappe.db.savepoint("bulk_deal_delivery")
+			try:
+				frappe.get_doc("Deal Delivery", name).submit()
+				results.append({"name": name, "status": "Submitted"})
+			except Exception as e:
+				frappe.db.rollback(save_point="bulk_deal_delivery")
+				frappe.log_error(title="Bulk submit failed for {0}".format(name))
+				results.append({"name": name, "status": "Failed", "error": str(e)})
+
+		deferred = frappe.flags.deal_delivery_bulk.deferred_deal_items
+	finally:
+		frappe.flags.deal_delivery_bulk = None
+
+	for deal_name, deal_items in deferred.items():
+		frappe.get_doc("Deal", deal_name).update_delivery_status(deal_items)
+
+	frappe.publish_realtime(
+		"deal_delivery_bulk_submit", {"results": results}, user=user or frappe.session.user)
+	return results
+
+
 @frappe.whitelist()
 def get_pack_sizes():
 	"""Get all active pack sizes for dropdown."""
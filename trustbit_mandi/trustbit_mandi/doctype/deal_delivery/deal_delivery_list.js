@@ -9,5 +9,37 @@ frappe.listview_settings['Deal Delivery'] = {
 		} else if (doc.docstatus === 2) {
 			return [__('Cancelled'), 'red', 'docstatus,=,2'];
 		}
+	},
+
+	onload: function(listview) {
+		listview.page.add_action_item(__('Submit in Background'), function() {
+			let names = listview.get_checked_items(true);
+			if (!names.length) {
+				frappe.msgprint(__('Select the draft deliveries to submit.'));
+				return;
+			}
+			frappe.call({
+				method: 'trustbit_mandi.trustbit_mandi.doctype.deal_delivery.deal_delivery.bulk_submit_deliveries',
+				args: { names: names }
+			});
+		});
+
+		frappe.realtime.off('deal_delivery_bulk_submit');
+		frappe.realtime.on('deal_delivery_bulk_submit', function(data) {
+			let failed = (data.results || []).filter(function(r) { return r.status !== 'Submitted'; });
+			let submitted = (data.results || []).length - failed.length;
+			let message = __('{0} Deal Deliveries submitted.', [submitted]);
+			if (failed.length) {
+				message += '<br><br>' + failed.map(function(r) {
+					return '<b>' + r.name + '</b>: ' + frappe.utils.escape_html(r.error || r.status);
+				}).join('<br>');
+			}
+			frappe.msgprint({
+				title: __('Bulk Submit Finished'),
+				message: message,
+				indicator: failed.length ? 'orange' : 'green'
+			});
+			listview.refresh();
+		});
 	}
 };
@@ -7,3 +7,7 @@ from frappe.model.document import Document
 
 class DealDeliveryItem(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Deal Delivery Item", ["soda", "deal_item"])
@@ -0,0 +1,212 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt, now
+
+
+class DealItemDeliveryLedger(Document):
+	pass
+
+
+def get_delivery_totals(delivery):
+	"""Delivered packs/KG per deal_item for one Deal Delivery document."""
+	totals = {}
+	for row in delivery.items:
+		if not row.soda or not row.deal_item:
+			continue
+		entry = totals.setdefault(row.deal_item, frappe._dict(
+			deal=row.soda, delivered_qty=0, delivered_kg=0))
+		entry.delivered_qty += flt(row.deliver_qty)
+		entry.delivered_kg += flt(row.deliver_qty) * flt(row.pack_weight_kg)
+	return totals
+
+
+def apply_delivery(delivery, sign):
+	"""Add (sign=1, submit) or remove (sign=-1, cancel) a delivery's rows.
+
+	All affected counters are moved in one INSERT ... ON DUPLICATE KEY UPDATE,
+	so the ledger row is created on a deal item's first delivery. Returns the
+	affected deal_item names.
+	"""
+	totals = get_delivery_totals(delivery)
+	if not totals:
+		return []
+
+	timestamp = now()
+	user = frappe.session.user
+	placeholders = []
+	values = []
+	for deal_item in sorted(totals):
+		entry = totals[deal_item]
+		placeholders.append("(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+		values.extend([
+			deal_item, entry.deal, deal_item,
+			sign * entry.delivered_qty, sign * entry.delivered_kg,
+			delivery.delivery_date if sign > 0 else None,
+			timestamp, timestamp, user, user,
+		])
+
+	frappe.db.sql("""
+		INSERT INTO `tabDeal Item Delivery Ledger`
+			(name, deal, deal_item, delivered_qty, delivered_kg, last_delivery_date,
+			 creation, modified, owner, modified_by)
+		VALUES {placeholders}
+		ON DUPLICATE KEY UPDATE
+			delivered_qty = delivered_qty + VALUES(delivered_qty),
+			delivered_kg = delivered_kg + VALUES(delivered_kg),
+			last_delivery_date = CASE
+				WHEN VALUES(last_delivery_date) IS NULL THEN last_delivery_date
+				WHEN last_delivery_date IS NULL THEN VALUES(last_delivery_date)
+				ELSE GREATEST(last_delivery_date, VALUES(last_delivery_date))
+			END,
+			modified = VALUES(modified),
+			modified_by = VALUES(modified_by)
+	""".format(placeholders=", ".join(placeholders)), values)
+
+	if sign < 0:
+		# A cancelled delivery may have been the latest one; dates cannot be
+		# decremented, so re-derive them for just the affected rows.
+		refresh_last_delivery_dates(list(totals))
+
+	return sorted(totals)
+
+
+def refresh_last_delivery_dates(deal_items):
+	frappe.db.sql("""
+		UPDATE `tabDeal Item Delivery Ledger` dl
+		LEFT JOIN (
+			SELECT sdi.deal_item, MAX(sd.delivery_date) as last_delivery_date
+			FROM `tabDeal Delivery Item` sdi
+			INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
+			WHERE sd.docstatus = 1 AND sdi.deal_item IN %(deal_items)s
+			GROUP BY sdi.deal_item
+		) src ON src.deal_item = dl.name
+		SET dl.last_delivery_date = src.last_delivery_date
+		WHERE dl.name IN %(deal_items)s
+	""", {"deal_items": tuple(deal_items)})
+
+
+def lock_deal_items(deal_items):
+	"""Take row locks on the ledger rows of `deal_items` ({deal_item: deal}).
+
+	Missing rows are created first so there is always something to lock.
+	The insert takes an exclusive lock on rows that already exist too (an
+	INSERT IGNORE would only take a shared one, and two submits holding it
+	would deadlock upgrading to FOR UPDATE). Both the insert and the
+	SELECT ... FOR UPDATE walk the rows in name order, so concurrent submits
+	touching overlapping deal items queue up on the first shared row
+	instead of deadlocking. Locks are held until the transaction ends.
+	Returns the locked (latest committed) totals keyed by deal_item.
+	"""
+	deal_items = {d: deal for d, deal in (deal_items or {}).items() if d and deal}
+	if not deal_items:
+		return {}
+
+	timestamp = now()
+	user = frappe.session.user
+	placeholders = []
+	values = []
+	for deal_item in sorted(deal_items):
+		placeholders.append("(%s, %s, %s, 0, 0, %s, %s, %s, %s)")
+		values.extend([deal_item, deal_items[deal_item], deal_item, timestamp, timestamp, user, user])
+
+	frappe.db.sql("""
+		INSERT INTO `tabDeal Item Delivery Ledger`
+			(name, deal, deal_item, delivered_qty, delivered_kg,
+			 creation, modified, owner, modified_by)
+		VALUES {placeholders}
+		ON DUPLICATE KEY UPDATE name = name
+	""".format(placeholders=", ".join(placeholders)), values)
+
+	return {
+		row.name: row
+		for row in frappe.db.sql("""
+			SELECT name, delivered_qty, delivered_kg
+			FROM `tabDeal Item Delivery Ledger`
+			WHERE name IN %(deal_items)s
+			ORDER BY name
+			FOR UPDATE
+		""", {"deal_items": tuple(sorted(deal_items))}, as_dict=True)
+	}
+
+
+def get_delivered_totals(deal_items, exclude_delivery=None):
+	"""Ledger totals keyed by deal_item: delivered_qty, delivered_kg, last_delivery_date.
+
+	Deal items with no submitted delivery are returned as zeros. When
+	`exclude_delivery` is a submitted delivery, its own rows are subtracted, so
+	callers see what the *other* deliveries have taken.
+	"""
+	deal_items = [d for d in set(deal_items or []) if d]
+	result = {
+		d: frappe._dict(delivered_qty=0, delivered_kg=0, last_delivery_date=None)
+		for d in deal_items
+	}
+	if not deal_items:
+		return result
+
+	for row in frappe.db.sql("""
+		SELECT name, delivered_qty, delivered_kg, last_delivery_date
+		FROM `tabDeal Item Delivery Ledger`
+		WHERE name IN %(deal_items)s
+	""", {"deal_items": tuple(deal_items)}, as_dict=True):
+		result[row.name].update(
+			delivered_qty=flt(row.delivered_qty),
+			delivered_kg=flt(row.delivered_kg),
+			last_delivery_date=row.last_delivery_date,
+		)
+
+	if exclude_delivery and frappe.db.get_value("Deal Delivery", exclude_delivery, "docstatus") == 1:
+		delivery = frappe.get_doc("Deal Delivery", exclude_delivery)
+		for deal_item, entry in get_delivery_totals(delivery).items():
+			if deal_item in result:
+				result[deal_item].delivered_qty -= entry.delivered_qty
+				result[deal_item].delivered_kg -= entry.delivered_kg
+
+	return result
+
+
+@frappe.whitelist()
+def rebuild_ledger(deal=None):
+	"""Regenerate ledger rows from submitted Deal Delivery Items.
+
+	Run after editing delivery rows directly in the database, e.g.
+	bench --site <site> execute trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.deal_item_delivery_ledger.rebuild_ledger
+	"""
+	frappe.only_for("System Manager")
+
+	condition = ""
+	values = {"timestamp": now(), "user": frappe.session.user}
+	if deal:
+		condition = "AND sdi.soda = %(deal)s"
+		values["deal"] = deal
+		frappe.db.delete("Deal Item Delivery Ledger", {"deal": deal})
+	else:
+		frappe.db.delete("Deal Item Delivery Ledger")
+
+	frappe.db.sql("""
+		INSERT INTO `tabDeal Item Delivery Ledger`
+			(name, deal, deal_item, delivered_qty, delivered_kg, last_delivery_date,
+			 creation, modified, owner, modified_by)
+		SELECT
+			sdi.deal_item, MAX(sdi.soda), sdi.deal_item,
+			SUM(sdi.deliver_qty),
+			SUM(sdi.deliver_qty * sdi.pack_weight_kg),
+			MAX(sd.delivery_date),
+			%(timestamp)s, %(timestamp)s, %(user)s, %(user)s
+		FROM `tabDeal Delivery Item` sdi
+		INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
+		WHERE sd.docstatus = 1
+		  AND sdi.soda IS NOT NULL AND sdi.soda != ''
+		  AND sdi.deal_item IS NOT NULL AND sdi.deal_item != ''
+		  {condition}
+		GROUP BY sdi.deal_item
+	""".format(condition=condition), values)
+
+	from trustbit_mandi.trustbit_mandi.doctype.deal_delivery.deal_delivery import (
+		clear_pending_items_cache,
+	)
+
+	clear_pending_items_cache()
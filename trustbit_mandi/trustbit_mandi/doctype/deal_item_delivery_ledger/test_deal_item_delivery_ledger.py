@@ -0,0 +1,222 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""Concurrent Deal Delivery submits against the same deal items.
+
+Every delivery is submitted from its own process, all released together, so
+the submits really race for the ledger rows. Over-delivery and deadlocks
+only show up with separate connections, which is why the drafts are
+committed first and removed again in tearDownClass.
+"""
+
+import multiprocessing
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+
+PACK_WEIGHT_KG = 50
+BOOKED_QTY = 10
+WORKER_TIMEOUT = 120
+
+
+def submit_in_process(site, sites_path, delivery, barrier, results):
+	"""Worker: submit one Deal Delivery on a fresh connection and report how it went."""
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		doc = frappe.get_doc("Deal Delivery", delivery)
+		barrier.wait(timeout=WORKER_TIMEOUT)
+		try:
+			doc.submit()
+			frappe.db.commit()
+			outcome = "submitted"
+		except Exception as e:
+			frappe.db.rollback()
+			if isinstance(e, frappe.QueryDeadlockError) or frappe.db.is_deadlocked(e):
+				outcome = "deadlock"
+			elif isinstance(e, frappe.ValidationError):
+				outcome = "rejected"
+			else:
+				outcome = repr(e)
+		results.put((delivery, outcome))
+	finally:
+		frappe.destroy()
+
+
+class TestDealItemDeliveryLedger(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		# A negative stock block would reject deliveries for a reason other than the ledger
+		frappe.db.set_single_value("Mandi Settings", "block_negative_issue", 0)
+		cls.customer = make_customer()
+		cls.items = [make_item("_Test Mandi Ledger Item 1"), make_item("_Test Mandi Ledger Item 2")]
+		cls.pack_size = make_pack_size()
+		cls.area = make_price_list_area()
+		cls.deals = []
+		cls.deliveries = []
+		frappe.db.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.rollback()
+		for name in cls.deliveries:
+			if frappe.db.get_value("Deal Delivery", name, "docstatus") == 1:
+				frappe.get_doc("Deal Delivery", name).cancel()
+		for name in cls.deliveries:
+			for mse in frappe.get_all("Mandi Stock Entry", filters={"deal_delivery": name}, pluck="name"):
+				frappe.db.delete("Mandi ERP Outbox", {"reference_doctype": "Mandi Stock Entry", "reference_name": mse})
+				frappe.delete_doc("Mandi Stock Entry", mse, force=True, ignore_permissions=True)
+			frappe.delete_doc("Deal Delivery", name, force=True, ignore_permissions=True)
+		for name in cls.deals:
+			frappe.db.delete("Deal Item Delivery Ledger", {"deal": name})
+			frappe.delete_doc("Deal", name, force=True, ignore_permissions=True)
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def test_concurrent_deliveries_never_exceed_booked_kg(self):
+		"""Six deliveries of 3 packs race for 10 booked packs: exactly three fit."""
+		deal = self.make_deal([self.items[0]])
+		deal_item = deal.items[0]
+		deliveries = [self.make_delivery(deal, [(deal_item, 3)]) for _i in range(6)]
+
+		outcomes = self.submit_concurrently(deliveries)
+
+		self.assertNotIn("deadlock", outcomes.values())
+		self.assertEqual(set(outcomes.values()) - {"submitted", "rejected"}, set(), outcomes)
+		submitted = [name for name, outcome in outcomes.items() if outcome == "submitted"]
+		self.assertEqual(len(submitted), 3, outcomes)
+
+		delivered_kg = flt(frappe.db.get_value("Deal Item Delivery Ledger", deal_item.name, "delivered_kg"))
+		self.assertLessEqual(delivered_kg, BOOKED_QTY * PACK_WEIGHT_KG)
+		self.assertEqual(delivered_kg, len(submitted) * 3 * PACK_WEIGHT_KG)
+
+	def test_overlapping_deal_items_in_any_row_order_do_not_deadlock(self):
+		"""Deliveries list the same two deal items in opposite orders; locks are still taken in one order."""
+		deal = self.make_deal(self.items)
+		first, second = deal.items
+		deliveries = [
+			self.make_delivery(deal, [(first, 2), (second, 2)] if i % 2 else [(second, 2), (first, 2)])
+			for i in range(8)
+		]
+
+		outcomes = self.submit_concurrently(deliveries)
+
+		self.assertNotIn("deadlock", outcomes.values())
+		self.assertEqual(set(outcomes.values()) - {"submitted", "rejected"}, set(), outcomes)
+		submitted = [name for name, outcome in outcomes.items() if outcome == "submitted"]
+		self.assertEqual(len(submitted), BOOKED_QTY // 2, outcomes)
+
+		for deal_item in (first, second):
+			delivered_kg = flt(frappe.db.get_value("Deal Item Delivery Ledger", deal_item.name, "delivered_kg"))
+			self.assertLessEqual(delivered_kg, BOOKED_QTY * PACK_WEIGHT_KG)
+			self.assertEqual(delivered_kg, len(submitted) * 2 * PACK_WEIGHT_KG)
+
+	def submit_concurrently(self, deliveries):
+		"""Submit every draft delivery from its own process at the same moment; returns {name: outcome}."""
+		frappe.db.commit()
+		context = multiprocessing.get_context("spawn")
+		barrier = context.Barrier(len(deliveries))
+		results = context.Queue()
+		processes = [
+			context.Process(
+				target=submit_in_process,
+				args=(frappe.local.site, frappe.local.sites_path, name, barrier, results),
+			)
+			for name in deliveries
+		]
+		for process in processes:
+			process.start()
+
+		outcomes = dict(results.get(timeout=WORKER_TIMEOUT) for _process in processes)
+		for process in processes:
+			process.join(timeout=WORKER_TIMEOUT)
+		# Read what the workers committed, not this connection's snapshot
+		frappe.db.rollback()
+		return outcomes
+
+	def make_deal(self, items):
+		deal = frappe.get_doc({
+			"doctype": "Deal",
+			"customer": self.customer,
+			"price_list_area": self.area,
+			"sales_type": "FOR",
+			"items": [
+				{
+					"item": item,
+					"pack_size": self.pack_size,
+					"pack_weight_kg": PACK_WEIGHT_KG,
+					"qty": BOOKED_QTY,
+					"rate": 1000,
+				}
+				for item in items
+			],
+		}).insert(ignore_permissions=True)
+		self.deals.append(deal.name)
+		return deal
+
+	def make_delivery(self, deal, rows):
+		delivery = frappe.get_doc({
+			"doctype": "Deal Delivery",
+			"customer": self.customer,
+			"items": [
+				{
+					"soda": deal.name,
+					"deal_item": deal_item.name,
+					"item": deal_item.item,
+					"pack_size": deal_item.pack_size,
+					"pack_weight_kg": PACK_WEIGHT_KG,
+					"deliver_qty": qty,
+					"rate": 1000,
+				}
+				for deal_item, qty in rows
+			],
+		}).insert(ignore_permissions=True)
+		self.deliveries.append(delivery.name)
+		return delivery.name
+
+
+def make_customer():
+	customer_name = "_Test Mandi Ledger Customer"
+	# Customers may be named by a series, so look them up by customer_name
+	name = frappe.db.get_value("Customer", {"customer_name": customer_name})
+	if not name:
+		name = frappe.get_doc({
+			"doctype": "Customer",
+			"customer_name": customer_name,
+			"customer_group": frappe.db.get_value("Customer Group", {"is_group": 0}),
+			"territory": frappe.db.get_value("Territory", {"is_group": 0}),
+		}).insert(ignore_permissions=True).name
+	return name
+
+
+def make_item(item_code):
+	if not frappe.db.exists("Item", item_code):
+		frappe.get_doc({
+			"doctype": "Item",
+			"item_code": item_code,
+			"item_group": frappe.db.get_value("Item Group", {"is_group": 0}),
+			"stock_uom": "Nos",
+			"is_stock_item": 0,
+		}).insert(ignore_permissions=True)
+	return item_code
+
+
+def make_pack_size():
+	name = f"_Test Mandi {PACK_WEIGHT_KG} KG"
+	if not frappe.db.exists("Deal Pack Size", name):
+		frappe.get_doc({
+			"doctype": "Deal Pack Size",
+			"pack_size_name": name,
+			"weight_kg": PACK_WEIGHT_KG,
+		}).insert(ignore_permissions=True)
+	return name
+
+
+def make_price_list_area():
+	name = "_Test Mandi Area"
+	if not frappe.db.exists("Deal Price List Area", name):
+		frappe.get_doc({"doctype": "Deal Price List Area", "area_name": name}).insert(ignore_permissions=True)
+	return name
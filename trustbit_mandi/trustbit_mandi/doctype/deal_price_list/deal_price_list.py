@@ -177,3 +177,8 @@ def bulk_update_prices(price_list_area, updates):
 
 	frappe.db.commit()
 	return count
+
+
+def on_doctype_update():
+	frappe.db.add_index(
+		"Deal Price List", ["price_list_area", "item", "is_active", "effective_datetime"])
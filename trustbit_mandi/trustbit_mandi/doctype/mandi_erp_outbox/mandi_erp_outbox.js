@@ -0,0 +1,16 @@
+frappe.ui.form.on('Mandi ERP Outbox', {
+	refresh: function(frm) {
+		if (frm.doc.status === 'Failed') {
+			frm.add_custom_button(__('Retry'), function() {
+				frappe.call({
+					method: 'trustbit_mandi.trustbit_mandi.doctype.mandi_erp_outbox.mandi_erp_outbox.retry_outbox_entry',
+					args: { name: frm.doc.name },
+					freeze: true,
+					callback: function() {
+						frm.reload_doc();
+					}
+				});
+			});
+		}
+	}
+});
@@ -0,0 +1,328 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""Outbox for the ERPNext documents that Mandi documents post.
+
+Stock Entries, Sales Invoices and Payment Entries are not built inline on
+submit. The submit adds an outbox entry in its own transaction
+(queue_erp_documents) and a background worker posts it (process_erp_outbox):
+
+- the ERPNext document, its link back to the Mandi document and the entry's
+  Done status commit together, so every entry is posted exactly once;
+- a failed entry is retried with exponential backoff, then left Failed
+  with its traceback until someone retries it;
+- cancelling the Mandi document cancels its unposted entries and returns
+  the documents already posted, for the caller to cancel
+  (cancel_erp_documents).
+
+Entries are claimed by locking the source document and then the entry, the
+same order a cancel takes them in.
+"""
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_to_date, now_datetime
+
+from trustbit_mandi.tracing import trace_step
+from trustbit_mandi.utils import mandi_erp_context
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 6 * 3600
+# A Processing entry untouched this long belongs to a worker that died
+STALE_PROCESSING_MINUTES = 30
+
+
+class MandiERPOutbox(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Mandi ERP Outbox", ["status", "next_attempt_at"])
+	frappe.db.add_index("Mandi ERP Outbox", ["reference_doctype", "reference_name"])
+
+
+def get_idempotency_key(operation, reference_doctype, reference_name, reference_key=None):
+	return "::".join([operation, reference_doctype, reference_name, reference_key or ""])
+
+
+def queue_erp_documents(reference_doctype, reference_name, entries):
+	"""Add (operation, reference_key) entries of one document to the outbox.
+
+	Entries already queued for the document are skipped, so callers can
+	queue again after a partial run. The worker starts once the caller's
+	transaction commits.
+	"""
+	if not entries:
+		return
+
+	timestamp = now_datetime()
+	user = frappe.session.user
+	frappe.db.bulk_insert(
+		"Mandi ERP Outbox",
+		["name", "operation", "status", "reference_doctype", "reference_name", "reference_key",
+		 "idempotency_key", "attempts", "next_attempt_at", "creation", "modified", "owner", "modified_by"],
+		[
+			(
+				frappe.generate_hash(length=10), operation, "Pending", reference_doctype, reference_name,
+				reference_key, get_idempotency_key(operation, reference_doctype, reference_name, reference_key),
+				0, timestamp, timestamp, timestamp, user, user,
+			)
+			for operation, reference_key in entries
+		],
+		ignore_duplicates=True,
+	)
+	enqueue_outbox_worker()
+
+
+def cancel_erp_documents(reference_doctype, reference_name, reference_keys=None):
+	"""Cancel a document's unposted outbox entries; returns {doctype: [names]} already posted.
+
+	Called on cancel, before the linked ERPNext documents are looked up. The
+	entries are read with a locking read, so a document posted after the
+	cancelling transaction started is still returned. Throws while an entry
+	is being posted.
+	"""
+	conditions = ["reference_doctype = %(reference_doctype)s", "reference_name = %(reference_name)s"]
+	values = {"reference_doctype": reference_doctype, "reference_name": reference_name}
+	if reference_keys is not None:
+		if not reference_keys:
+			return {}
+		conditions.append("reference_key IN %(reference_keys)s")
+		values["reference_keys"] = tuple(reference_keys)
+
+	entries = frappe.db.sql("""
+		SELECT name, operation, status, result_doctype, result_name
+		FROM `tabMandi ERP Outbox`
+		WHERE {conditions}
+		ORDER BY name
+		FOR UPDATE
+	""".format(conditions=" AND ".join(conditions)), values, as_dict=True)
+
+	processing = [entry for entry in entries if entry.status == "Processing"]
+	if processing:
+		frappe.throw("{0} for {1} is being posted to ERPNext right now. Please try again in a moment.".format(
+			processing[0].operation, reference_name))
+
+	unposted = [entry.name for entry in entries if entry.status in ("Pending", "Failed")]
+	if unposted:
+		frappe.db.sql("""
+			UPDATE `tabMandi ERP Outbox`
+			SET status = 'Cancelled', next_attempt_at = NULL, modified = %(modified)s
+			WHERE name IN %(names)s
+		""", {"names": tuple(unposted), "modified": now_datetime()})
+
+	posted = {}
+	for entry in entries:
+		if entry.status == "Done" and entry.result_name:
+			posted.setdefault(entry.result_doctype, []).append(entry.result_name)
+	return posted
+
+
+# ── Worker ──
+
+def enqueue_outbox_worker():
+	frappe.enqueue(
+		"trustbit_mandi.trustbit_mandi.doctype.mandi_erp_outbox.mandi_erp_outbox.process_erp_outbox",
+		queue="long",
+		timeout=3600,
+		job_id="mandi_erp_outbox",
+		deduplicate=True,
+		enqueue_after_commit=True,
+	)
+
+
+def schedule_erp_outbox():
+	"""Scheduled task: start the worker when entries are due, e.g. retries whose backoff has passed."""
+	if get_due_entries(limit=1):
+		enqueue_outbox_worker()
+
+
+def get_due_entries(limit=BATCH_SIZE):
+	"""Due entries, Stock Entries first and Payment Entries last, oldest first."""
+	now = now_datetime()
+	return frappe.db.sql("""
+		SELECT name, operation, reference_key
+		FROM `tabMandi ERP Outbox`
+		WHERE (status = 'Pending' AND (next_attempt_at IS NULL OR next_attempt_at <= %(now)s))
+			OR (status = 'Processing' AND modified < %(stale)s)
+		ORDER BY FIELD(operation, 'Stock Entry', 'Sales Invoice', 'Payment Entry'), creation
+		LIMIT %(limit)s
+	""", {
+		"now": now,
+		"stale": add_to_date(now, minutes=-STALE_PROCESSING_MINUTES),
+		"limit": int(limit),
+	}, as_dict=True)
+
+
+def process_erp_outbox():
+	"""Background job: post every due entry, a batch at a time.
+
+	Company, accounts and the customers' master data are resolved once per
+	batch and shared by every document posted in it.
+	"""
+	seen = set()
+	while True:
+		entries = [entry for entry in get_due_entries() if entry.name not in seen]
+		if not entries:
+			break
+		seen.update(entry.name for entry in entries)
+
+		customers = [entry.reference_key for entry in entries if entry.operation == "Sales Invoice"]
+		with mandi_erp_context(customers):
+			for entry in entries:
+				process_entry(entry.name)
+
+
+def process_entry(name):
+	"""Claim one entry, post its document and record the outcome."""
+	entry = claim_entry(name)
+	if not entry:
+		return
+
+	try:
+		with trace_step(entry.reference_doctype, entry.reference_name, "Outbox " + entry.operation):
+			result = POST_HANDLERS[(entry.operation, entry.reference_doctype)](entry)
+	except Exception:
+		frappe.db.rollback()
+		record_failure(entry, frappe.get_traceback())
+	else:
+		settle_entry(entry, "Done" if result else "Cancelled", result)
+	frappe.db.commit()
+
+
+def claim_entry(name):
+	"""Mark a due entry Processing and commit; returns it, or None when there is nothing to do."""
+	entry = frappe.db.get_value(
+		"Mandi ERP Outbox", name, ["reference_doctype", "reference_name"], as_dict=True)
+	if not entry:
+		return None
+
+	# Source document first, then the entry: the order a cancel locks them in
+	docstatus = frappe.db.get_value(
+		entry.reference_doctype, entry.reference_name, "docstatus", for_update=True)
+	entry = frappe.db.sql("""
+		SELECT name, operation, status, reference_doctype, reference_name, reference_key,
+			attempts, modified
+		FROM `tabMandi ERP Outbox`
+		WHERE name = %s
+		FOR UPDATE
+	""", name, as_dict=True)[0]
+
+	stale = add_to_date(now_datetime(), minutes=-STALE_PROCESSING_MINUTES)
+	if not (entry.status == "Pending" or (entry.status == "Processing" and entry.modified < stale)):
+		frappe.db.rollback()
+		return None
+
+	if docstatus != 1:
+		settle_entry(entry, "Cancelled")
+		frappe.db.commit()
+		return None
+
+	frappe.db.sql("""
+		UPDATE `tabMandi ERP Outbox`
+		SET status = 'Processing', modified = %(modified)s
+		WHERE name = %(name)s
+	""", {"name": name, "modified": now_datetime()})
+	frappe.db.commit()
+	return entry
+
+
+def settle_entry(entry, status, result=None):
+	result_doctype, result_name = result or (None, None)
+	frappe.db.sql("""
+		UPDATE `tabMandi ERP Outbox`
+		SET status = %(status)s, result_doctype = %(result_doctype)s, result_name = %(result_name)s,
+			next_attempt_at = NULL, modified = %(modified)s
+		WHERE name = %(name)s
+	""", {
+		"name": entry.name,
+		"status": status,
+		"result_doctype": result_doctype,
+		"result_name": result_name,
+		"modified": now_datetime(),
+	})
+
+
+def record_failure(entry, error):
+	"""Schedule the next attempt with exponential backoff, or give up after MAX_ATTEMPTS."""
+	attempts = (entry.attempts or 0) + 1
+	if attempts >= MAX_ATTEMPTS:
+		status, next_attempt_at = "Failed", None
+		frappe.log_error(
+			title="{0} for {1} {2} failed".format(entry.operation, entry.reference_doctype, entry.reference_name),
+			message=error)
+	else:
+		status = "Pending"
+		delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+		next_attempt_at = add_to_date(now_datetime(), seconds=delay)
+
+	frappe.db.sql("""
+		UPDATE `tabMandi ERP Outbox`
+		SET status = %(status)s, attempts = %(attempts)s, next_attempt_at = %(next_attempt_at)s,
+			last_error = %(error)s, modified = %(modified)s
+		WHERE name = %(name)s
+	""", {
+		"name": entry.name,
+		"status": status,
+		"attempts": attempts,
+		"next_attempt_at": next_attempt_at,
+		"error": error,
+		"modified": now_datetime(),
+	})
+
+
+@frappe.whitelist()
+def retry_outbox_entry(name):
+	"""Put a Failed entry back in the queue with a fresh set of attempts."""
+	frappe.only_for(("System Manager", "Accounts Manager"))
+	if frappe.db.get_value("Mandi ERP Outbox", name, "status") != "Failed":
+		frappe.throw("Only a failed outbox entry can be retried.")
+
+	frappe.db.set_value("Mandi ERP Outbox", name, {
+		"status": "Pending",
+		"attempts": 0,
+		"next_attempt_at": now_datetime(),
+	})
+	enqueue_outbox_worker()
+
+
+# ── Posting ──
+# Each handler returns (doctype, name) of the document posted, or None when
+# there is nothing left to post. A document that is already linked to its
+# source is returned as is, so posting is idempotent per source document.
+
+def post_stock_entry(entry):
+	doc = frappe.get_doc("Mandi Stock Entry", entry.reference_name)
+	name = doc.erp_stock_entry or doc.create_erp_stock_entry()
+	return name and ("Stock Entry", name)
+
+
+def post_dispatch_sales_invoice(entry):
+	doc = frappe.get_doc("Vehicle Dispatch", entry.reference_name)
+	name = doc.post_sales_invoice(entry.reference_key)
+	return name and ("Sales Invoice", name)
+
+
+def post_dispatch_payment_entry(entry):
+	doc = frappe.get_doc("Vehicle Dispatch", entry.reference_name)
+	name = doc.post_payment_entry(entry.reference_key)
+	return name and ("Payment Entry", name)
+
+
+def post_invoice_payment_entry(entry):
+	"""Payment row of a dispatch billed on a consolidated invoice (the entry's source)."""
+	dispatch = frappe.db.get_value("Vehicle Dispatch Customer Payment", entry.reference_key, "parent")
+	if not dispatch:
+		return None
+	name = frappe.get_doc("Vehicle Dispatch", dispatch).post_payment_entry(entry.reference_key)
+	return name and ("Payment Entry", name)
+
+
+POST_HANDLERS = {
+	("Stock Entry", "Mandi Stock Entry"): post_stock_entry,
+	("Sales Invoice", "Vehicle Dispatch"): post_dispatch_sales_invoice,
+	("Payment Entry", "Vehicle Dispatch"): post_dispatch_payment_entry,
+	("Payment Entry", "Sales Invoice"): post_invoice_payment_entry,
+}
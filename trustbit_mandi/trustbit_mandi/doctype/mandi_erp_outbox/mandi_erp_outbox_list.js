@@ -0,0 +1,13 @@
+frappe.listview_settings['Mandi ERP Outbox'] = {
+	add_fields: ['status'],
+	get_indicator: function(doc) {
+		const colors = {
+			'Pending': 'orange',
+			'Processing': 'yellow',
+			'Done': 'green',
+			'Failed': 'red',
+			'Cancelled': 'gray'
+		};
+		return [__(doc.status), colors[doc.status] || 'gray', 'status,=,' + doc.status];
+	}
+};
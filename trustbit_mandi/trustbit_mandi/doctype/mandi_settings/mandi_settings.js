@@ -0,0 +1,31 @@
+frappe.ui.form.on('Mandi Settings', {
+	refresh: function(frm) {
+		if (frm.doc.consolidate_invoices) {
+			frm.add_custom_button(__('Run Consolidated Invoicing'), function() {
+				frappe.call({
+					method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.consolidated_invoicing.run_consolidated_invoicing',
+					callback: function() {
+						frappe.show_alert({
+							message: __('Consolidated invoicing queued.'),
+							indicator: 'blue'
+						});
+					}
+				});
+			});
+		}
+
+		frm.add_custom_button(__('Rebuild Stock Closings'), function() {
+			frappe.confirm(__('Remove every stock closing and build them again in the background?'), function() {
+				frappe.call({
+					method: 'trustbit_mandi.trustbit_mandi.doctype.mandi_stock_closing.mandi_stock_closing.rebuild_stock_closings',
+					callback: function() {
+						frappe.show_alert({
+							message: __('Stock closings queued for rebuild.'),
+							indicator: 'blue'
+						});
+					}
+				});
+			});
+		});
+	}
+});
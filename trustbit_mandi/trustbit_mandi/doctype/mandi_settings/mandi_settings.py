@@ -0,0 +1,13 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MandiSettings(Document):
+	pass
+
+
+def get_mandi_settings():
+	return frappe.get_cached_doc("Mandi Settings")
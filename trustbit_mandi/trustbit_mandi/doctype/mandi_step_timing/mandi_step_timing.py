@@ -0,0 +1,13 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MandiStepTiming(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Mandi Step Timing", ["reference_doctype", "stage", "started_at"])
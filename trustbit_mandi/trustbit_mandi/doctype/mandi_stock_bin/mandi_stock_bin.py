@@ -0,0 +1,208 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint, flt, now
+
+INBOUND_ENTRY_TYPES = ("Opening Stock", "Receipt", "Adjustment (Increase)")
+
+# Bins within this many packs / KG of the entries count as matching
+VERIFY_TOLERANCE = 0.001
+
+
+class MandiStockBin(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique(
+		"Mandi Stock Bin", ["warehouse", "item", "pack_size"], constraint_name="warehouse_item_pack_size")
+
+
+def apply_stock_entry(entry, sign):
+	"""Move the bins of a Mandi Stock Entry's rows: sign=1 on submit, -1 on cancel.
+
+	All deltas go in one INSERT ... ON DUPLICATE KEY UPDATE, so a bin is
+	created on its first entry. Rows are written in key order, so concurrent
+	entries on the same bins queue up instead of deadlocking.
+	"""
+	direction = sign if entry.entry_type in INBOUND_ENTRY_TYPES else -sign
+	deltas = {}
+	for row in entry.items:
+		delta = deltas.setdefault((row.item, row.pack_size), frappe._dict(
+			item_name=row.item_name, pack_weight_kg=flt(row.pack_weight_kg), qty=0, kg=0))
+		delta.qty += flt(row.qty)
+		delta.kg += flt(row.kg)
+	if not deltas:
+		return
+
+	timestamp = now()
+	user = frappe.session.user
+	placeholders = []
+	values = []
+	for item, pack_size in sorted(deltas):
+		delta = deltas[(item, pack_size)]
+		placeholders.append("(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+		values.extend([
+			frappe.generate_hash(length=10), entry.warehouse or "", item, delta.item_name, pack_size,
+			delta.pack_weight_kg, direction * delta.qty, direction * delta.kg,
+			timestamp, timestamp, user, user,
+		])
+
+	frappe.db.sql("""
+		INSERT INTO `tabMandi Stock Bin`
+			(name, warehouse, item, item_name, pack_size, pack_weight_kg, balance_qty, balance_kg,
+			 creation, modified, owner, modified_by)
+		VALUES {placeholders}
+		ON DUPLICATE KEY UPDATE
+			balance_qty = balance_qty + VALUES(balance_qty),
+			balance_kg = balance_kg + VALUES(balance_kg),
+			item_name = IF(IFNULL(item_name, '') = '', VALUES(item_name), item_name),
+			pack_weight_kg = GREATEST(IFNULL(pack_weight_kg, 0), IFNULL(VALUES(pack_weight_kg), 0)),
+			modified = VALUES(modified),
+			modified_by = VALUES(modified_by)
+	""".format(placeholders=", ".join(placeholders)), values)
+
+
+def get_bin_balance(item, pack_size, warehouse=None):
+	"""Current balance in packs of one item + pack size, across warehouses unless one is given."""
+	conditions = ["item = %(item)s", "pack_size = %(pack_size)s"]
+	values = {"item": item, "pack_size": pack_size}
+	if warehouse:
+		conditions.append("warehouse = %(warehouse)s")
+		values["warehouse"] = warehouse
+
+	result = frappe.db.sql("""
+		SELECT COALESCE(SUM(balance_qty), 0)
+		FROM `tabMandi Stock Bin`
+		WHERE {conditions}
+	""".format(conditions=" AND ".join(conditions)), values)
+	return flt(result[0][0]) if result else 0
+
+
+def get_bin_balances(keys, for_update=False):
+	"""Current balance in packs per (item, pack_size) in `keys`, across warehouses, in one read.
+
+	With `for_update` the bins are locked until the transaction ends.
+	"""
+	keys = sorted(set(keys))
+	if not keys:
+		return {}
+
+	balances = dict.fromkeys(keys, 0)
+	for item, pack_size, balance_qty in frappe.db.sql("""
+		SELECT item, pack_size, balance_qty
+		FROM `tabMandi Stock Bin`
+		WHERE (item, pack_size) IN ({placeholders})
+		ORDER BY warehouse, item, pack_size
+		{lock}
+	""".format(
+		placeholders=", ".join(["(%s, %s)"] * len(keys)),
+		lock="FOR UPDATE" if for_update else "",
+	), [value for key in keys for value in key]):
+		balances[(item, pack_size)] += flt(balance_qty)
+	return balances
+
+
+def get_bin_stock(item=None, pack_size=None):
+	"""Current balance per item + pack size across warehouses, shaped like get_current_stock."""
+	conditions = ["1 = 1"]
+	values = {}
+	if item:
+		conditions.append("item = %(item)s")
+		values["item"] = item
+	if pack_size:
+		conditions.append("pack_size = %(pack_size)s")
+		values["pack_size"] = pack_size
+
+	return frappe.db.sql("""
+		SELECT
+			item,
+			MAX(item_name) as item_name,
+			pack_size,
+			MAX(pack_weight_kg) as pack_weight_kg,
+			SUM(balance_qty) as balance_qty,
+			SUM(balance_kg) as balance_kg
+		FROM `tabMandi Stock Bin`
+		WHERE {conditions}
+		GROUP BY item, pack_size
+		ORDER BY item ASC, MAX(pack_weight_kg) ASC
+	""".format(conditions=" AND ".join(conditions)), values, as_dict=True)
+
+
+def get_stock_from_entries():
+	"""What every bin should hold, summed from the submitted Mandi Stock Entries."""
+	return frappe.db.sql("""
+		SELECT
+			IFNULL(mse.warehouse, '') as warehouse,
+			msei.item,
+			MAX(msei.item_name) as item_name,
+			msei.pack_size,
+			MAX(msei.pack_weight_kg) as pack_weight_kg,
+			SUM(CASE WHEN mse.entry_type IN %(inbound)s THEN msei.qty ELSE -msei.qty END) as balance_qty,
+			SUM(CASE WHEN mse.entry_type IN %(inbound)s THEN msei.kg ELSE -msei.kg END) as balance_kg
+		FROM `tabMandi Stock Entry Item` msei
+		INNER JOIN `tabMandi Stock Entry` mse ON mse.name = msei.parent
+		WHERE mse.docstatus = 1
+		GROUP BY IFNULL(mse.warehouse, ''), msei.item, msei.pack_size
+	""", {"inbound": INBOUND_ENTRY_TYPES}, as_dict=True)
+
+
+@frappe.whitelist()
+def rebuild_stock_bins(verify_only=False):
+	"""Recompute the bins from submitted Mandi Stock Entries; returns the bins that were off.
+
+	With `verify_only` the bins are only compared, not rewritten. Run after
+	editing stock entry rows directly in the database, e.g.
+	bench --site <site> execute trustbit_mandi.trustbit_mandi.doctype.mandi_stock_bin.mandi_stock_bin.rebuild_stock_bins --kwargs "{'verify_only': 1}"
+	"""
+	frappe.only_for("System Manager")
+	verify_only = cint(verify_only)
+
+	# When rewriting, lock every bin (and the gaps between them) first: entries
+	# submitted meanwhile wait, then apply their deltas to the rebuilt bins.
+	current = {
+		(row.warehouse or "", row.item, row.pack_size): row
+		for row in frappe.db.sql("""
+			SELECT warehouse, item, pack_size, balance_qty, balance_kg
+			FROM `tabMandi Stock Bin`
+			{lock}
+		""".format(lock="" if verify_only else "FOR UPDATE"), as_dict=True)
+	}
+	expected = {(row.warehouse, row.item, row.pack_size): row for row in get_stock_from_entries()}
+
+	mismatches = []
+	for key in sorted(set(current) | set(expected), key=lambda key: tuple(part or "" for part in key)):
+		found = current.get(key) or frappe._dict()
+		should = expected.get(key) or frappe._dict()
+		if (abs(flt(found.balance_qty) - flt(should.balance_qty)) > VERIFY_TOLERANCE
+				or abs(flt(found.balance_kg) - flt(should.balance_kg)) > VERIFY_TOLERANCE):
+			mismatches.append({
+				"warehouse": key[0],
+				"item": key[1],
+				"pack_size": key[2],
+				"bin_qty": flt(found.balance_qty),
+				"expected_qty": flt(should.balance_qty),
+				"bin_kg": flt(found.balance_kg),
+				"expected_kg": flt(should.balance_kg),
+			})
+
+	if verify_only:
+		return mismatches
+
+	timestamp = now()
+	user = frappe.session.user
+	frappe.db.delete("Mandi Stock Bin")
+	frappe.db.bulk_insert(
+		"Mandi Stock Bin",
+		["name", "warehouse", "item", "item_name", "pack_size", "pack_weight_kg",
+		 "balance_qty", "balance_kg", "creation", "modified", "owner", "modified_by"],
+		[
+			(frappe.generate_hash(length=10), row.warehouse, row.item, row.item_name, row.pack_size,
+			 flt(row.pack_weight_kg), flt(row.balance_qty), flt(row.balance_kg),
+			 timestamp, timestamp, user, user)
+			for row in expected.values()
+		],
+	)
+	return mismatches
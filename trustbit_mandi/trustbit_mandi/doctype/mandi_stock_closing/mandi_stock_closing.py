@@ -0,0 +1,218 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""Closing stock snapshots for date-ranged stock reads.
+
+create_stock_closings, run daily by the scheduler, records the stock per
+item + pack size at the end of every ended period (week or month, per
+Mandi Settings). Each closing is the previous closing plus that period's
+entries, so a run only reads the periods it builds.
+
+A balance as of any date (get_stock_as_of) is then the latest closing on
+or before it plus the entries since: a scan bounded by one period rather
+than by the whole history.
+
+Submitting or cancelling a Mandi Stock Entry removes the closings on or
+after its posting date (invalidate_stock_closings); the next run builds
+them again.
+"""
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, flt, get_first_day, get_first_day_of_week, getdate, now, nowdate
+
+from trustbit_mandi.trustbit_mandi.doctype.mandi_settings.mandi_settings import get_mandi_settings
+from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_bin.mandi_stock_bin import INBOUND_ENTRY_TYPES
+
+
+class MandiStockClosing(Document):
+	pass
+
+
+def get_period_start(date, period):
+	date = getdate(date)
+	if period == "Weekly":
+		return getdate(get_first_day_of_week(date))
+	return getdate(get_first_day(date))
+
+
+def get_period_end(date, period):
+	date = getdate(date)
+	if period == "Weekly":
+		return add_days(get_period_start(date, period), 6)
+	return add_days(get_first_day(date, d_months=1), -1)
+
+
+def get_latest_closing(date, before=False):
+	"""Latest closing on (or, with `before`, strictly before) `date`."""
+	closings = frappe.db.sql("""
+		SELECT name, period_end
+		FROM `tabMandi Stock Closing`
+		WHERE period_end {operator} %s
+		ORDER BY period_end DESC
+		LIMIT 1
+	""".format(operator="<" if before else "<="), getdate(date), as_dict=True)
+	return closings[0] if closings else None
+
+
+def get_stock_as_of(upto_date, item=None, pack_size=None):
+	"""Stock per (item, pack_size) at the end of `upto_date`, from the latest closing plus the entries since."""
+	return sum_stock(get_latest_closing(upto_date), upto_date, item, pack_size)
+
+
+def sum_stock(closing, upto_date, item=None, pack_size=None):
+	"""Add the entries after `closing` (all entries when None) up to `upto_date` to its closing stock."""
+	item_conditions = ""
+	values = {"upto_date": getdate(upto_date), "inbound": INBOUND_ENTRY_TYPES}
+	if item:
+		item_conditions += " AND {alias}.item = %(item)s"
+		values["item"] = item
+	if pack_size:
+		item_conditions += " AND {alias}.pack_size = %(pack_size)s"
+		values["pack_size"] = pack_size
+
+	stock = {}
+
+	def add(row):
+		balance = stock.setdefault((row.item, row.pack_size), frappe._dict(
+			item=row.item, item_name=row.item_name, pack_size=row.pack_size,
+			pack_weight_kg=flt(row.pack_weight_kg), qty=0, kg=0))
+		balance.item_name = balance.item_name or row.item_name
+		balance.pack_weight_kg = max(balance.pack_weight_kg, flt(row.pack_weight_kg))
+		balance.qty += flt(row.qty)
+		balance.kg += flt(row.kg)
+
+	date_condition = ""
+	if closing:
+		values["closing"] = closing.name
+		values["closing_date"] = closing.period_end
+		date_condition = " AND mse.posting_date > %(closing_date)s"
+		for row in frappe.db.sql("""
+			SELECT item, item_name, pack_size, pack_weight_kg, closing_qty as qty, closing_kg as kg
+			FROM `tabMandi Stock Closing Item` ci
+			WHERE ci.parent = %(closing)s AND ci.parenttype = 'Mandi Stock Closing' {item_conditions}
+		""".format(item_conditions=item_conditions.format(alias="ci")), values, as_dict=True):
+			add(row)
+
+	for row in frappe.db.sql("""
+		SELECT
+			msei.item,
+			MAX(msei.item_name) as item_name,
+			msei.pack_size,
+			MAX(msei.pack_weight_kg) as pack_weight_kg,
+			SUM(CASE WHEN mse.entry_type IN %(inbound)s THEN msei.qty ELSE -msei.qty END) as qty,
+			SUM(CASE WHEN mse.entry_type IN %(inbound)s THEN msei.kg ELSE -msei.kg END) as kg
+		FROM `tabMandi Stock Entry Item` msei
+		INNER JOIN `tabMandi Stock Entry` mse ON mse.name = msei.parent
+		WHERE mse.docstatus = 1 AND mse.posting_date <= %(upto_date)s {date_condition} {item_conditions}
+		GROUP BY msei.item, msei.pack_size
+	""".format(date_condition=date_condition, item_conditions=item_conditions.format(alias="msei")),
+			values, as_dict=True):
+		add(row)
+
+	return stock
+
+
+def invalidate_stock_closings(posting_date):
+	"""Remove the closings that a Mandi Stock Entry posted on `posting_date` changes.
+
+	The closings from `posting_date` on are read with a locking read even
+	when there are none, which also locks the range a closing for a later
+	period end would be inserted in. A closing being built meanwhile is
+	either removed here once its run commits, or waits for this entry to
+	commit and then counts it.
+	"""
+	names = frappe.db.sql_list("""
+		SELECT name FROM `tabMandi Stock Closing`
+		WHERE period_end >= %s
+		ORDER BY period_end
+		FOR UPDATE
+	""", getdate(posting_date))
+	if names:
+		frappe.db.delete("Mandi Stock Closing Item", {"parent": ("in", names), "parenttype": "Mandi Stock Closing"})
+		frappe.db.delete("Mandi Stock Closing", {"name": ("in", names)})
+
+
+def create_stock_closings():
+	"""Scheduled job: build the closing of every ended period that has none yet, oldest first."""
+	period = get_mandi_settings().stock_closing_period or "Monthly"
+	last_period_end = add_days(get_period_start(nowdate(), period), -1)
+	first_posting_date = frappe.db.sql("""
+		SELECT MIN(posting_date) FROM `tabMandi Stock Entry` WHERE docstatus = 1
+	""")[0][0]
+	if not first_posting_date or getdate(first_posting_date) > last_period_end:
+		return
+
+	built = {getdate(date) for date in frappe.db.sql_list("""
+		SELECT period_end FROM `tabMandi Stock Closing` WHERE period_end >= %s
+	""", getdate(first_posting_date))}
+	# Each closing is built in a transaction that its own insert opens
+	frappe.db.commit()
+
+	period_end = get_period_end(first_posting_date, period)
+	while period_end <= last_period_end:
+		if period_end not in built:
+			try:
+				build_stock_closing(period_end, period)
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				frappe.log_error(title="Mandi Stock Closing failed for {0}".format(period_end))
+				break
+		period_end = get_period_end(add_days(period_end, 1), period)
+
+
+def build_stock_closing(period_end, period):
+	"""Record the closing stock at `period_end`: the latest earlier closing plus the entries since.
+
+	Call in a fresh transaction. The closing row is inserted before anything
+	is read, so a back-dated entry's invalidate_stock_closings either waits
+	for it or has already committed by the time the entries are summed.
+	"""
+	timestamp = now()
+	user = frappe.session.user
+	name = frappe.generate_hash(length=10)
+	try:
+		frappe.db.sql("""
+			INSERT INTO `tabMandi Stock Closing`
+				(name, period_end, period, docstatus, creation, modified, owner, modified_by)
+			VALUES (%s, %s, %s, 0, %s, %s, %s, %s)
+		""", (name, period_end, period, timestamp, timestamp, user, user))
+	except Exception as e:
+		if frappe.db.is_duplicate_entry(e):
+			# Built by another run in the meantime
+			frappe.db.rollback()
+			return None
+		raise
+
+	base = get_latest_closing(period_end, before=True)
+	stock = sum_stock(base, period_end)
+	if base:
+		frappe.db.set_value("Mandi Stock Closing", name, "base_closing", base.name, update_modified=False)
+
+	frappe.db.bulk_insert(
+		"Mandi Stock Closing Item",
+		["name", "parent", "parenttype", "parentfield", "idx", "item", "item_name", "pack_size",
+		 "pack_weight_kg", "closing_qty", "closing_kg", "creation", "modified", "owner", "modified_by"],
+		[
+			(frappe.generate_hash(length=10), name, "Mandi Stock Closing", "items", idx, row.item, row.item_name,
+			 row.pack_size, row.pack_weight_kg, row.qty, row.kg, timestamp, timestamp, user, user)
+			for idx, row in enumerate((stock[key] for key in sorted(stock)), 1)
+		],
+	)
+	return name
+
+
+@frappe.whitelist()
+def rebuild_stock_closings():
+	"""Drop every closing and queue a run that builds them again, e.g. after changing the period."""
+	frappe.only_for(("System Manager", "Stock Manager"))
+	invalidate_stock_closings("1900-01-01")
+	frappe.enqueue(
+		"trustbit_mandi.trustbit_mandi.doctype.mandi_stock_closing.mandi_stock_closing.create_stock_closings",
+		queue="long",
+		timeout=3600,
+		job_id="mandi_stock_closings",
+		deduplicate=True,
+		enqueue_after_commit=True,
+	)
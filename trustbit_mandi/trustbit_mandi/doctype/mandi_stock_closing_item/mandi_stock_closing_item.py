@@ -0,0 +1,8 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+
+class MandiStockClosingItem(Document):
+	pass
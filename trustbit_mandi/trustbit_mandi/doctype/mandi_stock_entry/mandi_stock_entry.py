@@ -1,8 +1,27 @@
 import frappe
+from frappe import _
 from frappe.model.document import Document
 from frappe.utils import flt
-from frappe import _
-
+from frappe.utils.caching import request_cache
+
+from trustbit_mandi.tracing import trace_step
+from trustbit_mandi.trustbit_mandi.doctype.mandi_erp_outbox.mandi_erp_outbox import (
+	cancel_erp_documents,
+	queue_erp_documents,
+)
+from trustbit_mandi.trustbit_mandi.doctype.mandi_settings.mandi_settings import get_mandi_settings
+from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_bin.mandi_stock_bin import (
+	INBOUND_ENTRY_TYPES,
+	apply_stock_entry,
+	get_bin_balance,
+	get_bin_balances,
+	get_bin_stock,
+)
+from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_closing.mandi_stock_closing import (
+	get_stock_as_of,
+	invalidate_stock_closings,
+)
+from trustbit_mandi.utils import get_active_erp_context
 
 # Maps Mandi entry types to ERPNext Stock Entry purpose and warehouse direction
 ENTRY_TYPE_MAP = {
@@ -13,6 +32,16 @@ ENTRY_TYPE_MAP = {
 	"Adjustment (Decrease)": {"purpose": "Material Issue", "wh_field": "s_warehouse"},
 }
 
+# Mandi Settings checkbox that turns the negative stock warning into an error, per entry type
+NEGATIVE_STOCK_BLOCK_FIELDS = {
+	"Issue": "block_negative_issue",
+	"Adjustment (Decrease)": "block_negative_adjustment",
+}
+
+
+class NegativeStockError(frappe.ValidationError):
+	pass
+
 
 class MandiStockEntry(Document):
 	def before_save(self):
@@ -53,121 +82,158 @@ class MandiStockEntry(Document):
 		self.total_kg = sum(flt(row.kg) for row in self.items)
 		self.total_items = len(self.items)
 
+	def before_submit(self):
+		with trace_step(self.doctype, self.name, "Negative Stock Check"):
+			self.check_negative_stock()
+
 	def on_submit(self):
 		self.db_set("status", "Submitted")
-		self.check_negative_stock()
-		self.create_erp_stock_entry()
+		with trace_step(self.doctype, self.name, "Stock Bins"):
+			apply_stock_entry(self, 1)
+		with trace_step(self.doctype, self.name, "Stock Closings"):
+			invalidate_stock_closings(self.posting_date)
+		with trace_step(self.doctype, self.name, "ERPNext Stock Entry"):
+			self.queue_erp_stock_entry()
 
 	def on_cancel(self):
 		self.db_set("status", "Cancelled")
+		apply_stock_entry(self, -1)
+		invalidate_stock_closings(self.posting_date)
 		self.cancel_erp_stock_entry()
 
+	def queue_erp_stock_entry(self):
+		"""Have the ERP outbox post the ERPNext Stock Entry once this submit commits."""
+		if self.entry_type in ENTRY_TYPE_MAP:
+			queue_erp_documents(self.doctype, self.name, [("Stock Entry", None)])
+
 	def check_negative_stock(self):
-		if self.entry_type not in ("Issue", "Adjustment (Decrease)"):
+		"""Warn about, or with the entry type's block on in Mandi Settings refuse, stock going negative.
+
+		Runs before the bins are moved: the balances after this entry are the
+		bins of all its rows, read at once, less the rows' qty. A blocking
+		check locks those bins, so two entries cannot both pass on the same stock.
+		"""
+		if self.entry_type in INBOUND_ENTRY_TYPES:
 			return
+		block_field = NEGATIVE_STOCK_BLOCK_FIELDS.get(self.entry_type)
+		block = bool(block_field and get_mandi_settings().get(block_field))
+
+		qty = {}
 		for row in self.items:
-			balance = get_stock_balance(row.item, row.pack_size)
+			qty[(row.item, row.pack_size)] = qty.get((row.item, row.pack_size), 0) + flt(row.qty)
+		balances = get_bin_balances(qty, for_update=block)
+
+		negative = []
+		for key in sorted(qty):
+			balance = flt(balances.get(key)) - qty[key]
 			if balance < 0:
-				frappe.msgprint(
-					_("Warning: {0} ({1}) stock balance is {2} packs (negative).").format(
-						row.item, row.pack_size, balance
+				negative.append((key[0], key[1], balance))
+		if not negative:
+			return
+
+		if block:
+			frappe.throw(
+				_("Not enough stock for {0}:<br>{1}").format(
+					self.entry_type,
+					"<br>".join(
+						_("{0} ({1}) would go to {2} packs.").format(item, pack_size, balance)
+						for item, pack_size, balance in negative
 					),
-					indicator="orange",
-					alert=True,
-				)
+				),
+				NegativeStockError,
+				title=_("Negative Stock"),
+			)
+
+		for item, pack_size, balance in negative:
+			frappe.msgprint(
+				_("Warning: {0} ({1}) stock balance is {2} packs (negative).").format(item, pack_size, balance),
+				indicator="orange",
+				alert=True,
+			)
 
 	def create_erp_stock_entry(self):
-		"""Create a corresponding ERPNext Stock Entry on submit."""
+		"""Create the corresponding ERPNext Stock Entry; run by the ERP outbox worker.
+
+		Errors propagate, so the outbox retries the entry.
+		"""
 		mapping = ENTRY_TYPE_MAP.get(self.entry_type)
 		if not mapping:
-			return
-
-		try:
-			company = self.company or frappe.db.get_value("Warehouse", self.warehouse, "company")
-			if not company:
-				frappe.msgprint(
-					_("Warning: No company found for warehouse {0}. ERPNext Stock Entry not created.").format(
-						self.warehouse
-					),
-					indicator="orange",
-					alert=True,
-				)
-				return
-
-			se = frappe.new_doc("Stock Entry")
-			se.set_posting_time = 1
-			se.posting_date = self.posting_date
-			se.purpose = mapping["purpose"]
-			se.company = company
-			se.remarks = "Auto-created from Mandi Stock Entry {0}".format(self.name)
-
-			# Aggregate items by item_code, converting packs to KG
-			item_kg_map = {}
-			for row in self.items:
-				if row.item not in item_kg_map:
-					item_kg_map[row.item] = 0
-				item_kg_map[row.item] += flt(row.qty) * flt(row.pack_weight_kg)
+			return None
 
+		erp = get_active_erp_context()
+		company = self.company or (
+			erp.get_warehouse_company(self.warehouse) if erp
+			else frappe.db.get_value("Warehouse", self.warehouse, "company")
+		)
+		if not company:
+			frappe.throw(_("No company found for warehouse {0}.").format(self.warehouse))
+
+		se = frappe.new_doc("Stock Entry")
+		se.set_posting_time = 1
+		se.posting_date = self.posting_date
+		se.purpose = mapping["purpose"]
+		se.company = company
+		se.remarks = "Auto-created from Mandi Stock Entry {0}".format(self.name)
+
+		# Aggregate items by item_code, converting packs to KG
+		item_kg_map = {}
+		for row in self.items:
+			if row.item not in item_kg_map:
+				item_kg_map[row.item] = 0
+			item_kg_map[row.item] += flt(row.qty) * flt(row.pack_weight_kg)
+
+		if erp and company == erp.company:
+			cost_center = erp.cost_center
+			expense_account = erp.stock_adjustment_account
+		else:
 			cost_center = frappe.get_cached_value("Company", company, "cost_center")
 			expense_account = frappe.get_cached_value("Company", company, "stock_adjustment_account")
 
-			# Determine the UOM name (ERPNext may have "Kg" or "KG")
-			uom_name = get_kg_uom()
-
-			for item_code, total_kg in item_kg_map.items():
-				item_row = {
-					"item_code": item_code,
-					"qty": flt(total_kg, 3),
-					"uom": uom_name,
-					"stock_uom": uom_name,
-					"conversion_factor": 1.0,
-					"transfer_qty": flt(total_kg, 3),
-					"allow_zero_valuation_rate": 1,
-					"basic_rate": 0,
-				}
-				if cost_center:
-					item_row["cost_center"] = cost_center
-				if expense_account:
-					item_row["expense_account"] = expense_account
-
-				item_row[mapping["wh_field"]] = self.warehouse
-				se.append("items", item_row)
-
-			se.set_stock_entry_type()
-			se.insert(ignore_permissions=True)
-			se.submit()
-
-			self.db_set("erp_stock_entry", se.name)
+		# Determine the UOM name (ERPNext may have "Kg" or "KG")
+		uom_name = erp.kg_uom if erp else get_kg_uom()
+
+		for item_code, total_kg in item_kg_map.items():
+			item_row = {
+				"item_code": item_code,
+				"qty": flt(total_kg, 3),
+				"uom": uom_name,
+				"stock_uom": uom_name,
+				"conversion_factor": 1.0,
+				"transfer_qty": flt(total_kg, 3),
+				"allow_zero_valuation_rate": 1,
+				"basic_rate": 0,
+			}
+			if cost_center:
+				item_row["cost_center"] = cost_center
+			if expense_account:
+				item_row["expense_account"] = expense_account
 
-			frappe.msgprint(
-				_("ERPNext Stock Entry {0} created.").format(
-					'<a href="/app/stock-entry/{0}">{0}</a>'.format(se.name)
-				),
-				indicator="green",
-				alert=True,
-			)
-		except Exception as e:
-			frappe.log_error(
-				title="ERPNext Stock Entry creation failed for {0}".format(self.name),
-				message=frappe.get_traceback(),
-			)
-			frappe.msgprint(
-				_("Warning: Could not create ERPNext Stock Entry. Error: {0}").format(str(e)),
-				indicator="orange",
-				alert=True,
-			)
+			item_row[mapping["wh_field"]] = self.warehouse
+			se.append("items", item_row)
+
+		se.set_stock_entry_type()
+		se.insert(ignore_permissions=True)
+		se.submit()
+
+		self.db_set("erp_stock_entry", se.name)
+		return se.name
 
 	def cancel_erp_stock_entry(self):
-		"""Cancel the linked ERPNext Stock Entry when this entry is cancelled."""
-		if not self.erp_stock_entry:
+		"""Cancel the linked ERPNext Stock Entry when this entry is cancelled.
+
+		An entry still waiting in the ERP outbox is dropped instead.
+		"""
+		posted = cancel_erp_documents(self.doctype, self.name).get("Stock Entry") or []
+		erp_stock_entry = self.erp_stock_entry or (posted[0] if posted else None)
+		if not erp_stock_entry:
 			return
 
 		try:
-			se = frappe.get_doc("Stock Entry", self.erp_stock_entry)
+			se = frappe.get_doc("Stock Entry", erp_stock_entry)
 			if se.docstatus == 1:
 				se.cancel()
 				frappe.msgprint(
-					_("ERPNext Stock Entry {0} cancelled.").format(self.erp_stock_entry),
+					_("ERPNext Stock Entry {0} cancelled.").format(erp_stock_entry),
 					indicator="orange",
 					alert=True,
 				)
@@ -178,13 +244,14 @@ class MandiStockEntry(Document):
 			)
 			frappe.msgprint(
 				_("Warning: Could not cancel ERPNext Stock Entry {0}. Error: {1}").format(
-					self.erp_stock_entry, str(e)
+					erp_stock_entry, str(e)
 				),
 				indicator="orange",
 				alert=True,
 			)
 
 
+@request_cache
 def get_kg_uom():
 	"""Get the correct UOM name for KG (ERPNext may have 'Kg' or 'KG')."""
 	if frappe.db.exists("UOM", "Kg"):
@@ -195,80 +262,25 @@ def get_kg_uom():
 
 
 def get_stock_balance(item, pack_size, posting_date=None):
-	conditions = ["mse.docstatus = 1", "msei.item = %s", "msei.pack_size = %s"]
-	values = [item, pack_size]
+	"""Balance in packs; the current one is read from the Mandi Stock Bins.
 
-	if posting_date:
-		conditions.append("mse.posting_date <= %s")
-		values.append(posting_date)
+	A balance as of `posting_date` starts from the latest Mandi Stock Closing
+	on or before that date.
+	"""
+	if not posting_date:
+		return get_bin_balance(item, pack_size)
 
-	result = frappe.db.sql(
-		"""
-		SELECT COALESCE(SUM(
-			CASE
-				WHEN mse.entry_type IN ('Opening Stock', 'Receipt', 'Adjustment (Increase)')
-				THEN msei.qty
-				ELSE -msei.qty
-			END
-		), 0) as balance
-		FROM `tabMandi Stock Entry Item` msei
-		INNER JOIN `tabMandi Stock Entry` mse ON mse.name = msei.parent
-		WHERE {conditions}
-	""".format(
-			conditions=" AND ".join(conditions)
-		),
-		values,
-	)
-
-	return flt(result[0][0]) if result else 0
+	balance = get_stock_as_of(posting_date, item, pack_size).get((item, pack_size))
+	return flt(balance.qty) if balance else 0
 
 
 @frappe.whitelist()
 def get_current_stock(item=None, pack_size=None):
-	conditions = ["mse.docstatus = 1"]
-	values = []
-
-	if item:
-		conditions.append("msei.item = %s")
-		values.append(item)
-	if pack_size:
-		conditions.append("msei.pack_size = %s")
-		values.append(pack_size)
-
-	return frappe.db.sql(
-		"""
-		SELECT
-			msei.item,
-			MAX(msei.item_name) as item_name,
-			msei.pack_size,
-			MAX(msei.pack_weight_kg) as pack_weight_kg,
-			SUM(
-				CASE
-					WHEN mse.entry_type IN ('Opening Stock', 'Receipt', 'Adjustment (Increase)')
-					THEN msei.qty
-					ELSE -msei.qty
-				END
-			) as balance_qty,
-			SUM(
-				CASE
-					WHEN mse.entry_type IN ('Opening Stock', 'Receipt', 'Adjustment (Increase)')
-					THEN msei.kg
-					ELSE -msei.kg
-				END
-			) as balance_kg
-		FROM `tabMandi Stock Entry Item` msei
-		INNER JOIN `tabMandi Stock Entry` mse ON mse.name = msei.parent
-		WHERE {conditions}
-		GROUP BY msei.item, msei.pack_size
-		ORDER BY msei.item ASC, MAX(msei.pack_weight_kg) ASC
-	""".format(
-			conditions=" AND ".join(conditions)
-		),
-		values,
-		as_dict=True,
-	)
+	"""Current balance per item + pack size, read from the Mandi Stock Bins."""
+	return get_bin_stock(item, pack_size)
 
 
+@request_cache
 def get_default_warehouse():
 	"""Get the default warehouse for Mandi operations."""
 	from trustbit_mandi.utils import get_mandi_company
@@ -306,7 +318,8 @@ def create_stock_entry_from_delivery(deal_delivery_name):
 	mse = frappe.new_doc("Mandi Stock Entry")
 	mse.posting_date = dd.delivery_date
 	mse.entry_type = "Issue"
-	mse.warehouse = get_default_warehouse()
+	erp = get_active_erp_context()
+	mse.warehouse = erp.default_warehouse if erp else get_default_warehouse()
 	mse.deal_delivery = deal_delivery_name
 	mse.remarks = "Auto-created from Deal Delivery {0}".format(deal_delivery_name)
 
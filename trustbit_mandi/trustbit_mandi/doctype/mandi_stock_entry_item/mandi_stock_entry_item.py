@@ -4,3 +4,7 @@ from frappe.model.document import Document
 
 class MandiStockEntryItem(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Mandi Stock Entry Item", ["item", "pack_size"])
@@ -0,0 +1,192 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""Consolidated Sales Invoices for Vehicle Dispatches.
+
+With Consolidate Sales Invoices on in Mandi Settings, a submitted Vehicle
+Dispatch only records its Deal Deliveries. create_consolidated_invoices,
+run daily by the scheduler, then bills every customer once per ended period
+(day, week or month) for all their dispatched load items, links the invoice
+back to the load rows and customer payment rows, and queues the customer
+payments against it in the ERP outbox.
+
+Cancelling a consolidated invoice releases its rows, so the next run bills
+them again.
+"""
+
+import frappe
+from frappe.utils import flt, get_first_day, get_first_day_of_week, getdate, nowdate
+
+from trustbit_mandi.trustbit_mandi.doctype.mandi_erp_outbox.mandi_erp_outbox import (
+	cancel_erp_documents,
+	queue_erp_documents,
+)
+from trustbit_mandi.trustbit_mandi.doctype.mandi_settings.mandi_settings import get_mandi_settings
+from trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch import make_sales_invoice
+from trustbit_mandi.utils import mandi_erp_context
+
+
+def get_period_start(date, period):
+	date = getdate(date)
+	if period == "Weekly":
+		return getdate(get_first_day_of_week(date))
+	if period == "Monthly":
+		return getdate(get_first_day(date))
+	return date
+
+
+def get_uninvoiced_load_items(upto_date):
+	"""Load rows of deferred, dispatched Vehicle Dispatches dated before `upto_date` with no invoice yet."""
+	return frappe.db.sql("""
+		SELECT
+			li.name, li.parent, li.customer, li.item, li.pack_size,
+			li.pack_weight_kg, li.rate, li.qty, li.amount, vd.dispatch_date
+		FROM `tabVehicle Dispatch Load Item` li
+		INNER JOIN `tabVehicle Dispatch` vd ON vd.name = li.parent
+		WHERE li.parenttype = 'Vehicle Dispatch'
+			AND (li.sales_invoice IS NULL OR li.sales_invoice = '')
+			AND li.returned = 0
+			AND IFNULL(li.customer, '') != ''
+			AND vd.docstatus = 1
+			AND vd.defer_invoicing = 1
+			AND vd.status = 'Dispatched'
+			AND vd.dispatch_date < %(upto_date)s
+		ORDER BY li.customer, vd.dispatch_date, li.parent, li.idx
+	""", {"upto_date": upto_date}, as_dict=True)
+
+
+def get_invoice_lines(rows):
+	"""Merge load rows selling the same item, pack and rate into one invoice line."""
+	lines = {}
+	for row in rows:
+		key = (row.item, row.pack_size, flt(row.pack_weight_kg), flt(row.rate))
+		line = lines.setdefault(key, frappe._dict(
+			item=row.item, pack_size=row.pack_size, pack_weight_kg=flt(row.pack_weight_kg),
+			qty=0, amount=0))
+		line.qty += flt(row.qty)
+		line.amount += flt(row.amount)
+	return list(lines.values())
+
+
+def create_consolidated_invoices(upto_date=None):
+	"""Scheduled job: invoice every ended period's deferred load items, one invoice per customer.
+
+	Each invoice is committed on its own, so a failure for one customer is
+	logged and retried by the next run without holding back the others.
+	"""
+	period = get_mandi_settings().consolidation_period or "Daily"
+	upto_date = getdate(upto_date) if upto_date else get_period_start(nowdate(), period)
+
+	groups = {}
+	for row in get_uninvoiced_load_items(upto_date):
+		key = (row.customer, get_period_start(row.dispatch_date, period))
+		groups.setdefault(key, []).append(row)
+
+	if groups:
+		with mandi_erp_context(customer for customer, _start in groups):
+			for (customer, _start), rows in groups.items():
+				try:
+					invoice_load_items(customer, rows)
+					frappe.db.commit()
+				except Exception:
+					frappe.db.rollback()
+					frappe.log_error(title="Consolidated Sales Invoice failed for {0}".format(customer))
+
+
+def invoice_load_items(customer, rows):
+	"""Create one Sales Invoice for `rows` of `customer` and link it back to the dispatches."""
+	# Lock the rows and drop any another run has billed in the meantime
+	unbilled = set(frappe.db.sql_list("""
+		SELECT name FROM `tabVehicle Dispatch Load Item`
+		WHERE name IN %(names)s AND (sales_invoice IS NULL OR sales_invoice = '')
+		ORDER BY name
+		FOR UPDATE
+	""", {"names": tuple(row.name for row in rows)}))
+	rows = [row for row in rows if row.name in unbilled]
+	if not rows:
+		return None
+
+	dispatches = sorted({row.parent for row in rows})
+	si = make_sales_invoice(
+		customer,
+		max(getdate(row.dispatch_date) for row in rows),
+		get_invoice_lines(rows),
+		remarks="Consolidated invoice for Vehicle Dispatch {0}".format(", ".join(dispatches)),
+	)
+
+	frappe.db.sql("""
+		UPDATE `tabVehicle Dispatch Load Item`
+		SET sales_invoice = %(si)s
+		WHERE name IN %(names)s
+	""", {"si": si.name, "names": tuple(row.name for row in rows)})
+	frappe.db.sql("""
+		UPDATE `tabVehicle Dispatch Customer Payment`
+		SET sales_invoice = %(si)s
+		WHERE parenttype = 'Vehicle Dispatch' AND parent IN %(dispatches)s
+			AND customer = %(customer)s
+			AND (sales_invoice IS NULL OR sales_invoice = '')
+	""", {"si": si.name, "dispatches": tuple(dispatches), "customer": customer})
+
+	payment_rows = frappe.get_all(
+		"Vehicle Dispatch Customer Payment",
+		filters={
+			"parenttype": "Vehicle Dispatch",
+			"parent": ["in", dispatches],
+			"sales_invoice": si.name,
+			"paying_amount": [">", 0],
+			"payment_entry": ["is", "not set"],
+		},
+		pluck="name",
+	)
+	queue_erp_documents("Sales Invoice", si.name, [("Payment Entry", row) for row in payment_rows])
+	return si
+
+
+def release_consolidated_invoice(doc, method=None):
+	"""Sales Invoice on_cancel: return the rows of a cancelled consolidated invoice to the queue.
+
+	Payment rows keep a Payment Entry that is still submitted, so the next
+	run does not record the payment twice.
+	"""
+	dispatches = frappe.db.sql_list("""
+		SELECT DISTINCT li.parent
+		FROM `tabVehicle Dispatch Load Item` li
+		INNER JOIN `tabVehicle Dispatch` vd ON vd.name = li.parent
+		WHERE li.sales_invoice = %(si)s AND li.parenttype = 'Vehicle Dispatch'
+			AND vd.defer_invoicing = 1
+	""", {"si": doc.name})
+	if not dispatches:
+		return
+
+	cancel_erp_documents("Sales Invoice", doc.name)
+	values = {"si": doc.name, "dispatches": tuple(dispatches)}
+	frappe.db.sql("""
+		UPDATE `tabVehicle Dispatch Load Item`
+		SET sales_invoice = NULL
+		WHERE sales_invoice = %(si)s AND parent IN %(dispatches)s
+	""", values)
+	frappe.db.sql("""
+		UPDATE `tabVehicle Dispatch Customer Payment` cp
+		LEFT JOIN `tabPayment Entry` pe ON pe.name = cp.payment_entry
+		SET cp.sales_invoice = NULL,
+			cp.payment_entry = IF(pe.docstatus = 1, cp.payment_entry, NULL)
+		WHERE cp.sales_invoice = %(si)s AND cp.parent IN %(dispatches)s
+	""", values)
+
+	frappe.msgprint(
+		"Items of Vehicle Dispatch {0} will be invoiced again by the next consolidated invoicing run.".format(
+			", ".join(dispatches)),
+		indicator="blue", alert=True)
+
+
+@frappe.whitelist()
+def run_consolidated_invoicing():
+	"""Queue a consolidated invoicing run now, for every period that has ended."""
+	frappe.only_for(("System Manager", "Accounts Manager"))
+	frappe.enqueue(
+		"trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.consolidated_invoicing.create_consolidated_invoices",
+		queue="long",
+		timeout=3600,
+		job_id="consolidated_invoicing",
+		deduplicate=True,
+	)
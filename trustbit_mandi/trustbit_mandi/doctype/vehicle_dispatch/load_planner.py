@@ -0,0 +1,421 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""Capacity-aware load planning for Vehicle Dispatch.
+
+The plan honours FIFO first: pending lines are taken whole, oldest deal
+first, for as long as they fit, then in whole packs until only a small
+window of capacity is left. That window is filled by a bounded knapsack
+over what is still pending. Lines with the same pack weight are
+interchangeable for the knapsack, so it runs per distinct pack weight (a
+handful) rather than per line, and the chosen pack counts go back to the
+lines oldest first. A plan over a few thousand lines takes milliseconds.
+"""
+
+import math
+import random
+import time
+from functools import reduce
+
+import frappe
+from frappe.utils import cint, flt
+
+# Capacity left for the knapsack once FIFO filling stops
+KNAPSACK_WINDOW_KG = 500
+
+# Knapsack capacity is counted in units of the pack weights' common divisor;
+# beyond this many units the weights are rounded up to a coarser unit, which
+# can only under-fill the vehicle, never overload it.
+MAX_KNAPSACK_UNITS = 20000
+WEIGHT_PRECISION = 10  # pack weights are compared in units of 0.1 KG
+
+
+def plan_load(candidates, capacity_kg):
+	"""Choose whole packs from `candidates` to fill `capacity_kg`.
+
+	`candidates` are dicts with pack_weight_kg and pending_packs, already in
+	FIFO order. Returns a list of planned pack counts, one per candidate.
+	"""
+	planned = [0] * len(candidates)
+	remaining = flt(capacity_kg)
+	if remaining <= 0:
+		return planned
+
+	weights = [flt(c.get("pack_weight_kg")) for c in candidates]
+	available = [
+		math.floor(flt(c.get("pending_packs")) + 1e-6) if weights[i] > 0 else 0
+		for i, c in enumerate(candidates)
+	]
+
+	# Phase 1: whole lines in FIFO order until the first that does not fit
+	start = len(candidates)
+	for i, packs in enumerate(available):
+		line_kg = packs * weights[i]
+		if line_kg > remaining + 1e-6:
+			start = i
+			break
+		planned[i] = packs
+		remaining -= line_kg
+
+	# Phase 2: whole packs in FIFO order down to the knapsack window
+	for i in range(start, len(candidates)):
+		if remaining <= KNAPSACK_WINDOW_KG:
+			break
+		take = min(available[i], math.floor((remaining - KNAPSACK_WINDOW_KG) / weights[i]))
+		if take > 0:
+			planned[i] += take
+			remaining -= take * weights[i]
+
+	# Phase 3: bounded knapsack over what is left, per distinct pack weight
+	by_weight = {}
+	for i in range(start, len(candidates)):
+		if available[i] > planned[i]:
+			by_weight.setdefault(weights[i], []).append(i)
+	if not by_weight or remaining < min(by_weight):
+		return planned
+
+	counts = {w: sum(available[i] - planned[i] for i in lines) for w, lines in by_weight.items()}
+	for weight, packs in solve_bounded_knapsack(counts, remaining).items():
+		for i in by_weight[weight]:
+			take = min(packs, available[i] - planned[i])
+			planned[i] += take
+			packs -= take
+			if not packs:
+				break
+
+	return planned
+
+
+def solve_bounded_knapsack(counts, capacity_kg):
+	"""Packs per weight ({weight_kg: max_packs}) that load the most KG within capacity_kg.
+
+	Weights are tried in the order given, so among equally full loads the
+	earlier (older) pack weights are preferred.
+	"""
+	weights = list(counts)
+	scaled = [round(w * WEIGHT_PRECISION) for w in weights]
+	unit = reduce(math.gcd, scaled)
+	cap_units = math.floor(capacity_kg * WEIGHT_PRECISION / unit + 1e-9)
+	if cap_units > MAX_KNAPSACK_UNITS:
+		factor = math.ceil(cap_units / MAX_KNAPSACK_UNITS)
+		unit *= factor
+		cap_units = math.floor(capacity_kg * WEIGHT_PRECISION / unit + 1e-9)
+	units = [math.ceil(s / unit) for s in scaled]
+
+	# reach[x]: a load of exactly x units is possible; via[x]: the weight
+	# index that first reached it; used[x]: packs of that weight in the chain.
+	reach = [False] * (cap_units + 1)
+	reach[0] = True
+	via = [-1] * (cap_units + 1)
+	used = [0] * (cap_units + 1)
+	for k, w in enumerate(units):
+		limit = counts[weights[k]]
+		for x in range(w, cap_units + 1):
+			if not reach[x] and reach[x - w] and (via[x - w] != k or used[x - w] < limit):
+				reach[x] = True
+				via[x] = k
+				used[x] = used[x - w] + 1 if via[x - w] == k else 1
+
+	best = max(x for x in range(cap_units + 1) if reach[x])
+	result = {}
+	x = best
+	while x > 0:
+		k = via[x]
+		result[weights[k]] = result.get(weights[k], 0) + 1
+		x -= units[k]
+	return result
+
+
+def get_vehicle_capacity(vehicle=None, capacity_kg=None):
+	if capacity_kg is not None and capacity_kg != "":
+		return flt(capacity_kg)
+	if vehicle:
+		return flt(frappe.db.get_value("Vehicle Master", vehicle, "capacity_kg"))
+	frappe.throw("Please select a Vehicle or enter the capacity to plan for.")
+
+
+def sort_fifo(rows):
+	"""Oldest deal first across customers.
+
+	Same order as get_pending_items_for_dispatch without the customer:
+	soda_date, then deal creation, deal name and item idx from the row's cursor.
+	"""
+	def key(row):
+		cursor = row.get("cursor") or {}
+		return (
+			str(row.get("soda_date") or ""),
+			cursor.get("creation") or "",
+			row.get("deal_name") or "",
+			cint(cursor.get("idx")),
+		)
+
+	return sorted(rows, key=key)
+
+
+@frappe.whitelist()
+def plan_load_for_dispatch(price_list_area=None, customer=None, vehicle=None, capacity_kg=None,
+		item=None, pack_size=None):
+	"""Pending deal items with a proposed load in planned_packs / planned_kg.
+
+	`capacity_kg` defaults to the Vehicle Master capacity of `vehicle`;
+	pass the capacity still free when the vehicle is partly loaded.
+	"""
+	from trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch import (
+		get_pending_items_for_dispatch,
+	)
+
+	capacity = get_vehicle_capacity(vehicle, capacity_kg)
+	rows = sort_fifo(get_pending_items_for_dispatch(
+		price_list_area=price_list_area, customer=customer, item=item, pack_size=pack_size))
+	planned = plan_load(rows, capacity)
+
+	for row, packs in zip(rows, planned, strict=True):
+		row["planned_packs"] = packs
+		row["planned_kg"] = packs * flt(row.get("pack_weight_kg"))
+	return rows
+
+
+def make_synthetic_area(lines, seed=None, pack_weights=(25, 30, 50, 26.5)):
+	"""Synthetic FIFO-ordered pending lines for benchmarking."""
+	rng = random.Random(seed)
+	return [
+		{"pack_weight_kg": rng.choice(pack_weights), "pending_packs": rng.randint(1, 200)}
+		for _ in range(lines)
+	]
+
+
+def benchmark(lines=3000, areas=5, capacity_kg=25000, seed=42):
+	"""Time plan_load on synthetic areas.
+
+	bench --site <site> execute trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.load_planner.benchmark --kwargs "{'lines': 5000}"
+	"""
+	results = []
+	for area in range(int(areas)):
+		candidates = make_synthetic_area(int(lines), seed=int(seed) + area)
+		started = time.perf_counter()
+		planned = plan_load(candidates, capacity_kg)
+		elapsed = time.perf_counter() - started
+		loaded = sum(p * c["pack_weight_kg"] for p, c in zip(planned, candidates, strict=True))
+		results.append({
+			"area": area + 1,
+			"lines": len(candidates),
+			"planned_kg": flt(loaded, 2),
+			"utilization": flt(loaded * 100 / capacity_kg, 2),
+			"seconds": flt(elapsed, 4),
+		})
+	return results
+
+
+# ── Fleet planning ──
+
+def plan_fleet(candidates, vehicles, max_rounds=20):
+	"""Assign pending lines to several vehicles.
+
+	`candidates` are FIFO-ordered dicts with customer, pack_weight_kg and
+	pending_packs; `vehicles` are (name, capacity_kg) pairs. What the fleet
+	can carry is chosen with plan_load over the combined capacity, so FIFO
+	still decides which lines go today. Those lines are packed per customer
+	by first-fit decreasing, splitting a customer only when no vehicle can
+	take them whole, and a local search then merges split customers and
+	empties lightly loaded vehicles where the others have room.
+
+	Returns a list of {vehicle, capacity_kg, loaded_kg, lines: {index: packs}}
+	for the vehicles used, in fleet order.
+	"""
+	weights = [flt(c.get("pack_weight_kg")) for c in candidates]
+	fleet = sorted(
+		[(name, flt(capacity)) for name, capacity in vehicles if flt(capacity) > 0],
+		key=lambda v: -v[1])
+	planned = plan_load(candidates, sum(capacity for _, capacity in fleet))
+
+	# Customer blocks: {customer: {index: packs}}, in FIFO order of first line
+	blocks = {}
+	for i, packs in enumerate(planned):
+		if packs:
+			blocks.setdefault(candidates[i].get("customer"), {})[i] = packs
+
+	def block_kg(lines):
+		return sum(packs * weights[i] for i, packs in lines.items())
+
+	bins = [frappe._dict(vehicle=name, capacity_kg=capacity, lines={}, customers={}) for name, capacity in fleet]
+	opened = []
+
+	def free(b):
+		return b.capacity_kg - sum(block_kg(lines) for lines in b.customers.values())
+
+	def place(b, customer, lines):
+		target = b.customers.setdefault(customer, {})
+		for i, packs in lines.items():
+			target[i] = target.get(i, 0) + packs
+
+	# First-fit decreasing over customer blocks
+	for customer, lines in sorted(blocks.items(), key=lambda kv: -block_kg(kv[1])):
+		kg = block_kg(lines)
+		target = next((b for b in opened if free(b) >= kg - 1e-6), None)
+		if not target:
+			target = next((b for b in bins if b not in opened and b.capacity_kg >= kg - 1e-6), None)
+			if target:
+				opened.append(target)
+		if target:
+			place(target, customer, lines)
+			continue
+
+		# Too big for any single vehicle: split it over the roomiest
+		# open vehicle, opening the next largest once those are full
+		remaining = dict(lines)
+		while remaining:
+			lightest_pack = min(weights[i] for i in remaining)
+			target = max(opened, key=free) if opened else None
+			if not target or free(target) < lightest_pack - 1e-6:
+				target = next((b for b in bins if b not in opened), None)
+				if not target:
+					break
+				opened.append(target)
+
+			part = {}
+			room = free(target)
+			for i in sorted(remaining):
+				take = min(remaining[i], math.floor((room + 1e-6) / weights[i]))
+				if take > 0:
+					part[i] = take
+					room -= take * weights[i]
+			if not part:
+				break
+			place(target, customer, part)
+			for i, packs in part.items():
+				remaining[i] -= packs
+				if not remaining[i]:
+					del remaining[i]
+
+	# Local improvement
+	for _ in range(int(max_rounds)):
+		improved = False
+
+		# Merge a split customer into one of the vehicles already carrying it
+		holders = {}
+		for b in opened:
+			for customer in b.customers:
+				holders.setdefault(customer, []).append(b)
+		for customer, carrying in holders.items():
+			if len(carrying) < 2:
+				continue
+			for target in sorted(carrying, key=free, reverse=True):
+				others = [b for b in carrying if b is not target]
+				moving = sum(block_kg(b.customers[customer]) for b in others)
+				if free(target) >= moving - 1e-6:
+					for b in others:
+						place(target, customer, b.customers.pop(customer))
+					improved = True
+					break
+
+		# Empty the lightest vehicle into the others' spare room
+		opened = [b for b in opened if b.customers]
+		if len(opened) > 1:
+			lightest = min(opened, key=lambda b: b.capacity_kg - free(b))
+			rest = [b for b in opened if b is not lightest]
+			moves = []
+			spare = {id(b): free(b) for b in rest}
+			for customer, lines in sorted(lightest.customers.items(), key=lambda kv: -block_kg(kv[1])):
+				kg = block_kg(lines)
+				# Prefer a vehicle already carrying this customer
+				target = next((b for b in rest if customer in b.customers and spare[id(b)] >= kg - 1e-6), None)
+				target = target or next((b for b in rest if spare[id(b)] >= kg - 1e-6), None)
+				if not target:
+					moves = None
+					break
+				spare[id(target)] -= kg
+				moves.append((target, customer))
+			if moves:
+				for target, customer in moves:
+					place(target, customer, lightest.customers.pop(customer))
+				opened.remove(lightest)
+				improved = True
+
+		if not improved:
+			break
+
+	plan = []
+	for b in bins:
+		if b not in opened or not b.customers:
+			continue
+		lines = {}
+		for customer_lines in b.customers.values():
+			lines.update(customer_lines)
+		plan.append(frappe._dict(
+			vehicle=b.vehicle,
+			capacity_kg=b.capacity_kg,
+			loaded_kg=flt(b.capacity_kg - free(b), 3),
+			lines=dict(sorted(lines.items())),
+		))
+	return plan
+
+
+@frappe.whitelist()
+def create_fleet_dispatches(price_list_area, vehicles=None, dispatch_date=None):
+	"""Plan an area's pending deal items over several vehicles and create draft dispatches.
+
+	`vehicles` is a list (or JSON list) of Vehicle Master names; all active
+	vehicles are used when it is empty. Every draft is inserted in the
+	request's transaction, so either all of them are created or none is.
+	"""
+	from trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch import (
+		get_pending_items_for_dispatch,
+	)
+
+	frappe.has_permission("Vehicle Dispatch", "create", throw=True)
+
+	vehicles = frappe.parse_json(vehicles) if vehicles else None
+	filters = {"name": ["in", vehicles]} if vehicles else {"is_active": 1}
+	fleet = frappe.get_all("Vehicle Master", filters=filters, fields=["name", "capacity_kg"])
+	if not fleet:
+		frappe.throw("No vehicles to plan for.")
+
+	rows = sort_fifo(get_pending_items_for_dispatch(price_list_area=price_list_area))
+	plan = plan_fleet(rows, [(v.name, v.capacity_kg) for v in fleet])
+	if not plan:
+		frappe.throw("Nothing to load: no pending deal items fit the selected vehicles.")
+
+	created = []
+	for load in plan:
+		vd = frappe.new_doc("Vehicle Dispatch")
+		vd.vehicle = load.vehicle
+		# before_save computes utilisation before fetch_from fills this in
+		vd.vehicle_capacity_kg = load.capacity_kg
+		if dispatch_date:
+			vd.dispatch_date = dispatch_date
+
+		customers = []
+		for i, packs in load.lines.items():
+			row = rows[i]
+			vd.append("load_items", {
+				"customer": row.customer,
+				"customer_name": row.customer_name,
+				"soda": row.deal_name,
+				"deal_item": row.deal_item_name,
+				"item": row.item,
+				"pack_size": row.pack_size,
+				"pack_weight_kg": flt(row.pack_weight_kg),
+				"qty": packs,
+				"price_per_kg": flt(row.price_per_kg),
+				"bag_cost": flt(row.bag_cost),
+				"rate": flt(row.rate),
+			})
+			if row.customer not in customers:
+				customers.append(row.customer)
+
+		for customer in customers:
+			vd.append("customer_payments", {
+				"customer": customer,
+				"payment_mode": "Cash",
+			})
+
+		vd.insert()
+		created.append({
+			"name": vd.name,
+			"vehicle": vd.vehicle,
+			"loaded_kg": flt(vd.total_loaded_kg, 2),
+			"capacity_kg": flt(vd.vehicle_capacity_kg, 2),
+			"customers": len(customers),
+		})
+
+	return created
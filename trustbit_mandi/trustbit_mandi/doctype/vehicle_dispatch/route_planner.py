@@ -0,0 +1,221 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""Stop ordering for Vehicle Dispatch load sheets.
+
+Customers are sequenced over straight-line (haversine) distances from their
+map coordinates, starting from the area's depot when it has coordinates.
+Up to EXACT_MAX_STOPS stops the shortest path is found exactly (Held-Karp).
+Longer routes use a nearest-neighbour tour improved by 2-opt and Or-opt
+moves, a heuristic that is usually but not always optimal. Twenty to fifty
+stops solve in a few milliseconds, so it runs on save.
+"""
+
+import math
+
+import frappe
+from frappe.utils import flt
+
+EARTH_RADIUS_KM = 6371.0
+# Largest route solved exactly; Held-Karp grows as 2^n * n^2
+EXACT_MAX_STOPS = 10
+
+
+def haversine_km(a, b):
+	lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+	lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+	h = (math.sin((lat2 - lat1) / 2) ** 2
+		+ math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+	return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+def get_distance_matrix(points):
+	n = len(points)
+	dist = [[0.0] * n for _ in range(n)]
+	for i in range(n):
+		for j in range(i + 1, n):
+			dist[i][j] = dist[j][i] = haversine_km(points[i], points[j])
+	return dist
+
+
+def nearest_neighbour(dist, start=0):
+	route = [start]
+	unvisited = set(range(len(dist))) - {start}
+	while unvisited:
+		last = route[-1]
+		nearest = min(unvisited, key=lambda j: (dist[last][j], j))
+		route.append(nearest)
+		unvisited.remove(nearest)
+	return route
+
+
+def two_opt(route, dist, max_rounds=50):
+	"""Reverse route segments while that shortens the open path; route[0] stays first."""
+	route = list(route)
+	n = len(route)
+	for _ in range(max_rounds):
+		improved = False
+		for i in range(1, n - 1):
+			for j in range(i + 1, n):
+				a, b = route[i - 1], route[i]
+				c = route[j]
+				d = route[j + 1] if j + 1 < n else None
+				before = dist[a][b] + (dist[c][d] if d is not None else 0)
+				after = dist[a][c] + (dist[b][d] if d is not None else 0)
+				if after < before - 1e-9:
+					route[i:j + 1] = reversed(route[i:j + 1])
+					improved = True
+		if not improved:
+			break
+	return route
+
+
+def or_opt(route, dist, max_segment=3):
+	"""Move segments of up to `max_segment` stops, forwards or reversed, while that shortens the path."""
+	route = list(route)
+	n = len(route)
+
+	def d(a, b):
+		return dist[a][b] if a is not None and b is not None else 0
+
+	improved = False
+	for length in range(1, max_segment + 1):
+		i = 1
+		while i + length <= n:
+			segment = route[i:i + length]
+			prev, nxt = route[i - 1], route[i + length] if i + length < n else None
+			removed = d(prev, segment[0]) + d(segment[-1], nxt) - d(prev, nxt)
+			rest = route[:i] + route[i + length:]
+
+			best = None
+			for j in range(len(rest)):
+				if j == i - 1:
+					continue
+				x, y = rest[j], rest[j + 1] if j + 1 < len(rest) else None
+				for candidate in (segment, segment[::-1]):
+					added = d(x, candidate[0]) + d(candidate[-1], y) - d(x, y)
+					if added < removed - 1e-9 and (best is None or added < best[0]):
+						best = (added, j, candidate)
+			if best:
+				_added, j, candidate = best
+				route = rest[:j + 1] + candidate + rest[j + 1:]
+				improved = True
+			else:
+				i += 1
+	return route, improved
+
+
+def improve_route(route, dist, max_rounds=50):
+	"""Alternate 2-opt and Or-opt until neither shortens the path."""
+	for _ in range(max_rounds):
+		route = two_opt(route, dist)
+		route, improved = or_opt(route, dist)
+		if not improved:
+			break
+	return route
+
+
+def held_karp(dist):
+	"""Shortest open path from node 0 through every node, by dynamic programming over subsets."""
+	n = len(dist)
+	if n <= 2:
+		return list(range(n))
+
+	# best[(mask, j)]: (length, previous node) of the shortest path from 0
+	# through the nodes in mask (bit k - 1 for node k) that ends at j
+	best = {(1 << (j - 1), j): (dist[0][j], 0) for j in range(1, n)}
+	for size in range(2, n):
+		for mask in range(1, 1 << (n - 1)):
+			if bin(mask).count("1") != size:
+				continue
+			for j in range(1, n):
+				bit = 1 << (j - 1)
+				if not mask & bit:
+					continue
+				previous = mask ^ bit
+				best[(mask, j)] = min(
+					(best[(previous, k)][0] + dist[k][j], k)
+					for k in range(1, n)
+					if previous & (1 << (k - 1))
+				)
+
+	full = (1 << (n - 1)) - 1
+	end = min(range(1, n), key=lambda j: (best[(full, j)][0], j))
+	route, mask = [], full
+	while end:
+		route.append(end)
+		mask, end = mask ^ (1 << (end - 1)), best[(mask, end)][1]
+	return [0, *reversed(route)]
+
+
+def order_stops(points, origin=None):
+	"""Visiting order (indices into `points`) of (lat, lon) stops, starting near `origin`.
+
+	The path is open: the vehicle does not return to the origin. Without an
+	origin the tour starts from the first stop.
+	"""
+	if len(points) < 3 and origin is None:
+		return list(range(len(points)))
+
+	nodes = ([origin] if origin is not None else []) + list(points)
+	dist = get_distance_matrix(nodes)
+	if len(points) <= EXACT_MAX_STOPS:
+		route = held_karp(dist)
+	else:
+		route = improve_route(nearest_neighbour(dist, 0), dist)
+	if origin is not None:
+		return [i - 1 for i in route[1:]]
+	return route
+
+
+def get_route_length_km(points, order, origin=None):
+	path = ([origin] if origin is not None else []) + [points[i] for i in order]
+	return sum(haversine_km(path[i], path[i + 1]) for i in range(len(path) - 1))
+
+
+def get_customer_coordinates(customers):
+	"""{customer: (lat, lon)} for customers with map coordinates set."""
+	if not customers or not frappe.get_meta("Customer").has_field("mandi_latitude"):
+		return {}
+	return {
+		row.name: (flt(row.mandi_latitude), flt(row.mandi_longitude))
+		for row in frappe.get_all(
+			"Customer",
+			filters={"name": ["in", list(customers)]},
+			fields=["name", "mandi_latitude", "mandi_longitude"],
+		)
+		if flt(row.mandi_latitude) or flt(row.mandi_longitude)
+	}
+
+
+def get_depot_coordinates(deals):
+	"""Depot of the area most of `deals` belong to, when it has coordinates."""
+	if not deals:
+		return None
+	row = frappe.db.sql("""
+		SELECT a.depot_latitude, a.depot_longitude
+		FROM `tabDeal` d
+		INNER JOIN `tabDeal Price List Area` a ON a.name = d.price_list_area
+		WHERE d.name IN %(deals)s
+		GROUP BY a.name, a.depot_latitude, a.depot_longitude
+		ORDER BY COUNT(*) DESC, a.name ASC
+		LIMIT 1
+	""", {"deals": tuple(deals)}, as_dict=True)
+	if row and (flt(row[0].depot_latitude) or flt(row[0].depot_longitude)):
+		return (flt(row[0].depot_latitude), flt(row[0].depot_longitude))
+	return None
+
+
+def sequence_customers(customers, deals=()):
+	"""{customer: stop number} in route order.
+
+	Customers without coordinates keep their relative order after the
+	routed ones.
+	"""
+	coordinates = get_customer_coordinates(customers)
+	located = [c for c in customers if c in coordinates]
+	unlocated = [c for c in customers if c not in coordinates]
+
+	order = order_stops([coordinates[c] for c in located], get_depot_coordinates(deals))
+	sequence = [located[i] for i in order] + unlocated
+	return {customer: stop for stop, customer in enumerate(sequence, start=1)}
@@ -0,0 +1,63 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+import itertools
+import random
+import unittest
+
+from trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.route_planner import (
+	EXACT_MAX_STOPS,
+	get_route_length_km,
+	order_stops,
+)
+
+
+def random_points(rng, count):
+	"""Stops scattered over roughly 100 x 100 km."""
+	return [(26 + rng.random(), 80 + rng.random()) for _i in range(count)]
+
+
+def brute_force_length_km(points, origin=None):
+	"""Length of the shortest open path, trying every order; without an origin the first stop stays first."""
+	if origin is None:
+		orders = ([0, *rest] for rest in itertools.permutations(range(1, len(points))))
+	else:
+		orders = (list(order) for order in itertools.permutations(range(len(points))))
+	return min(get_route_length_km(points, order, origin) for order in orders)
+
+
+class TestRoutePlanner(unittest.TestCase):
+	def assert_is_route(self, order, points, origin=None):
+		self.assertEqual(sorted(order), list(range(len(points))))
+		if origin is None:
+			self.assertEqual(order[0], 0)
+
+	def test_small_routes_match_brute_force(self):
+		rng = random.Random(42)
+		for case in range(200):
+			points = random_points(rng, rng.randint(3, 8))
+			origin = random_points(rng, 1)[0] if case % 2 else None
+
+			order = order_stops(points, origin)
+
+			self.assert_is_route(order, points, origin)
+			self.assertAlmostEqual(
+				get_route_length_km(points, order, origin),
+				brute_force_length_km(points, origin),
+				places=6,
+				msg=f"case {case}: {len(points)} stops, origin {origin}",
+			)
+
+	def test_large_routes_visit_every_stop_once(self):
+		rng = random.Random(7)
+		for count in (EXACT_MAX_STOPS + 1, 25, 60):
+			points = random_points(rng, count)
+			origin = random_points(rng, 1)[0]
+			self.assert_is_route(order_stops(points, origin), points, origin)
+			self.assert_is_route(order_stops(points), points)
+
+	def test_trivial_routes(self):
+		self.assertEqual(order_stops([]), [])
+		self.assertEqual(order_stops([(26.0, 80.0)]), [0])
+		self.assertEqual(order_stops([(26.0, 80.0)], origin=(26.5, 80.5)), [0])
+		self.assertEqual(order_stops([(26.0, 80.0), (26.1, 80.1)]), [0, 1])
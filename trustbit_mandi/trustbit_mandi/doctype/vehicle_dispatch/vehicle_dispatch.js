@@ -3,14 +3,86 @@ frappe.ui.form.on('Vehicle Dispatch', {
 		// Custom status indicator
 		if (frm.doc.docstatus === 0) {
 			frm.page.set_indicator(__('Loading'), 'orange');
+		} else if (frm.doc.docstatus === 1 && ['Queued', 'Processing'].includes(frm.doc.status)) {
+			frm.page.set_indicator(__(frm.doc.status), 'yellow');
+		} else if (frm.doc.docstatus === 1 && frm.doc.status === 'Failed') {
+			frm.page.set_indicator(__('Failed'), 'red');
 		} else if (frm.doc.docstatus === 1) {
 			frm.page.set_indicator(__('Dispatched'), 'blue');
+		} else if (frm.doc.docstatus === 2 && frm.doc.amendment_pending) {
+			frm.page.set_indicator(__('Amendment Pending'), 'orange');
 		} else if (frm.doc.docstatus === 2) {
 			frm.page.set_indicator(__('Cancelled'), 'red');
 		}
 
 		render_capacity_bar(frm);
 
+		// Amend without cancelling the documents of unchanged customers
+		if (frm.doc.docstatus === 1 && frm.doc.status === 'Dispatched') {
+			frm.add_custom_button(__('Amend Changed Items'), function() {
+				frappe.confirm(
+					__('Cancel this dispatch for amendment? Only the deliveries, invoices and payments of rows you change will be cancelled and recreated.'),
+					function() {
+						frappe.call({
+							method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.amend_incrementally',
+							args: { name: frm.doc.name },
+							freeze: true,
+							callback: function(r) {
+								if (r.message) {
+									frappe.set_route('Form', 'Vehicle Dispatch', r.message);
+								}
+							}
+						});
+					}
+				);
+			});
+		}
+
+		// Reverse one customer's deliveries, invoice and payment
+		if (frm.doc.docstatus === 1 && frm.doc.status === 'Dispatched') {
+			let customers = [...new Set((frm.doc.load_items || [])
+				.filter(row => row.customer && !row.returned)
+				.map(row => row.customer))];
+			if (customers.length) {
+				frm.add_custom_button(__('Return Customer Goods'), function() {
+					return_customer_dialog(frm, customers);
+				});
+			}
+		}
+
+		// Documents left open by an amendment that will not be submitted
+		if (frm.doc.docstatus === 2 && frm.doc.amendment_pending) {
+			frm.add_custom_button(__('Cancel Linked Documents'), function() {
+				frappe.confirm(
+					__('Cancel the deliveries, invoices and payments still linked to this dispatch?'),
+					function() {
+						frappe.call({
+							method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.cancel_pending_amendment_documents',
+							args: { name: frm.doc.name },
+							freeze: true,
+							callback: function() {
+								frm.reload_doc();
+							}
+						});
+					}
+				);
+			});
+		}
+
+		// Resume a background dispatch that stopped on an error
+		if (frm.doc.docstatus === 1 && frm.doc.status === 'Failed') {
+			frm.add_custom_button(__('Retry Dispatch'), function() {
+				frappe.call({
+					method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.retry_dispatch',
+					args: { name: frm.doc.name },
+					freeze: true,
+					callback: function() {
+						frm.reload_doc();
+					}
+				});
+			}).addClass('btn-primary');
+		}
+
 		// "Get Deliveries" button only in draft mode
 		if (frm.doc.docstatus === 0) {
 			frm.add_custom_button(__('Get Deliveries'), function() {
@@ -216,6 +288,24 @@ function get_deliveries_dialog(frm) {
 				label: 'Customer',
 				options: 'Customer',
 				hidden: 1
+			},
+			{
+				fieldtype: 'Link',
+				fieldname: 'item',
+				label: __('Item'),
+				options: 'Item'
+			},
+			{
+				fieldtype: 'Link',
+				fieldname: 'pack_size',
+				label: __('Pack Size'),
+				options: 'Deal Pack Size'
+			},
+			{
+				fieldtype: 'Check',
+				fieldname: 'plan_load',
+				label: __('Plan Load to Capacity'),
+				description: __('Pre-select packs that fill the remaining capacity, oldest deals first')
 			}
 		],
 		primary_action_label: __('Show Pending Items'),
@@ -229,17 +319,23 @@ function get_deliveries_dialog(frm) {
 				return;
 			}
 			d.hide();
-			load_pending_items_for_dispatch(frm, area, customer);
+			load_pending_items_for_dispatch(frm, area, customer, d.get_value('plan_load'),
+				d.get_value('item'), d.get_value('pack_size'));
 		}
 	});
 	d.show();
 }
 
-function load_pending_items_for_dispatch(frm, area, customer) {
+// Pending items are fetched a page at a time; the dialog loads the next
+// page when its table is scrolled to the bottom.
+const VD_PENDING_PAGE_LENGTH = 200;
+
+function load_pending_items_for_dispatch(frm, area, customer, plan_load, item, pack_size) {
 	let pending_items = null;
 	let pack_sizes = null;
 	let bag_cost_map = null;
 	let calls_done = 0;
+	let pager = null;
 
 	function check_all_done() {
 		calls_done++;
@@ -248,15 +344,52 @@ function load_pending_items_for_dispatch(frm, area, customer) {
 				frappe.msgprint(__('No pending deal items found.'));
 				return;
 			}
-			show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map);
+			show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map, pager);
 		}
 	}
 
+	let method = 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.get_pending_items_for_dispatch';
+	let args = { price_list_area: area, customer: customer, item: item, pack_size: pack_size };
+	if (plan_load) {
+		// The planner needs every candidate at once, so its result is not paged
+		method = 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.load_planner.plan_load_for_dispatch';
+		args.vehicle = frm.doc.vehicle;
+		args.capacity_kg = flt(frm.doc.vehicle_capacity_kg) - flt(frm.doc.total_loaded_kg);
+	} else {
+		args.page_length = VD_PENDING_PAGE_LENGTH;
+		pager = {
+			has_more: false,
+			loading: false,
+			after: null,
+			take: function(items) {
+				pager.has_more = items.length === VD_PENDING_PAGE_LENGTH;
+				if (items.length) pager.after = items[items.length - 1].cursor;
+				return items;
+			},
+			load_more: function(callback) {
+				if (!pager.has_more || pager.loading) return;
+				pager.loading = true;
+				frappe.call({
+					method: method,
+					args: Object.assign({}, args, { after: JSON.stringify(pager.after) }),
+					callback: function(r) {
+						pager.loading = false;
+						callback(pager.take(r.message || []));
+					},
+					error: function() {
+						pager.loading = false;
+					}
+				});
+			}
+		};
+	}
+
 	frappe.call({
-		method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.get_pending_items_for_dispatch',
-		args: { price_list_area: area, customer: customer },
+		method: method,
+		args: args,
 		callback: function(r) {
 			pending_items = r.message || [];
+			if (pager) pager.take(pending_items);
 			check_all_done();
 		}
 	});
@@ -278,12 +411,7 @@ function load_pending_items_for_dispatch(frm, area, customer) {
 	});
 }
 
-function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map) {
-	let pack_weight_map = {};
-	pack_sizes.forEach(function(ps) {
-		pack_weight_map[ps.pack_size] = flt(ps.weight_kg);
-	});
-
+function append_vd_dialog_rows(rows, pending_items, bag_cost_map) {
 	// Group items by customer for display
 	let customer_groups = {};
 	pending_items.forEach(function(p) {
@@ -298,9 +426,6 @@ function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map
 		customer_groups[cust].items.push(p);
 	});
 
-	// Build row state
-	let rows = [];
-	let row_idx = 0;
 	Object.keys(customer_groups).forEach(function(cust) {
 		let group = customer_groups[cust];
 		group.items.forEach(function(p) {
@@ -311,7 +436,7 @@ function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map
 			}
 
 			rows.push({
-				idx: row_idx++,
+				idx: rows.length,
 				customer: p.customer,
 				customer_name: p.customer_name,
 				deal_name: p.deal_name,
@@ -326,13 +451,24 @@ function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map
 				pending_kg: flt(p.pending_kg),
 				pending_packs: flt(p.pending_packs),
 				price_per_kg: ppk,
-				deliver_qty: Math.floor(flt(p.pending_packs)),
+				deliver_qty: p.planned_packs !== undefined ? p.planned_packs : Math.floor(flt(p.pending_packs)),
 				bag_cost: bc,
 				rate: flt(p.rate),
-				checked: true
+				checked: p.planned_packs !== undefined ? p.planned_packs > 0 : true
 			});
 		});
 	});
+}
+
+function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map, pager) {
+	let pack_weight_map = {};
+	pack_sizes.forEach(function(ps) {
+		pack_weight_map[ps.pack_size] = flt(ps.weight_kg);
+	});
+
+	// Build row state
+	let rows = [];
+	append_vd_dialog_rows(rows, pending_items, bag_cost_map);
 
 	let capacity = flt(frm.doc.vehicle_capacity_kg);
 	let already_loaded = flt(frm.doc.total_loaded_kg);
@@ -361,7 +497,7 @@ function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map
 			+ '</div>';
 
 		// Table
-		html += '<div style="max-height:400px;overflow-y:auto;border:1px solid #e2e8f0;border-radius:6px;">';
+		html += '<div class="vd-items-scroll" style="max-height:400px;overflow-y:auto;border:1px solid #e2e8f0;border-radius:6px;">';
 		html += '<table class="table table-sm" style="margin-bottom:0;font-size:12px;">';
 		html += '<thead style="background:#f7fafc;position:sticky;top:0;z-index:1;">';
 		html += '<tr>';
@@ -460,13 +596,21 @@ function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map
 			html += '</tr>';
 		});
 
-		html += '</tbody></table></div>';
+		html += '</tbody></table>';
+		if (pager && pager.has_more) {
+			html += '<div style="text-align:center;padding:8px;">'
+				+ '<a class="vd-load-more" style="font-size:12px;cursor:pointer;">'
+				+ (pager.loading ? __('Loading...') : __('Scroll or click to load more items'))
+				+ '</a></div>';
+		}
+		html += '</div>';
 
 		// Footer summary
 		let summary = get_vd_dialog_summary(rows);
 		html += '<div style="display:flex;justify-content:space-between;align-items:center;margin-top:10px;padding:8px 0;">';
 		html += '<div class="dialog-footer-summary" style="display:flex;gap:20px;font-size:12.5px;color:#4a5568;">';
-		html += '<div>Selected: <strong>' + summary.selected + '</strong> of ' + rows.length + '</div>';
+		html += '<div>Selected: <strong>' + summary.selected + '</strong> of ' + rows.length
+			+ (pager && pager.has_more ? '+' : '') + '</div>';
 		html += '<div>Customers: <strong>' + summary.customers + '</strong></div>';
 		html += '<div>Packs: <strong>' + summary.total_qty + '</strong></div>';
 		html += '<div>KG: <strong>' + summary.total_kg.toFixed(2) + '</strong></div>';
@@ -480,6 +624,23 @@ function show_dispatch_items_dialog(frm, pending_items, pack_sizes, bag_cost_map
 
 		wrapper.html(html);
 		bind_dispatch_events(wrapper, rows, pack_weight_map, bag_cost_map, pack_sizes, capacity, already_loaded, render_table);
+
+		wrapper.find('.vd-items-scroll').off('scroll').on('scroll', function() {
+			if (this.scrollTop + this.clientHeight >= this.scrollHeight - 40) {
+				load_more_rows();
+			}
+		});
+		wrapper.find('.vd-load-more').off('click').on('click', load_more_rows);
+	}
+
+	function load_more_rows() {
+		if (!pager || !pager.has_more || pager.loading) return;
+		let scroll_top = wrapper.find('.vd-items-scroll').scrollTop();
+		pager.load_more(function(items) {
+			append_vd_dialog_rows(rows, items, bag_cost_map);
+			render_table();
+			wrapper.find('.vd-items-scroll').scrollTop(scroll_top);
+		});
 	}
 
 	render_table();
@@ -700,3 +861,32 @@ function format_number(num) {
 function flt(val) {
 	return parseFloat(val) || 0;
 }
+
+function return_customer_dialog(frm, customers) {
+	let d = new frappe.ui.Dialog({
+		title: __('Return Customer Goods'),
+		fields: [
+			{
+				fieldname: 'customer',
+				fieldtype: 'Select',
+				label: __('Customer'),
+				options: customers,
+				reqd: 1,
+				description: __("Cancels this customer's payment, invoice and deliveries and restores the stock. Other customers are not affected.")
+			}
+		],
+		primary_action_label: __('Return'),
+		primary_action: function(values) {
+			d.hide();
+			frappe.call({
+				method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.return_customer',
+				args: { name: frm.doc.name, customer: values.customer },
+				freeze: true,
+				callback: function() {
+					frm.reload_doc();
+				}
+			});
+		}
+	});
+	d.show();
+}
@@ -3,16 +3,31 @@
 
 import frappe
 from frappe.model.document import Document
-from frappe.utils import flt
+from frappe.utils import cint, flt, getdate
 
+from trustbit_mandi.tracing import trace_step
 from trustbit_mandi.trustbit_mandi.doctype.deal_delivery.deal_delivery import (
-	get_other_delivered_kg_for_item,
+	get_pending_deal_item_rows,
 )
+from trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.deal_item_delivery_ledger import (
+	lock_deal_items,
+)
+from trustbit_mandi.trustbit_mandi.doctype.mandi_erp_outbox.mandi_erp_outbox import (
+	cancel_erp_documents,
+	queue_erp_documents,
+)
+from trustbit_mandi.trustbit_mandi.doctype.mandi_settings.mandi_settings import get_mandi_settings
+from trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.route_planner import sequence_customers
+from trustbit_mandi.utils import MandiErpContext, get_active_erp_context, mandi_erp_context
+
+# Statuses of a submitted dispatch whose documents are created by a background job
+BACKGROUND_STATUSES = ("Queued", "Processing", "Failed")
 
 
 class VehicleDispatch(Document):
 	def before_save(self):
 		self.calculate_item_kg()
+		self.set_stop_sequence()
 		self.calculate_totals()
 		self.calculate_customer_payment_totals()
 		self.calculate_freight_totals()
@@ -24,6 +39,24 @@ class VehicleDispatch(Document):
 			row.kg = flt(row.qty) * flt(row.pack_weight_kg)
 			row.amount = flt(row.qty) * flt(row.rate)
 
+	def set_stop_sequence(self):
+		"""Number the customer stops; in route order when Order Stops by Route is on."""
+		customers = []
+		for row in self.load_items:
+			if row.customer and row.customer not in customers:
+				customers.append(row.customer)
+
+		if self.optimize_route and len(customers) > 1:
+			stops = sequence_customers(customers, {row.soda for row in self.load_items if row.soda})
+			self.load_items.sort(key=lambda row: (stops.get(row.customer, len(stops) + 1), row.idx))
+			for idx, row in enumerate(self.load_items, start=1):
+				row.idx = idx
+		else:
+			stops = {customer: stop for stop, customer in enumerate(customers, start=1)}
+
+		for row in self.load_items:
+			row.stop_sequence = stops.get(row.customer)
+
 	def calculate_totals(self):
 		total_kg = 0
 		total_packs = 0
@@ -75,83 +108,237 @@ class VehicleDispatch(Document):
 		if self.docstatus == 0:
 			self.status = "Loading"
 		elif self.docstatus == 1:
-			self.status = "Dispatched"
+			if self.status not in BACKGROUND_STATUSES:
+				self.status = "Dispatched"
 		elif self.docstatus == 2:
 			self.status = "Cancelled"
 
+	def before_submit(self):
+		self.defer_invoicing = cint(get_mandi_settings().consolidate_invoices)
+
 	def on_submit(self):
 		if not self.load_items:
 			frappe.throw("Cannot dispatch without any items loaded.")
 
+		if self.amended_from:
+			with trace_step(self.doctype, self.name, "Carry Forward Amendment"):
+				self.carry_forward_amended_documents()
+
+		if self.submit_in_background:
+			self.db_set("status", "Queued")
+			enqueue_dispatch(self.name)
+			frappe.msgprint(
+				"Dispatch queued. Deliveries, invoices and payments are being created in the background.",
+				indicator="blue", alert=True)
+			return
+
+		# Lock every Deal Item on the truck up front, in one consistent order.
+		# Each Deal Delivery re-locks its own rows on submit; taking them all
+		# here first keeps two dispatches sharing deal items from deadlocking
+		# on each other's partially acquired locks.
+		with trace_step(self.doctype, self.name, "Lock Deal Items"):
+			lock_deal_items({
+				row.deal_item: row.soda for row in self.load_items if row.soda and row.deal_item
+			})
+
+		with trace_step(self.doctype, self.name, "Create Documents"):
+			self.create_dispatch_documents()
+		self.db_set("status", "Dispatched")
+		if self.defer_invoicing:
+			frappe.msgprint(
+				"Deliveries recorded. Invoices and payments will be created by consolidated invoicing.",
+				indicator="blue", alert=True)
+
+	def create_dispatch_documents(self, commit=False):
+		"""Create the Deal Deliveries and queue the Sales Invoices and Payment Entries.
+
+		Invoices and payments are posted by the ERP outbox worker (see
+		post_sales_invoice and post_payment_entry). Every step records its
+		document on the rows it covers (load item deal_delivery /
+		sales_invoice, customer payment sales_invoice / payment_entry) and
+		skips work already recorded, so a background run that stopped half
+		way resumes where it left off. With `commit`, each step is committed
+		as soon as it finishes.
+
+		Company, accounts, addresses and other master data are resolved once
+		for all customers on the truck and shared by every document created.
+		"""
+		with mandi_erp_context(row.customer for row in self.load_items):
+			self._run_dispatch_steps(commit)
+
+	def _run_dispatch_steps(self, commit):
 		# Count steps for progress bar
 		customer_deal_groups = self._group_items_by_customer_deal()
-		customers = list(set(row.customer for row in self.load_items if row.customer))
+		load_rows = {row.name: row for row in self.load_items}
+		customers = sorted(set(row.customer for row in self.load_items if row.customer))
 		paying_customers = [row for row in self.customer_payments if flt(row.paying_amount) > 0]
+		if self.defer_invoicing:
+			# Invoices and payments come from the consolidated invoicing job
+			customers, paying_customers = [], []
 
-		total_steps = len(customer_deal_groups) + len(customers) + len(paying_customers)
-		if total_steps == 0:
-			total_steps = 1
+		total_steps = len(customer_deal_groups) or 1
 		step = 0
 
 		# Step 1: Create Deal Deliveries (grouped by customer + deal)
-		for key, items in customer_deal_groups.items():
-			customer, deal = key
-			customer_name = items[0].get("customer_name", "")
-			step += 1
-			frappe.publish_progress(
-				step * 100 / total_steps,
-				title="Dispatching Vehicle...",
-				description="Creating delivery for {0}...".format(customer_name or customer))
-
-			dd = self._create_deal_delivery(customer, deal, items)
-			# Set back-reference on load_item rows
-			for item in items:
-				frappe.db.set_value(
-					"Vehicle Dispatch Load Item", item["row_name"],
-					"deal_delivery", dd.name, update_modified=False)
-
-		# Step 2: Create Sales Invoices (per customer)
-		customer_si_map = {}
-		for customer in customers:
-			step += 1
-			customer_name = frappe.get_cached_value("Customer", customer, "customer_name") or customer
-			frappe.publish_progress(
-				step * 100 / total_steps,
-				title="Dispatching Vehicle...",
-				description="Creating invoice for {0}...".format(customer_name))
-
-			si = self._create_sales_invoice(customer)
-			customer_si_map[customer] = si.name
-
-		# Set SI reference on customer_payments
-		for row in self.customer_payments:
-			if row.customer in customer_si_map:
-				frappe.db.set_value(
-					"Vehicle Dispatch Customer Payment", row.name,
-					"sales_invoice", customer_si_map[row.customer], update_modified=False)
-
-		# Step 3: Create Payment Entries (per customer, if paying_amount > 0)
-		for row in paying_customers:
-			step += 1
-			customer_name = row.customer_name or row.customer
-			frappe.publish_progress(
-				step * 100 / total_steps,
-				title="Dispatching Vehicle...",
-				description="Recording payment for {0}...".format(customer_name))
-
-			si_name = customer_si_map.get(row.customer)
-			if si_name:
-				pe = self._create_payment_entry(row, si_name)
-				if pe:
-					frappe.db.set_value(
-						"Vehicle Dispatch Customer Payment", row.name,
-						"payment_entry", pe.name, update_modified=False)
-
+		with trace_step(self.doctype, self.name, "Deal Deliveries"):
+			for key, items in customer_deal_groups.items():
+				customer, deal = key
+				customer_name = items[0].get("customer_name", "")
+				step += 1
+				if all(item["deal_delivery"] for item in items):
+					continue
+
+				frappe.publish_progress(
+					step * 100 / total_steps,
+					title="Dispatching Vehicle...",
+					description="Creating delivery for {0}...".format(customer_name or customer))
+
+				dd = self._create_deal_delivery(customer, deal, items)
+				# Set back-reference on load_item rows
+				for item in items:
+					self._set_row_link(load_rows[item["row_name"]], "deal_delivery", dd.name)
+				self._checkpoint(commit)
+
+		# Step 2: Queue Sales Invoices (per customer) and Payment Entries
+		# (per customer payment) for the ERP outbox worker
+		with trace_step(self.doctype, self.name, "Queue ERPNext Documents"):
+			invoiced = {row.customer for row in self.load_items if row.customer and row.sales_invoice}
+			queue_erp_documents(self.doctype, self.name, [
+				("Sales Invoice", customer) for customer in customers if customer not in invoiced
+			] + [
+				("Payment Entry", row.name) for row in paying_customers if not row.payment_entry
+			])
+
+		with trace_step(self.doctype, self.name, "Link Documents"):
+			self._flush_row_links()
 		frappe.publish_progress(100, title="Vehicle Dispatched!",
-			description="All documents created successfully.")
-		self.db_set("status", "Dispatched")
+			description="Deliveries created; invoices and payments follow in the background.")
+
+	def _set_row_link(self, row, fieldname, value):
+		"""Set a document link on a child row; the write is batched until _flush_row_links."""
+		row.set(fieldname, value)
+		if not hasattr(self, "_pending_row_links"):
+			self._pending_row_links = {}
+		self._pending_row_links.setdefault(row.doctype, {}).setdefault(fieldname, {})[row.name] = value
+
+	def _flush_row_links(self):
+		"""Write pending links with one multi-row UPDATE per child table."""
+		for doctype, fields in (getattr(self, "_pending_row_links", None) or {}).items():
+			assignments = []
+			values = []
+			row_names = set()
+			for fieldname, links in fields.items():
+				assignments.append("`{0}` = CASE name {1} ELSE `{0}` END".format(
+					fieldname, " ".join(["WHEN %s THEN %s"] * len(links))))
+				for row_name, value in links.items():
+					values.extend([row_name, value])
+				row_names.update(links)
+
+			frappe.db.sql("""
+				UPDATE `tab{doctype}`
+				SET {assignments}
+				WHERE name IN ({placeholders})
+			""".format(
+				doctype=doctype,
+				assignments=", ".join(assignments),
+				placeholders=", ".join(["%s"] * len(row_names)),
+			), values + sorted(row_names))
+
+		self._pending_row_links = {}
+
+	def carry_forward_amended_documents(self):
+		"""Reuse the documents of a dispatch cancelled through amend_incrementally.
+
+		Deal Deliveries are kept for customer + deal groups whose rows are
+		unchanged, Sales Invoices for customers whose rows are all unchanged,
+		and Payment Entries for unchanged payment rows on a kept invoice. Kept
+		documents are linked to this dispatch's rows, so create_dispatch_documents
+		skips them; documents of changed or removed groups are cancelled here
+		and recreated by the normal submit steps.
+		"""
+		original = frappe.get_doc("Vehicle Dispatch", self.amended_from)
+		if not original.amendment_pending:
+			return
+
+		same_date = getdate(original.dispatch_date) == getdate(self.dispatch_date)
+
+		# Deal Deliveries, per customer + deal
+		old_groups = get_load_item_groups(original.load_items, by_deal=True)
+		carried_dds = set()
+		for key, group in get_load_item_groups(self.load_items, by_deal=True).items():
+			old = old_groups.get(key)
+			if same_date and old and old.deal_delivery and old.signature == group.signature:
+				for row in group.rows:
+					self._set_row_link(row, "deal_delivery", old.deal_delivery)
+				carried_dds.add(old.deal_delivery)
+		stale_dds = {g.deal_delivery for g in old_groups.values() if g.deal_delivery} - carried_dds
+
+		# Sales Invoices, per customer
+		old_customers = get_load_item_groups(original.load_items)
+		for row in original.customer_payments:
+			if row.sales_invoice and row.customer in old_customers:
+				old_customers[row.customer].sales_invoice = (
+					old_customers[row.customer].sales_invoice or row.sales_invoice)
+		carried_sis = {}
+		for customer, group in get_load_item_groups(self.load_items).items():
+			old = old_customers.get(customer)
+			if same_date and old and old.sales_invoice and old.signature == group.signature:
+				for row in group.rows:
+					self._set_row_link(row, "sales_invoice", old.sales_invoice)
+				carried_sis[customer] = old.sales_invoice
+		stale_sis = {g.sales_invoice for g in old_customers.values() if g.sales_invoice}
+		stale_sis -= set(carried_sis.values())
+
+		# Payment Entries, per payment row on a carried invoice
+		old_payments = {}
+		for row in original.customer_payments:
+			if row.payment_entry:
+				old_payments.setdefault(get_payment_signature(row), []).append(row.payment_entry)
+		for row in self.customer_payments:
+			if row.customer not in carried_sis:
+				continue
+			self._set_row_link(row, "sales_invoice", carried_sis[row.customer])
+			payment_entries = old_payments.get(get_payment_signature(row))
+			if payment_entries:
+				self._set_row_link(row, "payment_entry", payment_entries.pop(0))
+		stale_pes = [pe for pes in old_payments.values() for pe in pes]
+
+		self._cancel_documents("Payment Entry", stale_pes, "Payment Entry", "PE", raise_exception=True)
+		self._cancel_documents("Sales Invoice", stale_sis, "Sales Invoice", "SI", raise_exception=True)
+		self._cancel_documents("Deal Delivery", stale_dds, "Delivery", "DD", raise_exception=True)
+
+		if carried_dds:
+			frappe.db.sql("""
+				UPDATE `tabDeal Delivery`
+				SET vehicle_dispatch = %(name)s
+				WHERE name IN %(deliveries)s
+			""", {"name": self.name, "deliveries": tuple(carried_dds)})
+
+		self._flush_row_links()
+		original.db_set("amendment_pending", 0)
+
+	def _checkpoint(self, commit):
+		"""In background mode, persist the links written so far and commit the step."""
+		if commit:
+			self._flush_row_links()
+			frappe.db.commit()
 
 	def on_cancel(self):
+		if self.status in ("Queued", "Processing"):
+			frappe.throw("Dispatch {0} is still being processed in the background. "
+				"Cancel it once processing has finished or failed.".format(self.name))
+
+		self.validate_consolidated_invoices()
+		# Drop invoices and payments still waiting in the ERP outbox; any it
+		# posted after this request started are cancelled with the linked ones.
+		posted = cancel_erp_documents(self.doctype, self.name)
+
+		if self.flags.keep_linked_documents:
+			# Cancelled by amend_incrementally: the amended copy decides on
+			# submit which of these documents to keep and which to cancel.
+			self.db_set({"status": "Cancelled", "amendment_pending": 1})
+			return
+
 		total_steps = 3
 		step = 0
 
@@ -161,7 +348,7 @@ class VehicleDispatch(Document):
 			step * 100 / total_steps,
 			title="Cancelling Dispatch...",
 			description="Cancelling payment entries...")
-		self._cancel_payment_entries()
+		self._cancel_payment_entries(posted.get("Payment Entry", []))
 
 		# Step 2: Cancel Sales Invoices
 		step += 1
@@ -169,7 +356,7 @@ class VehicleDispatch(Document):
 			step * 100 / total_steps,
 			title="Cancelling Dispatch...",
 			description="Cancelling sales invoices...")
-		self._cancel_sales_invoices()
+		self._cancel_sales_invoices(posted.get("Sales Invoice", []))
 
 		# Step 3: Cancel Deal Deliveries (DD on_cancel handles MSE + Deal rollback)
 		step += 1
@@ -183,6 +370,22 @@ class VehicleDispatch(Document):
 			description="All documents cancelled.")
 		self.db_set("status", "Cancelled")
 
+	def validate_consolidated_invoices(self, customer=None):
+		"""Block undoing rows that are on a consolidated invoice.
+
+		The invoice also covers other dispatches, so it is not cancelled from
+		here; cancelling it releases the rows for the next invoicing run.
+		"""
+		if not self.defer_invoicing:
+			return
+		invoices = sorted({
+			row.sales_invoice for row in self.load_items
+			if row.sales_invoice and (not customer or row.customer == customer)
+		})
+		if invoices:
+			frappe.throw("Items of {0} are billed on consolidated Sales Invoice {1}. "
+				"Cancel the invoice first.".format(customer or self.name, ", ".join(invoices)))
+
 	# ── Helper: Group items ──
 
 	def _group_items_by_customer_deal(self):
@@ -195,6 +398,7 @@ class VehicleDispatch(Document):
 				groups[key] = []
 			groups[key].append({
 				"row_name": row.name,
+				"deal_delivery": row.deal_delivery,
 				"customer_name": row.customer_name,
 				"soda": row.soda,
 				"deal_item": row.deal_item,
@@ -237,165 +441,111 @@ class VehicleDispatch(Document):
 
 	# ── Helper: Create Sales Invoice ──
 
-	def _create_sales_invoice(self, customer):
-		customer_items = [row for row in self.load_items if row.customer == customer]
-		if not customer_items:
+	def _create_sales_invoice(self, customer, rows):
+		if not rows:
 			frappe.throw("No items found for customer {0}".format(customer))
 
-		from trustbit_mandi.utils import get_mandi_company
-
-		company = get_mandi_company()
-
-		si = frappe.new_doc("Sales Invoice")
-		si.customer = customer
-		si.posting_date = self.dispatch_date
-		si.due_date = self.dispatch_date
-		si.company = company
-		si.update_stock = 0
-		si.set_posting_time = 1
-
-		# Set the billing address up front. india_compliance v16 added a
-		# before_validate hook on Sales Invoice that flags any new document whose
-		# caller left customer_address empty (_party_address_not_set), then later
-		# re-fetches GST details and REPLACES the taxes table after ERPNext has
-		# already computed totals — leaving tax rows with no computed amount, which
-		# its new validate_item_tax_template() rejects. Populating the address here
-		# means the flag is never set and that path never runs. Harmless on v15 and
-		# on sites without india_compliance: it is the address ERPNext would have
-		# resolved anyway in set_missing_values().
-		from frappe.contacts.doctype.address.address import get_default_address
-
-		billing_address = get_default_address("Customer", customer)
-		if billing_address:
-			si.customer_address = billing_address
-
-		income_account = frappe.get_cached_value("Company", company, "default_income_account")
-		cost_center = frappe.get_cached_value("Company", company, "cost_center")
-
-		for row in customer_items:
-			qty_kg = flt(row.qty) * flt(row.pack_weight_kg)
-			amount = flt(row.amount)
-			rate_per_kg = amount / qty_kg if qty_kg else 0
-
-			si_item = {
-				"item_code": row.item,
-				"qty": flt(qty_kg, 3),
-				"uom": "Kg",
-				"rate": flt(rate_per_kg, 4),
-				"amount": amount,
-				"description": "{0} - {1} x {2} packs".format(
-					row.item, row.pack_size, int(row.qty)),
-			}
-			if income_account:
-				si_item["income_account"] = income_account
-			if cost_center:
-				si_item["cost_center"] = cost_center
-
-			si.append("items", si_item)
-
-		si.insert(ignore_permissions=True)
-		si.submit()
-
-		frappe.msgprint(
-			"Sales Invoice {0} created for {1}.".format(
-				'<a href="/app/sales-invoice/{0}">{0}</a>'.format(si.name),
-				customer),
-			indicator="green", alert=True)
-		return si
+		return make_sales_invoice(customer, self.dispatch_date, rows)
+
+	def post_sales_invoice(self, customer):
+		"""Create and link the customer's Sales Invoice; run by the ERP outbox worker."""
+		rows = [row for row in self.load_items if row.customer == customer and not row.returned]
+		if not rows:
+			return None
+		for row in rows:
+			if row.sales_invoice:
+				return row.sales_invoice
+
+		si = self._create_sales_invoice(customer, rows)
+		for row in rows:
+			self._set_row_link(row, "sales_invoice", si.name)
+		for row in self.customer_payments:
+			if row.customer == customer and not row.sales_invoice:
+				self._set_row_link(row, "sales_invoice", si.name)
+		self._flush_row_links()
+		return si.name
+
+	def post_payment_entry(self, row_name):
+		"""Create and link the Payment Entry of a customer payment row; run by the ERP outbox worker."""
+		row = next((row for row in self.customer_payments if row.name == row_name), None)
+		if not row or flt(row.paying_amount) <= 0:
+			return None
+		if row.payment_entry:
+			return row.payment_entry
+		if not row.sales_invoice:
+			frappe.throw("Sales Invoice for {0} on {1} is not posted yet.".format(
+				row.customer_name or row.customer, self.name))
+
+		pe = self._create_payment_entry(row, row.sales_invoice)
+		self._set_row_link(row, "payment_entry", pe.name)
+		self._flush_row_links()
+		return pe.name
 
 	# ── Helper: Create Payment Entry ──
 
 	def _create_payment_entry(self, payment_row, si_name):
-		try:
-			from erpnext.accounts.doctype.payment_entry.payment_entry import get_payment_entry
+		from erpnext.accounts.doctype.payment_entry.payment_entry import get_payment_entry
 
-			pe = get_payment_entry("Sales Invoice", si_name)
-			pe.paid_amount = flt(payment_row.paying_amount)
-			pe.received_amount = flt(payment_row.paying_amount)
-			pe.mode_of_payment = payment_row.payment_mode or "Cash"
-			pe.reference_no = payment_row.reference or self.name
-			pe.reference_date = self.dispatch_date
+		erp = get_active_erp_context() or MandiErpContext()
+		mode_of_payment = payment_row.payment_mode or "Cash"
 
-			if pe.references:
-				pe.references[0].allocated_amount = flt(payment_row.paying_amount)
+		# Passing the company's bank/cash account, resolved once per context,
+		# spares get_payment_entry the same lookup for every row.
+		pe = get_payment_entry("Sales Invoice", si_name, bank_account=erp.get_payment_account() or None)
+		pe.paid_amount = flt(payment_row.paying_amount)
+		pe.received_amount = flt(payment_row.paying_amount)
+		pe.mode_of_payment = mode_of_payment
+		pe.reference_no = payment_row.reference or self.name
+		pe.reference_date = self.dispatch_date
 
-			pe.insert(ignore_permissions=True)
-			pe.submit()
+		if pe.references:
+			pe.references[0].allocated_amount = flt(payment_row.paying_amount)
 
-			frappe.msgprint(
-				"Payment Entry {0} created for {1}.".format(
-					'<a href="/app/payment-entry/{0}">{0}</a>'.format(pe.name),
-					payment_row.customer_name or payment_row.customer),
-				indicator="green", alert=True)
-			return pe
-		except Exception as e:
-			frappe.log_error(
-				title="Payment Entry creation failed for {0}".format(payment_row.customer),
-				message=str(e))
-			frappe.msgprint(
-				"Warning: Could not create Payment Entry for {0}. Error: {1}".format(
-					payment_row.customer_name or payment_row.customer, str(e)),
-				indicator="orange", alert=True)
-			return None
+		pe.insert(ignore_permissions=True)
+		pe.submit()
+		return pe
 
 	# ── Cancel helpers ──
 
-	def _cancel_payment_entries(self):
-		for row in self.customer_payments:
-			pe_name = frappe.db.get_value(
-				"Vehicle Dispatch Customer Payment",
-				row.name, "payment_entry")
-			if pe_name:
-				try:
-					pe = frappe.get_doc("Payment Entry", pe_name)
-					if pe.docstatus == 1:
-						pe.cancel()
-						frappe.msgprint(
-							"Payment Entry {0} cancelled.".format(pe_name),
-							indicator="orange", alert=True)
-				except Exception as e:
-					frappe.log_error(
-						title="Failed to cancel PE {0}".format(pe_name),
-						message=str(e))
-					frappe.msgprint(
-						"Warning: Could not cancel Payment Entry {0}. Error: {1}".format(
-							pe_name, str(e)),
-						indicator="red", alert=True)
+	def _cancel_payment_entries(self, posted=()):
+		pe_names = frappe.get_all(
+			"Vehicle Dispatch Customer Payment",
+			filters={
+				"parent": self.name,
+				"parenttype": "Vehicle Dispatch",
+				"payment_entry": ["is", "set"]
+			},
+			pluck="payment_entry",
+			order_by="idx asc"
+		)
+		pe_names += [name for name in posted if name not in pe_names]
 
-	def _cancel_sales_invoices(self):
-		si_names = set()
-		for row in self.customer_payments:
-			si_name = frappe.db.get_value(
-				"Vehicle Dispatch Customer Payment",
-				row.name, "sales_invoice")
-			if si_name:
-				si_names.add(si_name)
+		self._cancel_documents("Payment Entry", pe_names, "Payment Entry", "PE")
 
-		for si_name in si_names:
-			try:
-				si = frappe.get_doc("Sales Invoice", si_name)
-				if si.docstatus == 1:
-					si.cancel()
-					frappe.msgprint(
-						"Sales Invoice {0} cancelled.".format(si_name),
-						indicator="orange", alert=True)
-			except Exception as e:
-				frappe.log_error(
-					title="Failed to cancel SI {0}".format(si_name),
-					message=str(e))
-				frappe.msgprint(
-					"Warning: Could not cancel Sales Invoice {0}. Error: {1}".format(
-						si_name, str(e)),
-					indicator="red", alert=True)
+	def _cancel_sales_invoices(self, posted=()):
+		si_names = set(frappe.db.sql_list("""
+			SELECT sales_invoice FROM `tabVehicle Dispatch Customer Payment`
+			WHERE parent = %(name)s AND parenttype = 'Vehicle Dispatch'
+				AND IFNULL(sales_invoice, '') != ''
+			UNION
+			SELECT sales_invoice FROM `tabVehicle Dispatch Load Item`
+			WHERE parent = %(name)s AND parenttype = 'Vehicle Dispatch'
+				AND IFNULL(sales_invoice, '') != ''
+		""", {"name": self.name}))
+		si_names.update(posted)
+
+		self._cancel_documents("Sales Invoice", si_names, "Sales Invoice", "SI")
 
 	def _cancel_deal_deliveries(self):
-		dd_names = set()
-		for row in self.load_items:
-			dd_name = frappe.db.get_value(
-				"Vehicle Dispatch Load Item",
-				row.name, "deal_delivery")
-			if dd_name:
-				dd_names.add(dd_name)
+		dd_names = set(frappe.get_all(
+			"Vehicle Dispatch Load Item",
+			filters={
+				"parent": self.name,
+				"parenttype": "Vehicle Dispatch",
+				"deal_delivery": ["is", "set"]
+			},
+			pluck="deal_delivery"
+		))
 
 		auto_dds = frappe.get_all(
 			"Deal Delivery",
@@ -408,54 +558,328 @@ class VehicleDispatch(Document):
 		)
 		dd_names.update(auto_dds)
 
-		for dd_name in dd_names:
+		self._cancel_documents("Deal Delivery", dd_names, "Delivery", "DD")
+
+	def _cancel_documents(self, doctype, names, label, short_label, raise_exception=False):
+		for name in names:
 			try:
-				dd = frappe.get_doc("Deal Delivery", dd_name)
-				if dd.docstatus == 1:
-					dd.cancel()
+				doc = frappe.get_doc(doctype, name)
+				if doc.docstatus == 1:
+					doc.cancel()
 					frappe.msgprint(
-						"Delivery {0} cancelled.".format(dd_name),
+						"{0} {1} cancelled.".format(label, name),
 						indicator="orange", alert=True)
 			except Exception as e:
+				if raise_exception:
+					raise
 				frappe.log_error(
-					title="Failed to cancel DD {0}".format(dd_name),
+					title="Failed to cancel {0} {1}".format(short_label, name),
 					message=str(e))
 				frappe.msgprint(
-					"Warning: Could not cancel Delivery {0}. Error: {1}".format(
-						dd_name, str(e)),
+					"Warning: Could not cancel {0} {1}. Error: {2}".format(
+						label, name, str(e)),
 					indicator="red", alert=True)
 
 
+def make_sales_invoice(customer, posting_date, lines, remarks=None):
+	"""Create and submit a Sales Invoice for `customer` with one KG line per load line.
+
+	`lines` are load items or dicts with the same item, pack_size, qty,
+	pack_weight_kg and amount fields.
+	"""
+	erp = get_active_erp_context() or MandiErpContext([customer])
+	company = erp.company
+
+	si = frappe.new_doc("Sales Invoice")
+	si.customer = customer
+	si.posting_date = posting_date
+	si.due_date = posting_date
+	si.company = company
+	si.update_stock = 0
+	si.set_posting_time = 1
+
+	# Set the billing address up front. india_compliance v16 added a
+	# before_validate hook on Sales Invoice that flags any new document whose
+	# caller left customer_address empty (_party_address_not_set), then later
+	# re-fetches GST details and REPLACES the taxes table after ERPNext has
+	# already computed totals — leaving tax rows with no computed amount, which
+	# its new validate_item_tax_template() rejects. Populating the address here
+	# means the flag is never set and that path never runs. Harmless on v15 and
+	# on sites without india_compliance: it is the address ERPNext would have
+	# resolved anyway in set_missing_values().
+	billing_address = erp.get_address(customer)
+	if billing_address:
+		si.customer_address = billing_address
+
+	income_account = erp.income_account
+	cost_center = erp.cost_center
+
+	for row in lines:
+		qty_kg = flt(row.qty) * flt(row.pack_weight_kg)
+		amount = flt(row.amount)
+		rate_per_kg = amount / qty_kg if qty_kg else 0
+
+		si_item = {
+			"item_code": row.item,
+			"qty": flt(qty_kg, 3),
+			"uom": erp.kg_uom,
+			"rate": flt(rate_per_kg, 4),
+			"amount": amount,
+			"description": "{0} - {1} x {2} packs".format(
+				row.item, row.pack_size, int(row.qty)),
+		}
+		if income_account:
+			si_item["income_account"] = income_account
+		if cost_center:
+			si_item["cost_center"] = cost_center
+
+		si.append("items", si_item)
+
+	if remarks:
+		si.remarks = remarks
+
+	si.insert(ignore_permissions=True)
+	si.submit()
+	return si
+
+
+def get_load_item_groups(load_items, by_deal=False):
+	"""Group load rows per customer (or customer + deal) with a signature of their contents.
+
+	Two groups with the same signature produce the same Deal Delivery or
+	Sales Invoice, which is what lets an amendment keep it.
+	"""
+	groups = {}
+	for row in load_items:
+		if not row.customer or row.returned or (by_deal and not row.soda):
+			continue
+		key = (row.customer, row.soda) if by_deal else row.customer
+		group = groups.setdefault(key, frappe._dict(
+			rows=[], signature=[], deal_delivery=None, sales_invoice=None))
+		group.rows.append(row)
+		group.signature.append((
+			row.soda or "", row.deal_item or "", row.item, row.pack_size,
+			flt(row.pack_weight_kg), flt(row.qty), flt(row.rate), flt(row.bag_cost), flt(row.amount),
+		))
+		group.deal_delivery = group.deal_delivery or row.deal_delivery
+		group.sales_invoice = group.sales_invoice or row.sales_invoice
+
+	for group in groups.values():
+		group.signature = tuple(sorted(group.signature))
+	return groups
+
+
+def get_payment_signature(row):
+	return (row.customer, flt(row.paying_amount), row.payment_mode or "", row.reference or "")
+
+
+# ── Amendment ──
+
+@frappe.whitelist()
+def amend_incrementally(name):
+	"""Cancel a dispatch for amendment without cancelling its documents.
+
+	Returns the amended draft. On its submit, documents of unchanged groups
+	are carried forward and only the changed ones are cancelled and recreated.
+	"""
+	doc = frappe.get_doc("Vehicle Dispatch", name)
+	doc.check_permission("cancel")
+	if doc.docstatus != 1 or doc.status != "Dispatched":
+		frappe.throw("Only a dispatched Vehicle Dispatch can be amended incrementally.")
+
+	doc.flags.keep_linked_documents = True
+	# Its deliveries stay submitted and still link here until the amendment is submitted
+	doc.flags.ignore_links = True
+	doc.cancel()
+
+	amended = frappe.copy_doc(doc)
+	# Goods already returned are not part of the load any more
+	returned = {row.customer for row in doc.load_items if row.returned}
+	amended.load_items = [row for row in amended.load_items if row.customer not in returned]
+	amended.customer_payments = [
+		row for row in amended.customer_payments if row.customer not in returned]
+	amended.amended_from = doc.name
+	amended.status = "Loading"
+	amended.insert()
+	return amended.name
+
+
+@frappe.whitelist()
+def cancel_pending_amendment_documents(name):
+	"""Cancel the documents an incremental amendment left open, when no amendment will follow."""
+	doc = frappe.get_doc("Vehicle Dispatch", name)
+	doc.check_permission("cancel")
+	if doc.docstatus != 2 or not doc.amendment_pending:
+		frappe.throw("Vehicle Dispatch {0} has no documents awaiting an amendment.".format(name))
+
+	doc._cancel_payment_entries()
+	doc._cancel_sales_invoices()
+	doc._cancel_deal_deliveries()
+	doc.db_set("amendment_pending", 0)
+
+
+# ── Customer return ──
+
+@frappe.whitelist()
+def return_customer(name, customer):
+	"""Reverse one customer's part of a dispatched truck.
+
+	Cancels that customer's Payment Entries, Sales Invoice and Deal
+	Deliveries (whose cancel reverses the stock entries and delivered
+	quantities) and marks the load rows returned. Other customers'
+	documents, stock and GL are left alone.
+	"""
+	doc = frappe.get_doc("Vehicle Dispatch", name)
+	doc.check_permission("cancel")
+	if doc.docstatus != 1 or doc.status != "Dispatched":
+		frappe.throw("Goods can only be returned on a dispatched Vehicle Dispatch.")
+
+	rows = [row for row in doc.load_items if row.customer == customer and not row.returned]
+	if not rows:
+		frappe.throw("No dispatched items of customer {0} on {1}.".format(customer, name))
+	doc.validate_consolidated_invoices(customer)
+
+	payment_rows = [row for row in doc.customer_payments if row.customer == customer]
+	posted = cancel_erp_documents(doc.doctype, doc.name, [customer] + [row.name for row in payment_rows])
+	pe_names = [row.payment_entry for row in payment_rows if row.payment_entry]
+	pe_names += [name for name in posted.get("Payment Entry", []) if name not in pe_names]
+	si_names = {row.sales_invoice for row in rows + payment_rows if row.sales_invoice}
+	si_names.update(posted.get("Sales Invoice", []))
+	dd_names = {row.deal_delivery for row in rows if row.deal_delivery}
+
+	customer_name = rows[0].customer_name or customer
+	frappe.publish_progress(10, title="Returning Goods...",
+		description="Cancelling payments of {0}...".format(customer_name))
+	doc._cancel_documents("Payment Entry", pe_names, "Payment Entry", "PE", raise_exception=True)
+
+	frappe.publish_progress(40, title="Returning Goods...",
+		description="Cancelling invoice of {0}...".format(customer_name))
+	doc._cancel_documents("Sales Invoice", si_names, "Sales Invoice", "SI", raise_exception=True)
+
+	frappe.publish_progress(70, title="Returning Goods...",
+		description="Cancelling deliveries and restoring stock for {0}...".format(customer_name))
+	doc._cancel_documents("Deal Delivery", dd_names, "Delivery", "DD", raise_exception=True)
+
+	frappe.db.sql("""
+		UPDATE `tabVehicle Dispatch Load Item`
+		SET returned = 1
+		WHERE name IN %(rows)s
+	""", {"rows": tuple(row.name for row in rows)})
+
+	doc.add_comment("Info", "Goods of {0} returned: {1} cancelled.".format(
+		customer_name, ", ".join(sorted(pe_names) + sorted(si_names) + sorted(dd_names)) or "no documents"))
+	frappe.publish_progress(100, title="Goods Returned",
+		description="Documents of {0} cancelled.".format(customer_name))
+
+
+# ── Background dispatch ──
+
+def enqueue_dispatch(name):
+	frappe.enqueue(
+		"trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch.process_dispatch",
+		queue="long",
+		timeout=3600,
+		job_id="vehicle_dispatch::{0}".format(name),
+		deduplicate=True,
+		enqueue_after_commit=True,
+		name=name,
+	)
+
+
+def process_dispatch(name):
+	"""Background job: create a submitted dispatch's documents, resuming past completed steps."""
+	doc = frappe.get_doc("Vehicle Dispatch", name)
+	if doc.docstatus != 1 or doc.status not in BACKGROUND_STATUSES:
+		return
+
+	doc.db_set("status", "Processing", notify=True)
+	frappe.db.commit()
+
+	try:
+		doc.create_dispatch_documents(commit=True)
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title="Vehicle Dispatch {0} failed".format(name))
+		doc.db_set("status", "Failed", notify=True)
+		frappe.db.commit()
+		return
+
+	doc.db_set("status", "Dispatched", notify=True)
+	frappe.db.commit()
+
+
+@frappe.whitelist()
+def retry_dispatch(name):
+	"""Re-queue a background dispatch that failed; completed steps are not repeated."""
+	doc = frappe.get_doc("Vehicle Dispatch", name)
+	doc.check_permission("submit")
+	if doc.docstatus != 1 or doc.status != "Failed":
+		frappe.throw("Only a submitted dispatch whose background processing failed can be retried.")
+
+	doc.db_set("status", "Queued", notify=True)
+	enqueue_dispatch(doc.name)
+
+
 # ── Whitelisted APIs ──
 
 @frappe.whitelist()
-def get_pending_items_for_dispatch(price_list_area=None, customer=None):
-	"""Get pending Deal Items for VD dialog, filterable by area and/or customer."""
+def get_pending_items_for_dispatch(price_list_area=None, customer=None, item=None, pack_size=None,
+		after=None, page_length=None):
+	"""Get pending Deal Items for VD dialog, filterable by area and/or customer, item and pack size.
+
+	Lines with 0.1 KG or less left are dropped in the query itself. Rows come
+	in (customer, soda_date, deal creation, deal, idx) order, each with a
+	`cursor`; with `page_length`, one page is returned and the last row's
+	cursor, passed back as `after`, fetches the next.
+	"""
 	if not price_list_area and not customer:
 		frappe.throw("Please select an Area or Customer.")
 
-	conditions = [
-		"d.status IN ('Open', 'Confirmed', 'Partially Delivered')",
-		"di.item_status IN ('Open', 'Partially Delivered')"
+	deal_conditions = ["d.status IN ('Open', 'Confirmed', 'Partially Delivered')"]
+	item_conditions = [
+		"di.item_status IN ('Open', 'Partially Delivered')",
+		"di.qty * di.pack_weight_kg - COALESCE(dl.delivered_kg, 0) > 0.1",
 	]
-	values = []
+	values = {}
 
 	if customer:
-		conditions.append("d.customer = %s")
-		values.append(customer)
+		deal_conditions.append("d.customer = %(customer)s")
+		values["customer"] = customer
 
 	if price_list_area:
-		conditions.append("d.price_list_area = %s")
-		values.append(price_list_area)
-
-	rows = frappe.db.sql("""
-		SELECT
+		deal_conditions.append("d.price_list_area = %(price_list_area)s")
+		values["price_list_area"] = price_list_area
+
+	if item:
+		item_conditions.append("di.item = %(item)s")
+		values["item"] = item
+
+	if pack_size:
+		item_conditions.append("di.pack_size = %(pack_size)s")
+		values["pack_size"] = pack_size
+
+	if after:
+		after = frappe.parse_json(after)
+		item_conditions.append(
+			"(d.customer, d.soda_date, d.creation, d.name, di.idx)"
+			" > (%(after_customer)s, %(after_soda_date)s, %(after_creation)s, %(after_deal)s, %(after_idx)s)")
+		values.update({
+			"after_customer": after.get("customer"),
+			"after_soda_date": after.get("soda_date"),
+			"after_creation": after.get("creation"),
+			"after_deal": after.get("deal"),
+			"after_idx": cint(after.get("idx")),
+		})
+
+	rows = get_pending_deal_item_rows("""
 			d.name as deal_name,
 			d.soda_date,
+			d.creation as deal_creation,
 			d.customer,
 			d.customer_name,
 			d.price_list_area,
 			di.name as deal_item_name,
+			di.idx as deal_item_idx,
 			di.item,
 			di.item_name,
 			di.pack_size,
@@ -464,28 +888,30 @@ def get_pending_items_for_dispatch(price_list_area=None, customer=None):
 			di.rate,
 			di.price_per_kg,
 			di.base_price_50kg,
-			di.bag_cost
-		FROM `tabDeal Item` di
-		INNER JOIN `tabDeal` d ON d.name = di.parent
-		WHERE {conditions}
-		ORDER BY d.customer ASC, d.soda_date ASC, d.creation ASC, di.idx ASC
-	""".format(conditions=" AND ".join(conditions)), values, as_dict=True)
-
-	result = []
+			di.bag_cost""",
+		deal_conditions, item_conditions, values,
+		order_by="d.customer ASC, d.soda_date ASC, d.creation ASC, d.name ASC, di.idx ASC",
+		limit=cint(page_length) or None)
+
 	for row in rows:
 		booked_kg = flt(row.qty) * flt(row.pack_weight_kg)
-		other_delivered_kg = get_other_delivered_kg_for_item(
-			row.deal_name, row.deal_item_name)
-		pending_kg = booked_kg - flt(other_delivered_kg)
-
-		if pending_kg > 0.1:
-			row['booked_kg'] = booked_kg
-			row['delivered_kg'] = flt(other_delivered_kg)
-			row['pending_kg'] = pending_kg
-			if flt(row.pack_weight_kg) > 0:
-				row['pending_packs'] = pending_kg / flt(row.pack_weight_kg)
-			else:
-				row['pending_packs'] = 0
-			result.append(row)
-
-	return result
+		other_delivered_kg = flt(row.pop("dlv_kg"))
+		row.pop("dlv_qty")
+		pending_kg = booked_kg - other_delivered_kg
+
+		row['booked_kg'] = booked_kg
+		row['delivered_kg'] = other_delivered_kg
+		row['pending_kg'] = pending_kg
+		if flt(row.pack_weight_kg) > 0:
+			row['pending_packs'] = pending_kg / flt(row.pack_weight_kg)
+		else:
+			row['pending_packs'] = 0
+		row['cursor'] = {
+			"customer": row.customer,
+			"soda_date": str(row.soda_date),
+			"creation": str(row.pop("deal_creation")),
+			"deal": row.deal_name,
+			"idx": row.pop("deal_item_idx"),
+		}
+
+	return rows
@@ -1,9 +1,19 @@
 frappe.listview_settings['Vehicle Dispatch'] = {
 	has_indicator_for_draft: true,
 	has_indicator_for_cancelled: true,
+	add_fields: ['status'],
+	onload: function(listview) {
+		listview.page.add_inner_button(__('Plan Fleet'), function() {
+			plan_fleet_dialog(listview);
+		});
+	},
 	get_indicator: function(doc) {
 		if (doc.docstatus === 0) {
 			return [__('Loading'), 'orange', 'docstatus,=,0'];
+		} else if (doc.docstatus === 1 && ['Queued', 'Processing'].includes(doc.status)) {
+			return [__(doc.status), 'yellow', 'status,=,' + doc.status];
+		} else if (doc.docstatus === 1 && doc.status === 'Failed') {
+			return [__('Failed'), 'red', 'status,=,Failed'];
 		} else if (doc.docstatus === 1) {
 			return [__('Dispatched'), 'blue', 'docstatus,=,1'];
 		} else if (doc.docstatus === 2) {
@@ -11,3 +21,56 @@ frappe.listview_settings['Vehicle Dispatch'] = {
 		}
 	}
 };
+
+function plan_fleet_dialog(listview) {
+	let d = new frappe.ui.Dialog({
+		title: __('Plan Fleet for an Area'),
+		fields: [
+			{
+				fieldtype: 'Link',
+				fieldname: 'price_list_area',
+				label: __('Area'),
+				options: 'Deal Price List Area',
+				reqd: 1
+			},
+			{
+				fieldtype: 'Date',
+				fieldname: 'dispatch_date',
+				label: __('Dispatch Date'),
+				default: frappe.datetime.get_today(),
+				reqd: 1
+			},
+			{
+				fieldtype: 'MultiSelectList',
+				fieldname: 'vehicles',
+				label: __('Vehicles'),
+				description: __('Leave empty to use every active vehicle'),
+				get_data: function(txt) {
+					return frappe.db.get_link_options('Vehicle Master', txt, { is_active: 1 });
+				}
+			}
+		],
+		primary_action_label: __('Create Draft Dispatches'),
+		primary_action: function(values) {
+			d.hide();
+			frappe.call({
+				method: 'trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.load_planner.create_fleet_dispatches',
+				args: values,
+				freeze: true,
+				freeze_message: __('Planning vehicles...'),
+				callback: function(r) {
+					if (!r.message) return;
+					let lines = r.message.map(function(vd) {
+						return __('{0}: {1} / {2} KG, {3} customer(s)', [
+							'<a href="/app/vehicle-dispatch/' + vd.name + '">' + vd.name + '</a> (' + vd.vehicle + ')',
+							vd.loaded_kg, vd.capacity_kg, vd.customers
+						]);
+					});
+					frappe.msgprint(lines.join('<br>'), __('Draft Dispatches Created'));
+					listview.refresh();
+				}
+			});
+		}
+	});
+	d.show();
+}
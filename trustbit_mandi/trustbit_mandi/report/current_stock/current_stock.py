@@ -1,5 +1,7 @@
 import frappe
-from frappe.utils import flt, getdate, add_days
+from frappe.utils import add_days, flt, getdate
+
+from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_closing.mandi_stock_closing import get_stock_as_of
 
 
 def execute(filters=None):
@@ -42,20 +44,14 @@ def get_data(filters):
 		values["pack_size"] = pack_size
 
 	if from_date and to_date:
-		# With date range: opening = balance before from_date, movements within range
+		# With date range: opening = balance before from_date, movements within range.
+		# The opening starts from the latest Mandi Stock Closing, so only the
+		# entries since that closing and those in the range are read.
 		opening_date = add_days(getdate(from_date), -1)
 		values["from_date"] = from_date
 		values["to_date"] = to_date
-		values["opening_date"] = str(opening_date)
-
-		# Get all item+pack_size combos that have any movement
-		item_filter = ""
-		if item:
-			item_filter += " AND msei.item = %(item)s"
-		if pack_size:
-			item_filter += " AND msei.pack_size = %(pack_size)s"
 
-		data = frappe.db.sql(
+		movements = frappe.db.sql(
 			"""
 			SELECT
 				msei.item,
@@ -63,38 +59,62 @@ def get_data(filters):
 				msei.pack_size,
 				MAX(msei.pack_weight_kg) as pack_weight_kg,
 
-				COALESCE(SUM(CASE WHEN mse.posting_date <= %(opening_date)s THEN
-					CASE WHEN mse.entry_type IN ('Opening Stock', 'Receipt', 'Adjustment (Increase)')
-						THEN msei.qty ELSE -msei.qty END
-					ELSE 0 END), 0) as opening,
-
-				COALESCE(SUM(CASE WHEN mse.posting_date BETWEEN %(from_date)s AND %(to_date)s
-					AND mse.entry_type = 'Receipt' THEN msei.qty ELSE 0 END), 0) as received,
+				COALESCE(SUM(CASE WHEN mse.entry_type = 'Receipt'
+					THEN msei.qty ELSE 0 END), 0) as received,
 
-				COALESCE(SUM(CASE WHEN mse.posting_date BETWEEN %(from_date)s AND %(to_date)s
-					AND mse.entry_type = 'Issue' THEN msei.qty ELSE 0 END), 0) as issued,
+				COALESCE(SUM(CASE WHEN mse.entry_type = 'Issue'
+					THEN msei.qty ELSE 0 END), 0) as issued,
 
-				COALESCE(SUM(CASE WHEN mse.posting_date BETWEEN %(from_date)s AND %(to_date)s
-					AND mse.entry_type IN ('Adjustment (Increase)', 'Adjustment (Decrease)') THEN
+				COALESCE(SUM(CASE WHEN mse.entry_type IN ('Adjustment (Increase)', 'Adjustment (Decrease)') THEN
 					CASE WHEN mse.entry_type = 'Adjustment (Increase)' THEN msei.qty ELSE -msei.qty END
 					ELSE 0 END), 0) as adjusted,
 
-				COALESCE(SUM(CASE WHEN mse.posting_date <= %(to_date)s THEN
+				COALESCE(SUM(
 					CASE WHEN mse.entry_type IN ('Opening Stock', 'Receipt', 'Adjustment (Increase)')
 						THEN msei.qty ELSE -msei.qty END
-					ELSE 0 END), 0) as balance_qty
+				), 0) as net_qty
 
 			FROM `tabMandi Stock Entry Item` msei
 			INNER JOIN `tabMandi Stock Entry` mse ON mse.name = msei.parent
-			WHERE mse.docstatus = 1 {item_filter}
+			WHERE {conditions} AND mse.posting_date BETWEEN %(from_date)s AND %(to_date)s
 			GROUP BY msei.item, msei.pack_size
-			ORDER BY msei.item ASC, MAX(msei.pack_weight_kg) ASC
 		""".format(
-				item_filter=item_filter
+				conditions=" AND ".join(conditions)
 			),
 			values,
 			as_dict=True,
 		)
+
+		rows = {}
+		for key, balance in get_stock_as_of(opening_date, item, pack_size).items():
+			rows[key] = frappe._dict(
+				item=balance.item,
+				item_name=balance.item_name,
+				pack_size=balance.pack_size,
+				pack_weight_kg=balance.pack_weight_kg,
+				opening=balance.qty,
+				received=0,
+				issued=0,
+				adjusted=0,
+				balance_qty=balance.qty,
+			)
+		for movement in movements:
+			row = rows.setdefault((movement.item, movement.pack_size), frappe._dict(
+				item=movement.item,
+				item_name=movement.item_name,
+				pack_size=movement.pack_size,
+				pack_weight_kg=flt(movement.pack_weight_kg),
+				opening=0,
+				balance_qty=0,
+			))
+			row.item_name = row.item_name or movement.item_name
+			row.pack_weight_kg = max(flt(row.pack_weight_kg), flt(movement.pack_weight_kg))
+			row.received = flt(movement.received)
+			row.issued = flt(movement.issued)
+			row.adjusted = flt(movement.adjusted)
+			row.balance_qty = flt(row.opening) + flt(movement.net_qty)
+
+		data = sorted(rows.values(), key=lambda row: (row.item or "", flt(row.pack_weight_kg)))
 	else:
 		# No date range: show all-time balance
 		date_filter = ""
@@ -73,13 +73,10 @@ def get_data(filters):
 			s.price_list_area, di.qty, di.rate, di.amount,
 			di.delivered_qty, di.pending_qty, di.item_status,
 			s.status,
-			(SELECT MAX(sd.delivery_date)
-			 FROM `tabDeal Delivery Item` sdi
-			 INNER JOIN `tabDeal Delivery` sd ON sd.name = sdi.parent
-			 WHERE sdi.soda = s.name AND sdi.deal_item = di.name
-			   AND sd.docstatus = 1) as last_delivery_date
+			dl.last_delivery_date
 		FROM `tabDeal` s
 		INNER JOIN `tabDeal Item` di ON di.parent = s.name
+		LEFT JOIN `tabDeal Item Delivery Ledger` dl ON dl.name = di.name
 		WHERE {conditions}
 		ORDER BY s.soda_date ASC, s.creation ASC, di.idx ASC
 	""".format(conditions=" AND ".join(conditions))
@@ -0,0 +1,29 @@
+frappe.query_reports["Mandi Step Timing Report"] = {
+	"filters": [
+		{
+			"fieldname": "from_date",
+			"label": __("From Date"),
+			"fieldtype": "Date",
+			"default": frappe.datetime.add_days(frappe.datetime.get_today(), -7)
+		},
+		{
+			"fieldname": "to_date",
+			"label": __("To Date"),
+			"fieldtype": "Date",
+			"default": frappe.datetime.get_today()
+		},
+		{
+			"fieldname": "reference_doctype",
+			"label": __("Document Type"),
+			"fieldtype": "Select",
+			"options": "\nVehicle Dispatch\nDeal Delivery\nMandi Stock Entry"
+		},
+		{
+			"fieldname": "group_by",
+			"label": __("Group By"),
+			"fieldtype": "Select",
+			"options": "Stage\nStage and Day",
+			"default": "Stage"
+		}
+	]
+};
@@ -0,0 +1,85 @@
+import frappe
+from frappe.utils import add_days, flt, getdate, nowdate
+
+
+def execute(filters=None):
+	filters = frappe._dict(filters or {})
+	by_day = filters.get("group_by") == "Stage and Day"
+	columns = get_columns(by_day)
+	data = get_data(filters, by_day)
+	return columns, data
+
+
+def get_columns(by_day):
+	columns = []
+	if by_day:
+		columns.append({"fieldname": "day", "label": "Day", "fieldtype": "Date", "width": 100})
+	columns += [
+		{"fieldname": "reference_doctype", "label": "Document Type", "fieldtype": "Link", "options": "DocType", "width": 140},
+		{"fieldname": "stage", "label": "Stage", "fieldtype": "Data", "width": 180},
+		{"fieldname": "count", "label": "Runs", "fieldtype": "Int", "width": 70},
+		{"fieldname": "avg_ms", "label": "Avg (ms)", "fieldtype": "Float", "precision": 1, "width": 90},
+		{"fieldname": "p50_ms", "label": "p50 (ms)", "fieldtype": "Float", "precision": 1, "width": 90},
+		{"fieldname": "p95_ms", "label": "p95 (ms)", "fieldtype": "Float", "precision": 1, "width": 90},
+		{"fieldname": "max_ms", "label": "Max (ms)", "fieldtype": "Float", "precision": 1, "width": 90},
+		{"fieldname": "avg_sql", "label": "Avg SQL", "fieldtype": "Float", "precision": 1, "width": 80},
+		{"fieldname": "max_sql", "label": "Max SQL", "fieldtype": "Int", "width": 80},
+	]
+	return columns
+
+
+def percentile(sorted_values, pct):
+	"""Nearest-rank percentile of an ascending list."""
+	if not sorted_values:
+		return 0
+	rank = max(int(-(-pct * len(sorted_values) // 100)), 1)
+	return sorted_values[rank - 1]
+
+
+def get_data(filters, by_day):
+	from_date = getdate(filters.get("from_date") or add_days(nowdate(), -7))
+	to_date = getdate(filters.get("to_date") or nowdate())
+
+	conditions = ["started_at >= %(from_date)s", "started_at < %(to_date)s"]
+	values = {"from_date": from_date, "to_date": add_days(to_date, 1)}
+	if filters.get("reference_doctype"):
+		conditions.append("reference_doctype = %(reference_doctype)s")
+		values["reference_doctype"] = filters.reference_doctype
+
+	rows = frappe.db.sql(
+		"""
+		SELECT DATE(started_at) as day, reference_doctype, stage, duration_ms, sql_count
+		FROM `tabMandi Step Timing`
+		WHERE {conditions}
+		ORDER BY duration_ms ASC
+	""".format(conditions=" AND ".join(conditions)),
+		values,
+		as_dict=True,
+	)
+
+	groups = {}
+	for row in rows:
+		key = (row.day if by_day else None, row.reference_doctype, row.stage)
+		groups.setdefault(key, []).append(row)
+
+	data = []
+	for (day, reference_doctype, stage), group in groups.items():
+		durations = [flt(r.duration_ms) for r in group]
+		sql_counts = [r.sql_count or 0 for r in group]
+		row = {
+			"reference_doctype": reference_doctype,
+			"stage": stage,
+			"count": len(group),
+			"avg_ms": sum(durations) / len(durations),
+			"p50_ms": percentile(durations, 50),
+			"p95_ms": percentile(durations, 95),
+			"max_ms": durations[-1],
+			"avg_sql": sum(sql_counts) / len(sql_counts),
+			"max_sql": max(sql_counts),
+		}
+		if by_day:
+			row["day"] = day
+		data.append(row)
+
+	data.sort(key=lambda r: (r.get("day") or from_date, r["reference_doctype"] or "", -r["p95_ms"]))
+	return data
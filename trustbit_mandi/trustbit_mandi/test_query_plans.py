@@ -0,0 +1,201 @@
+# Copyright (c) 2026, Trustbit Software and contributors
+# For license information, please see license.txt
+
+"""EXPLAIN checks for the app's hot queries.
+
+Every hot path (delivery, dispatch, stock, price and report reads) is run
+once with frappe.db.sql wrapped, and each SELECT it issued is EXPLAINed.
+None may read one of the indexed tables with a full scan (type=ALL).
+
+On a near-empty test site the optimizer would rightly scan, so setUpClass
+pads the indexed tables with rows that no hot path matches, commits them
+and refreshes the table statistics; tearDownClass removes them again.
+"""
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, add_months, nowdate
+
+from trustbit_mandi.trustbit_mandi.doctype.deal_delivery.deal_delivery import (
+	_get_pending_deal_items,
+	get_deals_for_delivery,
+	iter_pending_deal_items,
+)
+from trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.deal_item_delivery_ledger import (
+	get_delivered_totals,
+)
+from trustbit_mandi.trustbit_mandi.doctype.deal_item_delivery_ledger.test_deal_item_delivery_ledger import (
+	make_customer,
+	make_item,
+	make_pack_size,
+	make_price_list_area,
+)
+from trustbit_mandi.trustbit_mandi.doctype.deal_price_list.deal_price_list import (
+	get_all_prices_for_area,
+	get_latest_price,
+)
+from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_entry.mandi_stock_entry import (
+	get_current_stock,
+	get_stock_balance,
+)
+from trustbit_mandi.trustbit_mandi.doctype.vehicle_dispatch.vehicle_dispatch import (
+	get_pending_items_for_dispatch,
+)
+from trustbit_mandi.trustbit_mandi.report.current_stock import current_stock
+from trustbit_mandi.trustbit_mandi.report.deal_ledger import deal_ledger
+from trustbit_mandi.trustbit_mandi.report.mandi_all_in_one_report import mandi_all_in_one_report
+from trustbit_mandi.trustbit_mandi.report.mandi_purchase_report import mandi_purchase_report
+
+# Tables the hot-query indexes were added for
+INDEXED_TABLES = (
+	"tabDeal",
+	"tabDeal Item",
+	"tabDeal Delivery Item",
+	"tabDeal Price List",
+	"tabMandi Stock Entry Item",
+	"tabGrain Purchase",
+)
+PADDING_PREFIX = "_Test QP"
+PADDING_ROWS = 1000
+PADDING_DATE = "2000-01-01"
+
+
+class TestQueryPlans(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.customer = make_customer()
+		cls.item = make_item("_Test Mandi Ledger Item 1")
+		cls.pack_size = make_pack_size()
+		cls.area = make_price_list_area()
+		cls.deal = frappe.get_doc({
+			"doctype": "Deal",
+			"customer": cls.customer,
+			"price_list_area": cls.area,
+			"sales_type": "FOR",
+			"items": [{"item": cls.item, "pack_size": cls.pack_size, "pack_weight_kg": 50, "qty": 10, "rate": 1000}],
+		}).insert(ignore_permissions=True)
+		cls.price = frappe.get_doc({
+			"doctype": "Deal Price List",
+			"price_list_area": cls.area,
+			"item": cls.item,
+			"effective_datetime": frappe.utils.now_datetime(),
+			"is_active": 1,
+			"base_price_50kg": 1000,
+		}).insert(ignore_permissions=True)
+		insert_padding()
+		frappe.db.commit()
+		for table in INDEXED_TABLES:
+			frappe.db.sql(f"ANALYZE TABLE `{table}`")
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.rollback()
+		frappe.db.delete("Deal Item Delivery Ledger", {"deal": cls.deal.name})
+		frappe.delete_doc("Deal", cls.deal.name, force=True, ignore_permissions=True)
+		frappe.delete_doc("Deal Price List", cls.price.name, force=True, ignore_permissions=True)
+		for table in (*INDEXED_TABLES, "tabMandi Stock Entry"):
+			frappe.db.sql(f"DELETE FROM `{table}` WHERE name LIKE %s", PADDING_PREFIX + "%")
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def test_hot_queries_do_not_scan_indexed_tables(self):
+		deal_item = self.deal.items[0]
+		month = frappe._dict(from_date=add_months(nowdate(), -1), to_date=nowdate())
+		hot_paths = {
+			"Current Stock": lambda: get_current_stock(),
+			"Current Stock report": lambda: current_stock.execute(month),
+			"Deal Ledger report": lambda: deal_ledger.execute(month),
+			"Mandi Purchase Report": lambda: mandi_purchase_report.execute(month),
+			"Mandi All In One Report": lambda: mandi_all_in_one_report.execute(month),
+			"Pending items for dispatch": lambda: get_pending_items_for_dispatch(),
+			"Pending deal items": lambda: _get_pending_deal_items(self.customer),
+			"Pending deal items (paged)": lambda: next(
+				iter_pending_deal_items(self.customer, self.item, self.pack_size), None),
+			"Pending items for customer dispatch": lambda: get_pending_items_for_dispatch(customer=self.customer),
+			"Pending items for customer dispatch (paged)": lambda: get_pending_items_for_dispatch(
+				customer=self.customer, item=self.item, page_length=50),
+			"Deals for delivery": lambda: get_deals_for_delivery([self.deal.name]),
+			"Delivered totals": lambda: get_delivered_totals([deal_item.name]),
+			"Stock balance": lambda: get_stock_balance(self.item, self.pack_size),
+			"Latest price": lambda: get_latest_price(self.area, self.item),
+			"All prices for area": lambda: get_all_prices_for_area(self.area),
+		}
+
+		for label, run in hot_paths.items():
+			with self.subTest(path=label):
+				queries = capture_selects(run)
+				self.assertTrue(queries, f"{label} issued no SELECT")
+				for query, values in queries:
+					scans = get_full_scans(query, values)
+					tables = ", ".join(row.table for row in scans)
+					self.assertFalse(scans, f"{label} full-scans {tables}:\n{' '.join(query.split())}")
+
+
+def capture_selects(run):
+	"""Run `run` and return (query, values) for every SELECT it issued through frappe.db.sql."""
+	captured = []
+	original_sql = frappe.db.sql
+
+	def sql(query, values=(), *args, **kwargs):
+		captured.append((query, values))
+		return original_sql(query, values, *args, **kwargs)
+
+	with patch.object(frappe.local.db, "sql", sql):
+		run()
+	return [(query, values) for query, values in captured if query.lstrip().upper().startswith("SELECT")]
+
+
+def get_full_scans(query, values):
+	"""EXPLAIN rows for `query` that read a whole indexed table."""
+	return [
+		row for row in frappe.db.sql("EXPLAIN " + query, values, as_dict=True)
+		if (row.get("type") or "").upper() == "ALL" and row.get("table") in INDEXED_TABLES
+	]
+
+
+def insert_padding():
+	"""Bulk insert PADDING_ROWS cancelled or inactive rows per indexed table, all on unrelated customers and items."""
+	timestamp = frappe.utils.now()
+	user = "Administrator"
+	std = [timestamp, timestamp, user, user]
+	std_fields = ["creation", "modified", "owner", "modified_by"]
+	rows = range(PADDING_ROWS)
+
+	def pad(doctype, fields, values):
+		frappe.db.bulk_insert(doctype, ["name", *fields, *std_fields], [[*row, *std] for row in values])
+
+	def key(kind, i):
+		return f"{PADDING_PREFIX} {kind} {i}"
+
+	pad("Deal", ["docstatus", "status", "customer", "price_list_area", "sales_type", "soda_date"], (
+		(key("Deal", i), 0, "Cancelled", key("Customer", i % 50), key("Area", i % 50), "FOR",
+		 add_days(PADDING_DATE, i % 365))
+		for i in rows))
+	pad("Deal Item", ["parent", "parenttype", "parentfield", "idx", "docstatus", "item", "pack_size", "qty",
+		"item_status"], (
+		(key("Deal Item", i), key("Deal", i), "Deal", "items", 1, 0, key("Item", i % 50), key("Pack", i % 5), 1,
+		 "Delivered")
+		for i in rows))
+	pad("Deal Delivery Item", ["parent", "parenttype", "parentfield", "idx", "docstatus", "soda", "deal_item",
+		"item", "pack_size", "deliver_qty"], (
+		(key("Delivery Item", i), key("Delivery", i), "Deal Delivery", "items", 1, 2, key("Deal", i),
+		 key("Deal Item", i), key("Item", i % 50), key("Pack", i % 5), 1)
+		for i in rows))
+	pad("Deal Price List", ["docstatus", "price_list_area", "item", "effective_datetime", "is_active",
+		"base_price_50kg"], (
+		(key("Price", i), 0, key("Area", i % 50), key("Item", i % 50), add_days(PADDING_DATE, i % 365), 0, 1)
+		for i in rows))
+	pad("Mandi Stock Entry", ["docstatus", "status", "entry_type", "posting_date"], (
+		(key("Stock Entry", i), 2, "Cancelled", "Receipt", add_days(PADDING_DATE, i % 365))
+		for i in rows))
+	pad("Mandi Stock Entry Item", ["parent", "parenttype", "parentfield", "idx", "docstatus", "item",
+		"pack_size", "qty"], (
+		(key("Stock Entry Item", i), key("Stock Entry", i), "Mandi Stock Entry", "items", 1, 2,
+		 key("Item", i % 50), key("Pack", i % 5), 1)
+		for i in rows))
+	pad("Grain Purchase", ["docstatus", "contract_date", "farmer_name"], (
+		(key("Grain Purchase", i), 0, add_days(PADDING_DATE, i % 365), key("Farmer", i))
+		for i in rows))
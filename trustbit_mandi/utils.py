@@ -1,5 +1,7 @@
 """Shared helpers for the Trustbit Mandi app."""
 
+from contextlib import contextmanager
+
 import frappe
 from frappe import _
 
@@ -42,3 +44,119 @@ def get_mandi_company():
 def get_company_abbr(company=None):
 	"""Abbreviation of the mandi company, used to build warehouse names."""
 	return frappe.get_cached_value("Company", company or get_mandi_company(), "abbr")
+
+
+class MandiErpContext:
+	"""Master data for the ERPNext documents one batch of work creates.
+
+	A Vehicle Dispatch posts a Sales Invoice and Payment Entry per customer
+	and a Stock Entry per delivery. Resolving the company, its accounts, the
+	KG UOM, warehouse, customer names and addresses once up front keeps the
+	master-data queries fixed however many customers are on the truck.
+	Activate it with mandi_erp_context(); builders read it through
+	get_active_erp_context() and fall back to their own lookups without one.
+	"""
+
+	def __init__(self, customers=()):
+		from trustbit_mandi.trustbit_mandi.doctype.mandi_stock_entry.mandi_stock_entry import (
+			get_default_warehouse,
+			get_kg_uom,
+		)
+
+		self.company = get_mandi_company()
+		company = frappe.get_cached_value(
+			"Company",
+			self.company,
+			["default_income_account", "cost_center", "stock_adjustment_account"],
+			as_dict=True,
+		) or frappe._dict()
+		self.income_account = company.default_income_account
+		self.cost_center = company.cost_center
+		self.stock_adjustment_account = company.stock_adjustment_account
+
+		self.kg_uom = get_kg_uom()
+		self.default_warehouse = get_default_warehouse()
+		self.warehouse_companies = {}
+		if self.default_warehouse:
+			self.warehouse_companies[self.default_warehouse] = self.company
+
+		self.payment_account = None
+
+		self.customer_names = {}
+		self.addresses = {}
+		self.load_customers(customers)
+
+	def load_customers(self, customers):
+		"""Resolve names and billing addresses for `customers`."""
+		customers = tuple(sorted({c for c in customers if c} - set(self.customer_names)))
+		if not customers:
+			return
+
+		for row in frappe.get_all(
+			"Customer",
+			filters={"name": ["in", customers]},
+			fields=["name", "customer_name"],
+		):
+			self.customer_names[row.name] = row.customer_name or row.name
+		for customer in customers:
+			self.customer_names.setdefault(customer, customer)
+
+		# Same rule as frappe's get_default_address: the primary address, or
+		# the only one when the customer has exactly one.
+		addresses = {}
+		for row in frappe.db.sql("""
+			SELECT dl.link_name as customer, addr.name, addr.is_primary_address
+			FROM `tabAddress` addr
+			INNER JOIN `tabDynamic Link` dl ON dl.parent = addr.name AND dl.parenttype = 'Address'
+			WHERE dl.link_doctype = 'Customer' AND dl.link_name IN %(customers)s
+				AND IFNULL(addr.disabled, 0) = 0
+			ORDER BY addr.is_primary_address DESC, addr.name ASC
+		""", {"customers": customers}, as_dict=True):
+			addresses.setdefault(row.customer, []).append(row)
+		for customer in customers:
+			rows = addresses.get(customer) or []
+			primary = [row.name for row in rows if row.is_primary_address]
+			self.addresses[customer] = primary[0] if primary else (
+				rows[0].name if len(rows) == 1 else None)
+
+	def get_customer_name(self, customer):
+		self.load_customers([customer])
+		return self.customer_names.get(customer) or customer
+
+	def get_address(self, customer):
+		self.load_customers([customer])
+		return self.addresses.get(customer)
+
+	def get_payment_account(self):
+		"""The bank/cash account get_payment_entry picks for a Sales Invoice of the company.
+
+		Resolved with ERPNext's own rule (default bank account, else cash) on
+		first use, so every Payment Entry posts to the account it did before.
+		"""
+		if self.payment_account is None:
+			from erpnext.accounts.doctype.payment_entry.payment_entry import get_bank_cash_account
+
+			bank = get_bank_cash_account(frappe._dict(company=self.company), None)
+			self.payment_account = (bank or {}).get("account") or ""
+		return self.payment_account
+
+	def get_warehouse_company(self, warehouse):
+		if warehouse not in self.warehouse_companies:
+			self.warehouse_companies[warehouse] = frappe.db.get_value("Warehouse", warehouse, "company")
+		return self.warehouse_companies[warehouse]
+
+
+@contextmanager
+def mandi_erp_context(customers=()):
+	"""Make a MandiErpContext for `customers` active for the duration of the block."""
+	previous = frappe.flags.mandi_erp_context
+	frappe.flags.mandi_erp_context = context = MandiErpContext(customers)
+	try:
+		yield context
+	finally:
+		frappe.flags.mandi_erp_context = previous
+
+
+def get_active_erp_context():
+	"""The MandiErpContext of the enclosing mandi_erp_context() block, if any."""
+	return frappe.flags.mandi_erp_context